@@ -0,0 +1,63 @@
+import os
+import argparse
+import tempfile
+
+import numpy as np
+
+from time import perf_counter
+
+from opensfdi.io.repositories import FileImageRepo
+
+def synthetic_stack(cameras, phases, width, height, seed=0):
+    rng = np.random.default_rng(seed)
+
+    x = np.linspace(0.0, 16.0 * np.pi, width, dtype=np.float32)
+    base = 0.5 + 0.5 * np.cos(x)[None, :, None] * np.ones((height, 1, 3), dtype=np.float32)
+
+    return [[base + 0.05 * rng.random((height, width, 3), dtype=np.float32) for _ in range(phases)] for _ in range(cameras)]
+
+def timed(func):
+    start = perf_counter()
+    func()
+    return perf_counter() - start
+
+def run(stack, workers, ext):
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = FileImageRepo(tmp, workers=workers)
+
+        names = []
+        for cam_i, xs in enumerate(stack):
+            for i, img in enumerate(xs):
+                names.append(f'cam{cam_i}_img{i}.{ext}')
+                repo.add_image(img, names[-1])
+
+        save = timed(repo.commit)
+        load = timed(lambda: repo.load_images(names))
+
+    return save, load
+
+def main():
+    parser = argparse.ArgumentParser(description='FileImageRepo encode/decode time against thread count')
+    parser.add_argument('--cameras', type=int, default=4)
+    parser.add_argument('--phases', type=int, default=12)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument('--ext', default='jpg')
+    args = parser.parse_args()
+
+    stack = synthetic_stack(args.cameras, args.phases, args.width, args.height)
+
+    print(f'{args.cameras * args.phases} images of {args.width}x{args.height} ({args.ext}), {os.cpu_count()} cpus')
+    print(f'{"workers":>8} {"save (s)":>10} {"load (s)":>10} {"speed-up":>9}')
+
+    serial = None
+    for workers in sorted(set(args.workers)):
+        save, load = run(stack, workers, args.ext)
+
+        if serial is None: serial = save + load
+
+        print(f'{workers:>8} {save:>10.3f} {load:>10.3f} {serial / (save + load):>8.2f}x')
+
+if __name__ == '__main__':
+    main()
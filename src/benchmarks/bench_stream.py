@@ -0,0 +1,92 @@
+import argparse
+
+import numpy as np
+
+from time import perf_counter
+
+from opensfdi.experiment import FringeProjection, NStepFPExperiment
+from opensfdi.profilometry import ClassicPhaseHeight
+from opensfdi.unwrap import itoh
+from opensfdi.video import FringeProjector, SyntheticCamera
+
+PLANE_DIST = 100.0
+PROJ_DIST = 200.0
+
+class SyntheticProjector(FringeProjector):
+    def __init__(self, steps, frequency, resolution):
+        super().__init__('Projector1', frequency, np.pi / 2.0, resolution, [2.0 * np.pi * i / steps for i in range(steps)])
+
+    def display(self):
+        pass
+
+def synthetic_surface(width, height, amplitude=5.0):
+    y, x = np.ogrid[-1.0:1.0:height * 1j, -1.0:1.0:width * 1j]
+
+    return (amplitude * np.exp(-3.0 * (x * x + y * y))).astype(np.float32)
+
+def make_experiment(args):
+    w, h = args.width, args.height
+    truth = synthetic_surface(w, h)
+
+    projector = SyntheticProjector(args.steps, args.period, (w, h))
+    cameras = [SyntheticCamera(projector, resolution=(w, h), plane_dist=PLANE_DIST, proj_dist=PROJ_DIST, noise=args.noise,
+                               gamma=args.gamma, dtype=np.uint8, name=f'Camera{i}', seed=i) for i in range(args.cameras)]
+
+    experiment = NStepFPExperiment(FringeProjection(cameras, projector), steps=args.steps)
+
+    experiment.add_pre_ref_callback(lambda: [c.set_heightmap(None) for c in cameras])
+    experiment.add_post_ref_callback(lambda: [c.set_heightmap(truth) for c in cameras])
+
+    return experiment, projector, truth
+
+def main():
+    parser = argparse.ArgumentParser(description='Sustained NStepFPExperiment throughput with synthetic cameras')
+    parser.add_argument('--cameras', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--period', type=float, default=32, help='fringe period in pixels')
+    parser.add_argument('--noise', type=float, default=0.01)
+    parser.add_argument('--gamma', type=float, default=1.0)
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of each run')
+    args = parser.parse_args()
+
+    experiment, projector, truth = make_experiment(args)
+    frames = 2 * args.steps * args.cameras
+
+    # Capture only
+    count, start = 0, perf_counter()
+    while perf_counter() - start < args.seconds:
+        measurement = experiment.run()
+        count += 1
+    elapsed = perf_counter() - start
+
+    print(f'capture:   {count / elapsed:7.2f} measurements/s ({count * frames / elapsed:.1f} frames/s)')
+
+    # Capture and reconstruction on pipeline threads
+    stages = experiment.heightmap_stages(1.0 / args.period, [PLANE_DIST] * args.cameras, [PROJ_DIST] * args.cameras)
+
+    with experiment.pipelined_stream(stages) as pipeline:
+        count, start = 0, perf_counter()
+        for _ in pipeline:
+            count += 1
+            if args.seconds <= perf_counter() - start: break
+        elapsed = perf_counter() - start
+
+        stats = pipeline.stats()
+
+    print(f'pipelined: {count / elapsed:7.2f} heightmaps/s')
+    for name, s in stats.items():
+        print(f'  {name:>14}: {s["mean_latency"] * 1e3:8.2f} ms mean latency')
+
+    # Accuracy of one reconstruction against the rendered surface
+    ref_imgs, imgs = measurement
+    ph = ClassicPhaseHeight(1.0 / args.period, PLANE_DIST, PROJ_DIST, unwrapper=lambda phase: itoh.unwrap_phase(phase, axis=None))
+    heightmap = ph.heightmap(ref_imgs[0, ..., 0].astype(np.float32), imgs[0, ..., 0].astype(np.float32))
+
+    print(f'accuracy:  {np.sqrt(np.mean((heightmap - truth) ** 2)):.4f} RMS height error (surface peak {truth.max():.1f})')
+
+    experiment.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import argparse
+
+import numpy as np
+
+from time import perf_counter
+
+from skimage.restoration import unwrap_phase as skimage_unwrap
+
+from opensfdi.unwrap import itoh, reliability
+
+# Single-core throughput target for the reliability unwrapper (megapixels per second)
+RELIABILITY_TARGET_MPS = 0.5
+
+def synthetic_wrapped(width, height, cycles=16):
+    x, y = np.meshgrid(np.linspace(0.0, 1.0, width, dtype=np.float32), np.linspace(0.0, 1.0, height, dtype=np.float32))
+
+    truth = (2.0 * np.pi * cycles) * (x + 0.5 * y * y)
+
+    return np.angle(np.exp(1j * truth)).astype(np.float32)
+
+def best_of(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Phase unwrapping throughput (itoh, reliability, scikit-image)')
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--aspect', type=float, default=4.0 / 3.0, help='width / height of the synthetic maps')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--batch', type=int, default=4, help='stack size for the batched itoh run')
+    parser.add_argument('--skip-skimage', action='store_true')
+    args = parser.parse_args()
+
+    print(f'{"size":>11} {"method":>12} {"time (s)":>10} {"MP/s":>8}')
+
+    for mp in args.megapixels:
+        height = int(round((mp * 1e6 / args.aspect) ** 0.5))
+        width = int(round(height * args.aspect))
+        pixels = width * height
+
+        wrapped = synthetic_wrapped(width, height)
+        batch = np.repeat(wrapped[None], args.batch, axis=0)
+
+        runs = {
+            'itoh'          : (lambda: itoh.unwrap_phase(wrapped, axis=None), pixels),
+            f'itoh x{args.batch}' : (lambda: itoh.unwrap_phase(batch, axis=None), pixels * args.batch),
+            'reliability'   : (lambda: reliability.unwrap_phase(wrapped), pixels),
+        }
+
+        if not args.skip_skimage:
+            runs['skimage'] = (lambda: skimage_unwrap(wrapped), pixels)
+
+        for name, (func, px) in runs.items():
+            t = best_of(func, args.repeats)
+            mps = px / t / 1e6
+
+            note = ''
+            if name == 'reliability' and mps < RELIABILITY_TARGET_MPS:
+                note = f'  (below {RELIABILITY_TARGET_MPS} MP/s target)'
+
+            print(f'{f"{width}x{height}":>11} {name:>12} {t:>10.4f} {mps:>8.2f}{note}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+''' Reconstruction hot path benchmarks on synthetic data.
+
+    python -m benchmarks.suite --baseline benchmarks/baseline.json
+
+compares a run against the reference results committed in benchmarks/baseline.json (its "meta"
+records the machine they came from; cases and sizes missing from it are not compared). Timings
+only compare meaningfully on similar hardware: after an intended change, or on a new reference
+machine, regenerate it from src/ with
+
+    python -m benchmarks.suite --megapixels 0.3 2 8 --output benchmarks/baseline.json
+'''
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+from time import perf_counter
+
+from opensfdi import definitions, wrapped_phase, unwrapped_phase
+from opensfdi.fringes import FringeFactory
+from opensfdi.unwrap import itoh, reliability
+from opensfdi.profilometry import ClassicPhaseHeight, PolyPhaseHeight
+from opensfdi.experiment import LightCalc
+from opensfdi.calibration import apply_correction, apply_lut, correction_lut
+from opensfdi.io.repositories import ChunkedArrayRepo
+
+# Name -> setup(width, height, tmp) returning the callable to time
+CASES = {}
+
+STEPS = 3
+PERIOD = 32
+GAMMA_COEFFS = [0.6, 0.3, 0.1, 0.0]
+
+# Differences below these are treated as noise when comparing against a baseline
+# (timer resolution and scheduling for times; tracemalloc jitter from caches and interning for memory)
+NOISE_FLOOR_SECONDS = 1e-3
+NOISE_FLOOR_MB = 0.5
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def case(name):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+
+    return register
+
+def synthetic_surface(width, height, amplitude=4.0):
+    y, x = np.ogrid[-1.0:1.0:height * 1j, -1.0:1.0:width * 1j]
+
+    return (amplitude * np.exp(-4.0 * (x * x + y * y))).astype(np.float32)
+
+def synthetic_stacks(width, height):
+    ''' Reference fringes from FringeFactory and the same fringes phase shifted by a synthetic surface. '''
+    # Vertical fringes (orientation π/2 varies along x), matching the measurement built below
+    ref_imgs = FringeFactory.MakeSinusoidal(PERIOD, STEPS, np.pi / 2.0, width=width, height=height)
+
+    x = np.arange(width, dtype=np.float32)
+    surface = synthetic_surface(width, height)
+
+    imgs = np.empty_like(ref_imgs)
+    for i in range(STEPS):
+        np.cos(surface + np.float32(2.0 * np.pi / PERIOD) * x + np.float32(2.0 * np.pi * i / STEPS), out=imgs[i])
+        imgs[i] *= 0.5
+        imgs[i] += 0.5
+
+    return np.asarray(ref_imgs), imgs
+
+def synthetic_wrapped(width, height):
+    x = np.arange(width, dtype=np.float32)
+
+    return np.angle(np.exp(1j * (np.float32(2.0 * np.pi / PERIOD) * x + 8.0 * synthetic_surface(width, height)))).astype(np.float32)
+
+@case('wrapped_phase')
+def _(width, height, tmp):
+    _, imgs = synthetic_stacks(width, height)
+    return lambda: wrapped_phase(imgs)
+
+@case('unwrap_itoh')
+def _(width, height, tmp):
+    wrapped = synthetic_wrapped(width, height)
+    return lambda: itoh.unwrap_phase(wrapped, axis=None)
+
+@case('unwrap_reliability')
+def _(width, height, tmp):
+    wrapped = synthetic_wrapped(width, height)
+    return lambda: reliability.unwrap_phase(wrapped)
+
+@case('unwrap_skimage')
+def _(width, height, tmp):
+    wrapped = synthetic_wrapped(width, height)
+    return lambda: unwrapped_phase(wrapped)
+
+@case('classic_heightmap')
+def _(width, height, tmp):
+    ref_imgs, imgs = synthetic_stacks(width, height)
+    ph = ClassicPhaseHeight(1.0 / PERIOD, 500.0, 250.0)
+
+    return lambda: ph.heightmap(ref_imgs, imgs)
+
+@case('poly_heightmap')
+def _(width, height, tmp):
+    ref_imgs, imgs = synthetic_stacks(width, height)
+    ph = PolyPhaseHeight(coeffs=[0.0, 0.5, 0.01], unwrapper=lambda phase: itoh.unwrap_phase(phase, axis=None))
+
+    return lambda: ph.heightmap(ref_imgs, imgs)
+
+@case('to_stl')
+def _(width, height, tmp):
+    heightmap = synthetic_surface(width, height)
+    ph = ClassicPhaseHeight(1.0 / PERIOD, 500.0, 250.0)
+    path = os.path.join(tmp, 'bench.stl')
+
+    return lambda: ph.to_stl(heightmap, path)
+
+@case('light_calc')
+def _(width, height, tmp):
+    ref_imgs, imgs = synthetic_stacks(width, height)
+    calc = LightCalc(0.05, 1.0, 1.43)
+    calc.lookup_table() # Built once per session, not part of the timing
+
+    return lambda: calc.calculate(0.8 * imgs, ref_imgs)
+
+@case('apply_correction')
+def _(width, height, tmp):
+    img = np.random.default_rng(0).random((height, width), dtype=np.float32)
+    return lambda: apply_correction(img, GAMMA_COEFFS)
+
+@case('apply_lut')
+def _(width, height, tmp):
+    img = np.random.default_rng(0).integers(0, 4096, (height, width), dtype=np.uint16)
+    lut = correction_lut(GAMMA_COEFFS, 4096)
+
+    return lambda: apply_lut(img, lut, out=np.empty_like(img), bits=12)
+
+@case('repo_save')
+def _(width, height, tmp):
+    imgs = (synthetic_stacks(width, height)[1] * 4095).astype(np.uint16)
+    repo = ChunkedArrayRepo(os.path.join(tmp, 'repo'))
+
+    def save():
+        repo.add_image(imgs, 'imgs', frame_ndim=2)
+        repo.commit()
+
+    return save
+
+@case('repo_load')
+def _(width, height, tmp):
+    imgs = (synthetic_stacks(width, height)[1] * 4095).astype(np.uint16)
+    path = os.path.join(tmp, 'repo')
+
+    repo = ChunkedArrayRepo(path)
+    repo.add_image(imgs, 'imgs', frame_ndim=2)
+    repo.commit()
+
+    return lambda: np.array(ChunkedArrayRepo(path).load_image('imgs'))
+
+def measure(func, repeats):
+    ''' Best time over repeats, then peak traced allocation (MB) over one extra run. '''
+    func() # Warm up caches and lazy imports
+
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+
+    # numpy reports its buffers to tracemalloc; memory allocated inside OpenCV is not seen
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    return min(times), peak / 1e6
+
+def size_for(megapixels, aspect):
+    height = int(round((megapixels * 1e6 / aspect) ** 0.5))
+    return int(round(height * aspect)), height
+
+def compare(results, baseline, tolerance):
+    ''' Results slower or larger than the baseline by more than tolerance (a fraction). '''
+    previous = {(r["case"], r["megapixels"]): r for r in baseline["results"]}
+
+    regressions = []
+    for r in results:
+        old = previous.get((r["case"], r["megapixels"]))
+        if old is None: continue
+
+        for key in ("seconds", "peak_mb"):
+            floor = NOISE_FLOOR_SECONDS if key == "seconds" else NOISE_FLOOR_MB
+
+            if (1.0 + tolerance) * old[key] + floor < r[key]:
+                regressions.append((r["case"], r["megapixels"], key, old[key], r[key]))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconstruction hot path benchmarks on synthetic data')
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[0.3, 2, 8, 20])
+    parser.add_argument('--aspect', type=float, default=4.0 / 3.0, help='width / height of the synthetic images')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', nargs='?', const=BASELINE, help=f'JSON results to compare against (default {os.path.relpath(BASELINE)})')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown/growth over the baseline')
+    args = parser.parse_args()
+
+    results = []
+
+    print(f'{"case":>20} {"size":>11} {"time (s)":>10} {"MP/s":>8} {"peak (MB)":>10}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Keep generated fringes and lookup tables out of the real data directory
+        definitions.update_root(tmp)
+
+        for mp in args.megapixels:
+            width, height = size_for(mp, args.aspect)
+
+            for name in args.cases:
+                seconds, peak_mb = measure(CASES[name](width, height, tmp), args.repeats)
+                mps = width * height / seconds / 1e6
+
+                results.append({"case": name, "megapixels": mp, "width": width, "height": height,
+                                "seconds": seconds, "mp_per_s": mps, "peak_mb": peak_mb})
+
+                print(f'{name:>20} {f"{width}x{height}":>11} {seconds:>10.4f} {mps:>8.2f} {peak_mb:>10.1f}')
+
+                FringeFactory.clear_cache()
+
+    report = {
+        "meta": {
+            "python"    : platform.python_version(),
+            "numpy"     : np.__version__,
+            "platform"  : platform.platform(),
+            "cpus"      : os.cpu_count(),
+            "repeats"   : args.repeats
+        },
+        "results": results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as infile:
+            regressions = compare(results, json.load(infile), args.tolerance)
+
+        for name, mp, key, old, new in regressions:
+            print(f'REGRESSION {name} at {mp} MP: {key} {old:.4g} -> {new:.4g}')
+
+        if regressions: sys.exit(1)
+
+        print(f'No regressions against {args.baseline}')
+
+if __name__ == '__main__':
+    main()
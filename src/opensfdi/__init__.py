@@ -1,40 +1,55 @@
-from skimage.restoration import unwrap_phase
+import os
+import sys
+import logging
+import threading
 
 import numpy as np
-import cv2
-from matplotlib import pyplot as plt
 
-import logging
-import sys
-import argparse
+from opensfdi.utils.maths import demodulate
+from opensfdi.utils.precision import set_precision, get_precision
+from opensfdi.instrument import traced
 
-parser = argparse.ArgumentParser()
+# matplotlib, cv2 and scikit-image are imported on first use so that importing opensfdi stays cheap
+# (worker processes import it on every spawn)
 
-parser.add_argument('--debug', action='store_true')
+DEBUG = os.environ.get('OPENSFDI_DEBUG', '').lower() in ('1', 'true', 'yes', 'on')
 
-args, unknown = parser.parse_known_args()
+logger = logging.getLogger('opensfdi')
+logger.addHandler(logging.NullHandler())
+logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
 
-args = vars(args)
+def set_debug(enabled=True):
+    ''' Enable debug output (plots and debug logging). Also set by OPENSFDI_DEBUG=1 in the environment. '''
+    global DEBUG
 
-DEBUG = args["debug"]
+    DEBUG = enabled
+    logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
 
-logger = logging.getLogger('opensfdi')
+def configure_logging(debug=None, stream=sys.stdout):
+    ''' Send opensfdi log messages to stream (stdout by default), for scripts and command line tools. '''
+    if debug is not None: set_debug(debug)
 
-#formatter = logging.Formatter(fmt='%(threadName)s:%(message)s')
-formatter = logging.Formatter(fmt='[%(levelname)s] %(message)s')
+    #formatter = logging.Formatter(fmt='%(threadName)s:%(message)s')
+    formatter = logging.Formatter(fmt='[%(levelname)s] %(message)s')
 
-handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(formatter)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(formatter)
 
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+
+    return handler
 
 def show_phasemap(phasemap, min_phase=None, max_phase=None):
+    from matplotlib import pyplot as plt
+
     plt.imshow(phasemap, cmap='gray', vmin=min_phase, vmax=max_phase)
     plt.title(f'Phasemap ({phasemap.min():.2f} to {phasemap.max():.2f})')
     plt.show()
 
 def show_surface(data):
+    from matplotlib import pyplot as plt
+
     hf = plt.figure()
 
     ha = hf.add_subplot(111, projection='3d')
@@ -46,6 +61,9 @@ def show_surface(data):
     plt.show()
 
 def show_image(img, grey=False, title='', vmin=0.0, vmax=1.0):
+    import cv2
+    from matplotlib import pyplot as plt
+
     if grey:
         cmap='gray'
     else:
@@ -69,37 +87,41 @@ def centre_crop_img(img, x1, y1, x2:int = 0, y2:int = 0):
 def normalise_image(img):
     return ((img - img.min()) / (img.max() - img.min()))
 
-def rgb2grey(img):
-    r, g, b = img[:,:,0], img[:,:,1], img[:,:,2]
-    return 0.2989 * r + 0.5870 * g + 0.1140 * b
+def rgb2grey(img, out=None, scratch=None):
+    ''' Luma of an (..., 3) image in the compute precision. Channels are weighted one at a time,
+        so integer camera frames are never copied to float as a whole. out and scratch are
+        optional buffers of shape img.shape[:-1] to write into instead of allocating.
+    '''
+    dtype = get_precision()
+
+    grey = np.multiply(img[..., 0], dtype.type(0.2989), out=out, dtype=dtype)
+    if scratch is None: scratch = np.empty_like(grey)
+
+    for c, weight in ((1, 0.5870), (2, 0.1140)):
+        np.multiply(img[..., c], dtype.type(weight), out=scratch, dtype=dtype)
+        grey += scratch
 
+    return grey
+
+# scikit-image's unwrapper keeps global state in its C code and gives wrong results when called concurrently
+_unwrap_lock = threading.Lock()
+
+@traced('unwrap.skimage', pixels=lambda phi_imgs: np.size(phi_imgs))
 def unwrapped_phase(phi_imgs):
-    return unwrap_phase(phi_imgs)
+    from skimage.restoration import unwrap_phase
 
+    with _unwrap_lock:
+        result = unwrap_phase(phi_imgs)
 
-def wrapped_phase(imgs):
-    p = np.zeros(imgs[0].shape, dtype=np.float32)
-    q = np.zeros(imgs[0].shape, dtype=np.float32)
+    # scikit-image always unwraps in float64
+    return result.astype(get_precision(), copy=False)
 
-    for i, img in enumerate(imgs):
-        phase = (2.0  * np.pi * i) / len(imgs)
-        p = np.add(p, img * np.sin(phase), dtype=np.float32)
-        q = np.add(q, img * np.cos(phase), dtype=np.float32)
 
-    return np.negative(np.arctan2(p, q), dtype=np.float32)
+def wrapped_phase(imgs):
+    return demodulate(imgs)[0]
 
 def ac_imgs(imgs: list):
-    return np.divide(np.sum(imgs, axis=0), len(imgs))
+    return demodulate(imgs)[2]
 
 def dc_imgs(imgs: list):
-    N = len(imgs)
-    
-    p = q = np.zeros(imgs[0].shape, dtype=np.float32)
-    
-    for i, img in enumerate(imgs):
-        phase = (2.0 * np.pi * i) / N
-        
-        p = np.add(p, img * np.sin(phase))
-        q = np.add(q, img * np.cos(phase))
-        
-    return (2.0 / N) * np.sqrt((p * p) + (q * q))
\ No newline at end of file
+    return demodulate(imgs)[1]
\ No newline at end of file
@@ -1,25 +1,113 @@
+import os
 import cv2
 import logging
 import numpy as np
 
-import matplotlib.pyplot as plt
+import opensfdi
 
-from opensfdi import DEBUG
-from opensfdi import rgb2grey, display_image
-from opensfdi.definitions import CALIBRATION_DIR
+from opensfdi import rgb2grey
+from opensfdi import definitions
 from opensfdi.io.std import Serializable
+from opensfdi.utils.precision import as_float, get_precision
 
 from abc import ABC, abstractmethod
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+# Correction table sizes for common camera/projector bit depths
+LUT_SIZES = {8: 256, 10: 1024, 12: 4096}
 
 def apply_correction(img, coeffs, x1=0.0, x2=1.0):
-    poly_func = np.poly1d(coeffs)
+    img = as_float(img)
+
+    # Horner's rule (coefficients highest power first, as np.poly1d) in the compute precision
+    corrected_img = np.full_like(img, coeffs[0])
+
+    for c in coeffs[1:]:
+        corrected_img *= img
+        corrected_img += c
+
+    return np.clip(corrected_img, x1, x2, out=corrected_img) # Cutoff values outside of [x1, x2]
+
+def correction_lut(coeffs, size=256, x1=0.0, x2=1.0):
+    ''' Corrected intensity in [x1, x2] for size evenly spaced input intensities in [0, 1]. '''
+    levels = np.linspace(0.0, 1.0, size)
+
+    return np.clip(np.polyval(coeffs, levels), x1, x2).astype(np.float32)
+
+def apply_lut(img, lut, out=None, bits=None):
+    ''' Gamma correct img by table lookup.
+
+        uint8/uint16 images are corrected in place (or into out), keeping their dtype. Their codes
+        span the dtype's full range, or 0..2**bits - 1 for e.g. 10 or 12-bit camera data stored as
+        uint16 (larger codes are clipped), and are mapped onto the table by relative intensity.
+        Float images in [0, 1] are quantised to the nearest table entry and returned in the
+        compute precision.
+    '''
+    lut = as_float(lut)
+
+    if img.dtype in (np.uint8, np.uint16):
+        if bits is None: bits = img.dtype.itemsize * 8
+
+        if not 1 <= bits <= img.dtype.itemsize * 8:
+            raise Exception(f"{img.dtype} images cannot hold {bits}-bit codes")
+
+        table = __integer_table(np.ascontiguousarray(lut).tobytes(), lut.dtype.str, img.dtype.str, bits)
+
+        if out is None: out = img
+
+        return np.take(table, img, out=out, mode='clip')
+
+    if not np.issubdtype(img.dtype, np.floating):
+        raise Exception(f"Gamma correction needs uint8, uint16 or float images (got {img.dtype})")
+
+    n = len(lut)
+    idx = np.multiply(img, n - 1, dtype=get_precision())
+    np.clip(idx, 0, n - 1, out=idx)
+    np.rint(idx, out=idx)
+
+    return np.take(lut, idx.astype(np.uint16 if n <= 65536 else np.intp), out=out)
+
+@lru_cache(maxsize=16)
+def __integer_table(lut, lut_dtype, dtype, bits):
+    # Corrected code for every input code, interpolating the table by relative intensity
+    lut = np.frombuffer(lut, dtype=lut_dtype)
+    top = (1 << bits) - 1
+
+    levels = np.interp(np.linspace(0.0, 1.0, top + 1), np.linspace(0.0, 1.0, len(lut)), lut)
+
+    table = np.rint(levels * top).astype(dtype)
+    table.flags.writeable = False
+
+    return table
+
+def find_checkerboard(image, checkerboard, max_size=1024):
+    ''' Checkerboard corners for one image, or None when the board isn't found.
+
+        Detection runs on the first pyramid level no larger than max_size, and the corners are
+        then refined to sub-pixel accuracy at full resolution around the coarse estimates.
+    '''
+    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+    grey_img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+    levels, small = 0, grey_img
+    while max_size < max(small.shape):
+        small = cv2.pyrDown(small)
+        levels += 1
+
+    ret, corners = cv2.findChessboardCorners(small, checkerboard, cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_NORMALIZE_IMAGE)
 
-    corrected_img = poly_func(img)
+    if not ret: return None
 
-    corrected_img[corrected_img < x1] = x1 # Cutoff values less than x1
-    corrected_img[corrected_img > x2] = x2 # Cutoff values greater than x2
+    if levels:
+        corners = cv2.cornerSubPix(small, corners, (5, 5), (-1, -1), criteria)
 
-    return corrected_img
+        # Pixel centres of level L map to (x + 0.5) * 2^L - 0.5 at full resolution
+        corners = ((corners + 0.5) * (1 << levels) - 0.5).astype(np.float32)
+
+    return cv2.cornerSubPix(grey_img, corners, (11, 11), (-1, -1), criteria)
 
 class Calibration(Serializable, ABC):
     def __init__(self):
@@ -30,8 +118,11 @@ class Calibration(Serializable, ABC):
         raise NotImplementedError
 
 class GammaCalibration(Calibration):
-    def __init__(self, camera, projector, delta, crop_size=0.25, order=5, intensity_count=32):
+    def __init__(self, camera, projector, delta, crop_size=0.25, order=5, intensity_count=32, bit_depth=8):
         super().__init__()
+
+        if bit_depth not in LUT_SIZES:
+            raise Exception(f"Unsupported bit depth {bit_depth} ({', '.join(map(str, LUT_SIZES))})")
         
         self.camera = camera
         self.projector = projector
@@ -40,9 +131,11 @@ class GammaCalibration(Calibration):
         self._crop_size = crop_size
         self._order = order
         self._intensity_count = intensity_count
+        self._bit_depth = bit_depth
         
         self.coeffs = None
         self.visible = None
+        self.lut = None
 
     def calibrate(self):
         intensities = np.linspace(0.0, 1.0, self._intensity_count, dtype=np.float32)
@@ -77,8 +170,11 @@ class GammaCalibration(Calibration):
 
         self.coeffs = np.polyfit(vis_averages, vis_intensities, self._order)
         self.visible = intensities[s:f+1]
+        self.lut = correction_lut(self.coeffs, LUT_SIZES[self._bit_depth], self.visible.min(), self.visible.max())
+
+        if opensfdi.DEBUG: # Plot results
+            import matplotlib.pyplot as plt
 
-        if DEBUG: # Plot results
             plt.plot(vis_averages, vis_intensities, 'o')
             trendpoly = np.poly1d(self.coeffs)
             plt.title('Gamma Calibration Curve Results')
@@ -91,10 +187,29 @@ class GammaCalibration(Calibration):
 
         return self.coeffs, self.visible
 
+    def correct(self, img, out=None, bits=None):
+        ''' Apply the correction table to a captured frame or projector pattern (see apply_lut). '''
+        if self.lut is None:
+            raise Exception("Gamma calibration has not been run")
+
+        return apply_lut(img, self.lut, out=out, bits=bits)
+
+    @staticmethod
+    def load_lut(data):
+        ''' Correction table from serialized calibration data, rebuilt from the curve for older data without one. '''
+        if "lut" in data:
+            return np.asarray(data["lut"], dtype=np.float32)
+
+        visible = np.asarray(data["visible_intensities"])
+
+        return correction_lut(data["coeffs"], LUT_SIZES[data.get("bit_depth", 8)], visible.min(), visible.max())
+
     def serialize(self):
         return {
                 "coeffs"                : self.coeffs.tolist(),
-                "visible_intensities"   : self.visible.tolist()
+                "visible_intensities"   : self.visible.tolist(),
+                "bit_depth"             : self._bit_depth,
+                "lut"                   : self.lut.tolist()
             }
         
     def deserialize(self):
@@ -119,12 +234,15 @@ class GammaCalibration(Calibration):
         return start, finish
 
 class CameraCalibration(Calibration):
-    def __init__(self, camera, img_count=10, cb_size=(8, 6)):
+    def __init__(self, camera, img_count=10, cb_size=(8, 6), workers=None, max_detect_size=1024):
         super().__init__()
         
         self.camera = camera
         
         self._cb_size = cb_size
+
+        self.workers = workers
+        self.max_detect_size = max_detect_size
         
         if img_count < 10:
             raise Exception("10 or more images are required to calibrate cameras")
@@ -132,8 +250,9 @@ class CameraCalibration(Calibration):
         self._img_count = img_count
         
         self.cam_mat = self.dist_mat = self.optimal_mat = None
+        self.failures = []
 
-    def on_checkboard_change(self, i):
+    def on_checkerboard_change(self, i):
         '''
             (i) = Image number just completed (doesn't take into account multiple cameras)
         '''
@@ -152,34 +271,23 @@ class CameraCalibration(Calibration):
         
         CHECKERBOARD = (self._cb_size[0] - 1, self._cb_size[1] - 1)
 
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-
         threedpoints = []
         twodpoints = []
 
         objectp3d = np.zeros((1, CHECKERBOARD[0] * CHECKERBOARD[1], 3), np.float32)
         objectp3d[0, :, :2] = np.mgrid[0:CHECKERBOARD[0], 0:CHECKERBOARD[1]].T.reshape(-1, 2)
 
-        for i, image in enumerate(imgs):
-            image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
-            grey_img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-            ret, corners = cv2.findChessboardCorners(grey_img, CHECKERBOARD, cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_NORMALIZE_IMAGE)
-
-            if ret:
+        for corners in self.detect(imgs):
+            if corners is not None:
                 threedpoints.append(objectp3d)
+                twodpoints.append(corners)
 
-                corners2 = cv2.cornerSubPix(grey_img, corners, (11, 11), (-1, -1), criteria)
-
-                twodpoints.append(corners2)
-                
-                #image = cv2.drawChessboardCorners(image, CHECKERBOARD, corners2, ret)
-            else:
-                self.logger.warning(f'{self.camera.name} failed to find checkerboard on image {i}')
+        if len(twodpoints) == 0:
+            raise Exception(f"No checkerboards found for {self.camera.name}")
 
         h, w = imgs[0].shape[:2]
 
-        ret, self.cam_mat, self.dist_mat, r_vecs, t_vecs = cv2.calibrateCamera(threedpoints, twodpoints, grey_img.shape[::-1], None, None)
+        ret, self.cam_mat, self.dist_mat, r_vecs, t_vecs = cv2.calibrateCamera(threedpoints, twodpoints, (w, h), None, None)
 
         if not ret: raise
 
@@ -187,6 +295,40 @@ class CameraCalibration(Calibration):
         
         return self.cam_mat, self.dist_mat, self.optimal_mat
 
+    def detect(self, imgs):
+        ''' Checkerboard corners for each image (None where the board wasn't found), detected across
+            a process pool (workers=1 runs serially). Failed images are listed in self.failures.
+        '''
+        checkerboard = (self._cb_size[0] - 1, self._cb_size[1] - 1)
+        args = (checkerboard, self.max_detect_size)
+
+        if self.workers == 1 or len(imgs) < 2:
+            found = [find_checkerboard(img, *args) for img in imgs]
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = [pool.submit(find_checkerboard, img, *args) for img in imgs]
+                found = [f.result() for f in futures]
+
+        self.failures = [i for i, corners in enumerate(found) if corners is None]
+
+        for i in self.failures:
+            self.logger.warning(f'{self.camera.name} failed to find checkerboard on image {i}')
+
+        return found
+
+    def save_undistort_maps(self, directory=None):
+        ''' Apply the calibration to the camera and save its undistortion maps, so they can be
+            loaded with Camera.load_undistort_maps instead of being rebuilt at start-up.
+        '''
+        if directory is None: directory = definitions.ensure_dir(definitions.CALIBRATION_DIR)
+
+        self.camera.cam_mat, self.camera.dist_mat, self.camera.optimal_mat = self.cam_mat, self.dist_mat, self.optimal_mat
+
+        path = os.path.join(directory, f'{self.camera.name}_undistort.npz')
+        self.camera.save_undistort_maps(path)
+
+        return path
+
     def serialize(self):
         return {
                 "checkerboard_size" : self._cb_size,
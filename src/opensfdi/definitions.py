@@ -25,6 +25,12 @@ def make_structure():
     Path(FRINGES_DIR).mkdir(exist_ok=True)
     Path(CALIBRATION_DIR).mkdir(exist_ok=True)
 
+def ensure_dir(path):
+    ''' Create path (and its parents) if needed, returning it. Directories are made when first written to rather than on import. '''
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+    return path
+
 def update_root(new_root, mkdirs=True):
     global ROOT_DIR
     global DATA_DIR
@@ -39,5 +45,3 @@ def update_root(new_root, mkdirs=True):
     CALIBRATION_DIR = os.path.join(DATA_DIR, "calibration") # Location where calibration data is dumped
     
     if mkdirs: make_structure()
-    
-make_structure()
\ No newline at end of file
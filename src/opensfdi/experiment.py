@@ -1,30 +1,59 @@
-
+import os
+import hashlib
 import numpy as np
 
 import logging
 
-from time import sleep
-from scipy.ndimage import gaussian_filter
-from scipy.interpolate import griddata
-
-from opensfdi.profilometry import ClassicPhaseHeight
-from opensfdi.video import FringeProjector
+from time import sleep, perf_counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+from opensfdi import definitions, rgb2grey
+from opensfdi import instrument
+from opensfdi.instrument import span, traced
+from opensfdi.io.std import replacing
+from opensfdi.pipeline import Pipeline
+from opensfdi.profilometry import ClassicPhaseHeight, ReferencePhase
+from opensfdi.video import FringeProjector, CaptureCoordinator
+from opensfdi.unwrap.temporal import TemporalUnwrapper
 from opensfdi.utils import maths
+from opensfdi.utils.precision import get_precision, set_precision
+
+def _frame_pixels(imgs):
+    # Cameras with nothing left to replay return None
+    return sum(img.shape[0] * img.shape[1] for img in imgs if img is not None)
 
 class Photogrammetry:
-    def __init__(self, cameras, delay):
+    def __init__(self, cameras, delay, timeout=10.0):
         if len(cameras) < 2: raise Exception("You need at least 2 cameras to run an experiment") 
         
         self.logger = logging.getLogger('opensfdi')
         self.cameras = cameras
         self.delay = delay
+
+        self.coordinator = CaptureCoordinator(cameras, timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        ''' Stop the cameras' capture workers. '''
+        self.coordinator.close()
         
     def run(self):
-        if 0 < self.delay: sleep(self.delay)
-        return [camera.capture() for camera in self.cameras]
+        with span('photogrammetry.run', frames=len(self.cameras)) as s:
+            if 0 < self.delay: sleep(self.delay)
+            imgs = self.coordinator.capture()
+
+            if instrument.ENABLED: s.add(pixels=_frame_pixels(imgs))
+
+        return imgs
 
 class FringeProjection:
-    def __init__(self, cameras, projector: FringeProjector, delay=0.0):
+    def __init__(self, cameras, projector: FringeProjector, delay=0.0, timeout=10.0):
         if projector is None: 
             raise Exception("You need a projector to run an experiment")
         
@@ -37,14 +66,63 @@ class FringeProjection:
         self.projector = projector
         self.delay = delay
 
+        self.coordinator = CaptureCoordinator(cameras, timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        ''' Stop the cameras' capture workers. '''
+        self.coordinator.close()
+
     def run(self):
-        self.projector.display()
-        if 0 < self.delay: sleep(self.delay)
-        return [camera.capture() for camera in self.cameras]
+        with span('fringe_projection.run', frames=len(self.cameras)) as s:
+            self.projector.display()
+            if 0 < self.delay: sleep(self.delay)
+            imgs = self.coordinator.capture()
+
+            if instrument.ENABLED: s.add(pixels=_frame_pixels(imgs))
+
+        return imgs
     
     def next(self):
         self.projector.next()
 
+    def frames(self):
+        ''' Endless stream of (phase step index, images): one capture per projector step. '''
+        while True:
+            index = self.projector.current
+
+            imgs = self.run()
+            self.next()
+
+            yield index, imgs
+
+    def rolling_phase(self, convert_grey=False, refresh=None):
+        ''' Endless stream of per-camera (wrapped phase, AC, DC) over the last n projector steps,
+            one per captured frame once every step has been seen (see maths.RollingDemodulator).
+            The arrays are reused by the next frame: copy anything that must outlive it.
+        '''
+        n = len(self.projector.phases)
+        demods = [maths.RollingDemodulator(n, refresh) for _ in self.cameras]
+        greys = None
+
+        for index, imgs in self.frames():
+            if convert_grey:
+                if greys is None:
+                    greys = [(np.empty(img.shape[:-1], dtype=get_precision()), np.empty(img.shape[:-1], dtype=get_precision())) for img in imgs]
+
+                imgs = [rgb2grey(img, out=grey, scratch=scratch) for img, (grey, scratch) in zip(imgs, greys)]
+
+            for demod, img in zip(demods, imgs):
+                demod.push(img, index)
+
+            if demods[0].ready:
+                yield [demod.result() for demod in demods]
+
 """ 
     def stream(self):
         self.stream = True
@@ -55,12 +133,18 @@ class FringeProjection:
         self.logger.info('Finished streaming') """
 
 class LightCalc:
-    def __init__(self, mu_a, mu_sp, refr_index, sf = [0.0, 0.2], std_dev = 3):
+    # Inverse lookup tables already built this session, keyed like the files in CALIBRATION_DIR
+    _luts = {}
+
+    def __init__(self, mu_a, mu_sp, refr_index, sf = [0.0, 0.2], std_dev = 3, lut_size=512):
         self.mu_a = mu_a 
         self.mu_sp = mu_sp
         self.refr_index = refr_index
         self.sf = sf
         self.std_dev = std_dev
+        self.lut_size = lut_size
+
+        self.logger = logging.getLogger('opensfdi')
     
     def __calculate(self, mu_a, mu_sp, refr_index):
         # Effective Reflection Coefficient
@@ -71,86 +155,114 @@ class LightCalc:
         ap = mu_sp / mu_tr                  # Reduced albedo
         
         return R_eff, A, mu_tr, ap
-    
-    def calculate(self, imgs, ref_imgs):
+
+    def forward_model(self, mu_a, mu_sp):
+        ''' Diffuse reflectance (R_dc, R_ac) from the diffusion approximation, broadcast over mu_a and mu_sp. '''
+        R_eff, A, mu_tr, ap = self.__calculate(mu_a, mu_sp, self.refr_index)
+
+        g = lambda mu_effp: (3 * A * ap) / (((mu_effp / mu_tr) + 1) * ((mu_effp / mu_tr) + 3 * A))
+
+        return g(maths.mu_eff(mu_a, mu_tr, self.sf[0])), g(maths.mu_eff(mu_a, mu_tr, self.sf[1]))
+
+    def lookup_table(self):
+        ''' Inverse LUT on a regular (R_dc, R_ac) grid: returns (dc_axis, ac_axis, mu_a table, mu_sp table).
+
+            Built once per (refractive index, spatial frequencies, size) and cached on disk in CALIBRATION_DIR.
+        '''
+        key = f'sfdi_lut_n{self.refr_index:.4f}_f{self.sf[0]:.4f}-{self.sf[1]:.4f}_{self.lut_size}'
+
+        if key in LightCalc._luts:
+            return LightCalc._luts[key]
+
+        path = os.path.join(definitions.CALIBRATION_DIR, f'{key}.npz')
+
+        if os.path.exists(path):
+            with np.load(path) as data:
+                lut = (data["dc_axis"], data["ac_axis"], data["mu_a"], data["mu_sp"])
+        else:
+            self.logger.info(f'Building inverse diffusion lookup table ({path})')
+            lut = self.__build_lut()
+
+            definitions.ensure_dir(definitions.CALIBRATION_DIR)
+
+            with replacing(path) as tmp, open(tmp, 'wb') as outfile:
+                np.savez(outfile, dc_axis=lut[0], ac_axis=lut[1], mu_a=lut[2], mu_sp=lut[3])
+
+        LightCalc._luts[key] = lut
+
+        return lut
+
+    def __build_lut(self):
+        # Get an array of reflectance values and corresponding optical properties
+        # We are setting the absorption coefficient range
+        mu_a, mu_sp = np.meshgrid(np.arange(0, 0.5, 0.001), np.arange(0.1, 5, 0.01), indexing='ij')
+
+        # THE DIFFUSION APPROXIMATION (all pairs at once)
+        r_dc, r_ac = self.forward_model(mu_a, mu_sp)
+
+        points = np.column_stack((r_dc.ravel(), r_ac.ravel()))
+
+        dc_axis = np.linspace(r_dc.min(), r_dc.max(), self.lut_size)
+        ac_axis = np.linspace(r_ac.min(), r_ac.max(), self.lut_size)
+        grid_dc, grid_ac = np.meshgrid(dc_axis, ac_axis, indexing='ij')
+
+        from scipy.interpolate import LinearNDInterpolator
+        from scipy.spatial import Delaunay
+
+        # Triangulate once to resample the scattered forward model onto the regular grid
+        tri = Delaunay(points)
+        lut_mua = LinearNDInterpolator(tri, mu_a.ravel())(grid_dc, grid_ac)
+        lut_musp = LinearNDInterpolator(tri, mu_sp.ravel())(grid_dc, grid_ac)
+
+        return dc_axis, ac_axis, lut_mua.astype(np.float32), lut_musp.astype(np.float32)
+
+    def lookup(self, r_dc, r_ac):
+        ''' Per-pixel (mu_a, mu_sp) maps from diffuse reflectance maps by bilinear LUT interpolation. '''
+        dc_axis, ac_axis, lut_mua, lut_musp = self.lookup_table()
+
+        coords = np.array([
+            (r_dc - dc_axis[0]) / (dc_axis[1] - dc_axis[0]),
+            (r_ac - ac_axis[0]) / (ac_axis[1] - ac_axis[0])
+        ], dtype=get_precision())
+
+        from scipy.ndimage import map_coordinates
+
+        # Reflectances outside the modelled range become NaN
+        mua = map_coordinates(lut_mua, coords, output=get_precision(), order=1, mode='constant', cval=np.nan)
+        musp = map_coordinates(lut_musp, coords, output=get_precision(), order=1, mode='constant', cval=np.nan)
+
+        return mua, musp
+
+    def optical_maps(self, imgs, ref_imgs):
+        ''' Per-pixel absorption and reduced scattering maps. '''
         R_eff, A, mu_tr, ap = self.__calculate(self.mu_a, self.mu_sp, self.refr_index)
         
-        ref_img_ac = maths.AC(ref_imgs)
-        ref_img_dc = maths.DC(ref_imgs)
+        _, ref_img_ac, ref_img_dc = maths.demodulate(ref_imgs)
+        _, imgs_ac, imgs_dc = maths.demodulate(imgs)
         
         # Apply some gaussian filtering if necessary
         if 0 < self.std_dev:
+            from scipy.ndimage import gaussian_filter
+
             ref_img_dc = gaussian_filter(ref_img_dc, self.std_dev)
             ref_img_ac = gaussian_filter(ref_img_ac, self.std_dev)
 
         # Get AC/DC Reflectance values using diffusion approximation
-        r_ac, r_dc = maths.diffusion_approximation(A, ap, mu_tr, f[1])
+        r_ac, r_dc = maths.diffusion_approximation(A, ap, mu_tr, self.sf[1])
 
         R_d_AC2 = (imgs_ac / ref_img_ac) * r_ac
         R_d_DC2 = (imgs_dc / ref_img_dc) * r_dc
 
-        xi = []
-        x, y = R_d_AC2.shape
-        # Put the DC and AC diffuse reflectance values into an array
-        for i in range(x):
-            for j in range(y):
-                freq = [R_d_DC2[i][j], R_d_AC2[i][j]]
-                xi.append(freq)
-
-        # Get an array of reflectance values and corresponding optical properties
-        # We are setting the absorption coefficient range
-        mu_a = np.arange(0, 0.5, 0.001)
-        mu_sp = np.arange(0.1, 5, 0.01)
-
-        # THE DIFFUSION APPROXIMATION
-        # Getting the diffuse reflectance AC values corresponding to specific absorption and reduced scattering coefficients
-        Reflectance_AC = []
-        Reflectance_DC = []
-        op_mua = []
-        op_sp = []
-        for i in range(len(mu_a)):
-            for j in range(len(mu_sp)):
-                # 1.43 is the refractive index of tissue
-                R_eff, A, mu_tr, ap = self.__calculate(mu_a[i], mu_sp[j], 1.43)
-
-                g = lambda mu_effp: (3 * A * ap) / (((mu_effp / mu_tr) + 1) * ((mu_effp / mu_tr) + 3 * A))
-
-                ac = maths.mu_eff(mu_a[i], mu_tr, f[1])
-                dc = maths.mu_eff(mu_a[i], mu_tr, f[0])
-
-                Reflectance_AC.append(g(ac))
-                Reflectance_DC.append(g(dc))
-
-                op_mua.append(mu_a[i])
-                op_sp.append(mu_sp[j])
-
-        # putting the DC and AC diffuse reflectance values generated from the Diffusion Approximation into an array
-        points = []
-        for k in range(len(mu_a) * len(mu_sp)):
-            freq = [Reflectance_DC[k], Reflectance_AC[k]]
-            points.append(freq)
-
-        points_array = np.array(points)
-        
-        #putting the optical properties into two seperate arrays
-        op_mua_array = np.array(op_mua)
-        op_sp_array = np.array(op_sp)
-
-        #using scipy.interpolate.griddata to perform cubic interpolation of diffuse reflectance values to match
-        #the generated diffuse reflectance values from image to calculated optical properties
-        interp_method = 'cubic'
-        coeff_abs = griddata(points_array, op_mua_array, xi, method=interp_method) #mua
-        coeff_sct = griddata(points_array, op_sp_array, xi, method=interp_method) #musp
-
-        abs_plot = np.reshape(coeff_abs, (R_d_AC2.shape[0], R_d_AC2.shape[1]))
-        sct_plot = np.reshape(coeff_sct, (R_d_AC2.shape[0], R_d_AC2.shape[1]))
+        return self.lookup(R_d_DC2, R_d_AC2)
+    
+    def calculate(self, imgs, ref_imgs):
+        abs_plot, sct_plot = self.optical_maps(imgs, ref_imgs)
 
         absorption = np.nanmean(abs_plot)
-        absorption_std = np.std(abs_plot)
+        absorption_std = np.nanstd(abs_plot)
 
         scattering = np.nanmean(sct_plot)
-        scattering_std = np.std(sct_plot)
-
+        scattering_std = np.nanstd(sct_plot)
 
         self.logger.info(f'Absorption: {absorption}')
         self.logger.info(f'Deviation std: {absorption_std}')
@@ -160,6 +272,35 @@ class LightCalc:
 
         return absorption, scattering, absorption_std, scattering_std
 
+def _classic_ph_camera(ref_imgs, imgs, out, sf, plane_dist, proj_dist, unwrapper):
+    start = perf_counter()
+
+    ph = ClassicPhaseHeight(sf, plane_dist, proj_dist, unwrapper)
+    ph.heightmap(ref_imgs, imgs, convert_grey=True, crop=None, out=out)
+
+    return perf_counter() - start
+
+def _classic_ph_shared(specs, i, reference, precision, *params):
+    # Process pool worker: attach to the shared stacks instead of receiving pickled copies.
+    # Spawned workers start from the environment's precision, so the parent's is passed along
+    set_precision(precision)
+
+    blocks = [SharedMemory(name=name) for name, _, _ in specs]
+
+    try:
+        ref_imgs, imgs, heightmaps = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf) for block, (_, shape, dtype) in zip(blocks, specs)]
+
+        # With cached references the first stack holds their phases rather than reference images
+        ref = ReferencePhase(None, ref_imgs[i], convert_grey=True) if reference else ref_imgs[i]
+
+        elapsed = _classic_ph_camera(ref, imgs[i], heightmaps[i], *params)
+
+        del ref_imgs, imgs, heightmaps
+    finally:
+        for block in blocks: block.close()
+
+    return elapsed
+
 class Experiment:
     def __init__(self, test):
         self.logger = logging.getLogger("opensfdi")
@@ -169,6 +310,16 @@ class Experiment:
         self.streaming = False
     
         self.save_results = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        ''' Close the test (its cameras' capture workers). '''
+        self.test.close()
     
     def stream(self):
         self.streaming = True
@@ -178,7 +329,16 @@ class Experiment:
             
         self.logger.info('Finished streaming')
 
+    def pipelined_stream(self, stages, maxsize=2, policy='block'):
+        ''' Run measurements on a capture thread feeding the (name, callable) processing stages.
+
+            Returns a started Pipeline: iterate over it for results and stop() it (or use it in a
+            with block) to shut down. See opensfdi.pipeline.Pipeline for the queue policies.
+        '''
+        return Pipeline(self.run, stages, maxsize=maxsize, policy=policy)
+
     # Subclass Experiment to declare your own default run behaviour
+    @traced('experiment.run')
     def run(self):
         self.logger.info(f'Taking a measurement')
         
@@ -190,7 +350,21 @@ class FPExperiment(Experiment):
     def __init__(self, test: FringeProjection):
         super().__init__(test)
 
+    def rolling_stream(self, convert_grey=False, refresh=None):
+        ''' Like stream, but yields per-camera (wrapped phase, AC, DC) on every frame from a sliding
+            window over the projector's phase steps instead of waiting for n new frames.
+        '''
+        self.streaming = True
+
+        for result in self.test.rolling_phase(convert_grey, refresh):
+            if not self.streaming: break
+
+            yield result
+
+        self.logger.info('Finished streaming')
+
     # Subclass Experiment to declare your own default run behaviour
+    @traced('experiment.run')
     def run(self):
         self.logger.info(f'Taking a measurement')
         
@@ -199,7 +373,7 @@ class FPExperiment(Experiment):
         return result
 
 class NStepFPExperiment(FPExperiment):
-    def __init__(self, test: FringeProjection, steps=3):
+    def __init__(self, test: FringeProjection, steps=3, frequencies=None, cache_references=False, calibration=None):
         super().__init__(test)
         
         self._pre_cbs = []
@@ -207,38 +381,116 @@ class NStepFPExperiment(FPExperiment):
 
         self.steps = steps
 
+        # Optional list of fringe frequencies to sequence (multi-frequency temporal unwrapping)
+        self.frequencies = frequencies
+
+        # With cache_references, classic_ph keeps each camera's reference phase (also saved through the
+        # CalibrationService calibration, when given) and run skips the reference capture while the
+        # setup they were captured with is unchanged
+        self.cache_references = cache_references or calibration is not None
+        self.calibration = calibration
+        self.references = {}
+
         proj_phases = len(test.projector.phases)
 
         if proj_phases < self.steps: 
             raise Exception(f"You need {steps} phases to run a {steps}-step experiment ({proj_phases} provided)")
 
+    @traced('experiment.run')
     def run(self):
         # Run the experiment n times for both reference and measurement images
         
-        # Run pre-reference image callbacks
-        for cb in self._pre_cbs: cb()
-        
-        ref_imgs = []
-        for _ in range(self.steps):
-            ref_imgs.append(self.test.run())
-            self.test.next()
+        if self.has_references():
+            self.logger.info('Using cached reference phases, skipping the reference capture')
+            ref_imgs = None
+        else:
+            # Run pre-reference image callbacks
+            for cb in self._pre_cbs: cb()
+
+            ref_imgs = self.__capture_sets()
             
         # Run post-ref callbacks
         for cb in self._post_cbs: cb()
         
-        imgs = []
-        for _ in range(self.steps):
-            imgs.append(self.test.run())
-            self.test.next()
+        imgs = self.__capture_sets()
         
         self.logger.info(f'Measurement completed')
         
-        ref_imgs = np.transpose(ref_imgs, (1, 0, 2, 3, 4))
-        imgs = np.transpose(imgs, (1, 0, 2, 3, 4))
-        
         return ref_imgs, imgs
 
-    def classic_ph(self, ref_imgs, imgs, sf, cam_plane_dists, cam_proj_dists):
+    def reference_setup(self, i):
+        ''' Key of the settings that shape camera i's reference phase; a cached one is only used while it matches. '''
+        camera, projector = self.test.cameras[i], self.test.projector
+        frequencies = [projector.frequency] if self.frequencies is None else list(self.frequencies)
+
+        setup = (camera.name, tuple(camera.resolution), projector.name, frequencies, projector.orientation, list(projector.phases), self.steps)
+
+        return hashlib.blake2b(repr(setup).encode(), digest_size=20).hexdigest()
+
+    def has_references(self):
+        ''' Whether every camera has a cached reference phase for the current setup, loading them from
+            the calibration service when not yet in memory.
+        '''
+        if not self.cache_references: return False
+
+        for i in range(len(self.test.cameras)):
+            setup = self.reference_setup(i)
+            ref = self.references.get(i)
+
+            if ref is not None and ref.setup == setup: continue
+
+            ref = None if self.calibration is None else self.calibration.load_reference(setup)
+            if ref is None: return False
+
+            self.references[i] = ref
+
+        return True
+
+    def __cache_references(self, ref_imgs, unwrapper):
+        # The reference phase does not depend on the camera's distances
+        ph = ClassicPhaseHeight(1.0, 1.0, 1.0, unwrapper)
+
+        for i, stack in enumerate(ref_imgs):
+            ref = ph.reference_phase(stack, convert_grey=True)
+            ref = ReferencePhase(ref.key, ref.phase, ref.convert_grey, ref.crop, self.reference_setup(i))
+
+            if self.calibration is not None: self.calibration.save_reference(ref, key=ref.setup)
+
+            self.references[i] = ref
+
+        return [self.references[i] for i in range(len(ref_imgs))]
+
+    def __capture_steps(self):
+        imgs = []
+        for _ in range(self.steps):
+            imgs.append(self.test.run())
+            self.test.next()
+
+        # (cameras, steps, h, w, c)
+        return np.transpose(imgs, (1, 0, 2, 3, 4))
+
+    def __capture_sets(self):
+        if self.frequencies is None:
+            return self.__capture_steps()
+
+        # One n-step set per fringe frequency: (cameras, frequencies, steps, h, w, c)
+        sets = []
+        for freq in self.frequencies:
+            self.test.projector.set_frequency(freq)
+            sets.append(self.__capture_steps())
+
+        return np.stack(sets, axis=1)
+
+    def classic_ph(self, ref_imgs, imgs, sf, cam_plane_dists, cam_proj_dists, backend='serial', workers=None):
+        ''' Heightmap for every camera, in camera order.
+
+            backend is 'serial', 'thread' or 'process'. The process backend hands the image stacks to
+            workers through shared memory rather than pickling them. Per-camera reconstruction times
+            (seconds) are stored in self.timings. ref_imgs is None when run skipped the reference
+            capture, in which case the cached reference phases are used.
+        '''
+        imgs = self.__as_stack(imgs)
+
         cameras = imgs.shape[0]
         
         if len(cam_plane_dists) != cameras:
@@ -248,16 +500,89 @@ class NStepFPExperiment(FPExperiment):
         if len(cam_proj_dists) != cameras:
             raise Exception("You must provide a distance for all cameras to the projector")
             return None
+
+        if backend not in ('serial', 'thread', 'process'):
+            raise Exception(f"Unknown execution backend '{backend}' (serial, thread or process)")
+
+        unwrapper = None if self.frequencies is None else TemporalUnwrapper(self.frequencies, self.test.projector.orientation)
+
+        if ref_imgs is None:
+            if not self.has_references():
+                raise Exception("No reference images were given and there are no cached reference phases")
+
+            refs = [self.references[i] for i in range(cameras)]
+        else:
+            ref_imgs = self.__as_stack(ref_imgs)
+            refs = self.__cache_references(ref_imgs, unwrapper) if self.cache_references else None
+
+        if refs is not None:
+            ref_imgs = refs if backend != 'process' else np.stack([ref.phase for ref in refs])
+
+        heightmaps = np.empty((cameras, *imgs.shape[-3:-1]), dtype=get_precision())
+        params = [(sf, cam_plane_dists[i], cam_proj_dists[i], unwrapper) for i in range(cameras)]
+
+        if backend == 'serial':
+            self.timings = [_classic_ph_camera(ref_imgs[i], imgs[i], heightmaps[i], *params[i]) for i in range(cameras)]
+
+        elif backend == 'thread':
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_classic_ph_camera, ref_imgs[i], imgs[i], heightmaps[i], *params[i]) for i in range(cameras)]
+                self.timings = [f.result() for f in futures]
+
+        else:
+            blocks = [SharedMemory(create=True, size=max(1, x.nbytes)) for x in (ref_imgs, imgs, heightmaps)]
+
+            try:
+                specs = []
+                for block, x in zip(blocks, (ref_imgs, imgs, heightmaps)):
+                    np.ndarray(x.shape, dtype=x.dtype, buffer=block.buf)[:] = x
+                    specs.append((block.name, x.shape, x.dtype.str))
+
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    futures = [pool.submit(_classic_ph_shared, specs, i, refs is not None, get_precision().name, *params[i]) for i in range(cameras)]
+                    self.timings = [f.result() for f in futures]
+
+                heightmaps[:] = np.ndarray(heightmaps.shape, dtype=heightmaps.dtype, buffer=blocks[2].buf)
+            finally:
+                for block in blocks:
+                    block.close()
+                    block.unlink()
+
+        for i, t in enumerate(self.timings):
+            self.logger.debug(f'Camera {i} heightmap took {t:.3f}s ({backend})')
         
-        heightmaps = []
-        
-        for i in range(cameras):
-            ph = ClassicPhaseHeight(sf, cam_plane_dists[i], cam_proj_dists[i])
-            heightmap = ph.heightmap(ref_imgs[i], imgs[i], convert_grey=True, crop=None)
-            
-            heightmaps.append(heightmap)
-        
-        return heightmaps
+        return list(heightmaps)
+
+    def heightmap_stages(self, sf, cam_plane_dists, cam_proj_dists):
+        ''' Wrapped phase, unwrap and height stages for pipelined_stream, one heightmap per camera. '''
+        unwrapper = None if self.frequencies is None else TemporalUnwrapper(self.frequencies, self.test.projector.orientation)
+
+        phs = [ClassicPhaseHeight(sf, d, l, unwrapper) for d, l in zip(cam_plane_dists, cam_proj_dists)]
+
+        def wrapped(measurement):
+            ref_imgs, imgs = measurement
+
+            # Cached reference phases (ref_imgs is None) are already unwrapped
+            if ref_imgs is None:
+                if not self.has_references(): raise Exception("No reference images were captured and there are no cached reference phases")
+                refs = [self.references[i] for i in range(len(phs))]
+            else:
+                refs = [ph.wrapped_phasemap(rgb2grey(ref_imgs[i])) for i, ph in enumerate(phs)]
+
+            return [(refs[i], ph.wrapped_phasemap(rgb2grey(imgs[i]))) for i, ph in enumerate(phs)]
+
+        def unwrap(phases):
+            return [(ref.phase if isinstance(ref, ReferencePhase) else ph.unwrapper(ref), ph.unwrapper(measured)) for ph, (ref, measured) in zip(phs, phases)]
+
+        def height(phases):
+            return [ph.from_phase(ref, measured) for ph, (ref, measured) in zip(phs, phases)]
+
+        return [('wrapped_phase', wrapped), ('unwrap', unwrap), ('height', height)]
+
+    def __as_stack(self, x):
+        # Results loaded from disk come back as object arrays of images
+        x = np.asarray(x)
+        return np.array(x.tolist()) if x.dtype == object else x
 
     def add_pre_ref_callback(self, cb):
         self._pre_cbs.append(cb)
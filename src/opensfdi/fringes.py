@@ -1,55 +1,139 @@
-import cv2
+import os
+import threading
 
 import numpy as np
 
+from collections import OrderedDict
+
+from opensfdi import definitions
+from opensfdi.io.std import replacing
+from opensfdi.utils.precision import get_precision
+
 class FringeFactory:
+    ''' Fringe pattern sets of shape (phase_count, height, width), or (..., 3) for RGB.
+
+        Pattern sets are generated in one broadcast expression and kept in an LRU cache keyed by
+        (kind, frequency, phase_count, orientation, resolution, dtype), so the returned arrays are
+        read-only (copy them before modifying). The cache holds at most CACHE_BYTES of generated
+        sets (a 12-step 1920x1080 float32 set is ~95 MiB); larger sets are returned uncached and
+        0 disables caching. With persist=True a set is also stored as a .npy file in FRINGES_DIR and
+        memory-mapped from there on later runs; mapped sets are cached without counting against the
+        limit. dtype defaults to the compute precision; integer dtypes are scaled to their full range.
+    '''
+    CACHE_BYTES = 256 * 2 ** 20
+
+
     @staticmethod
-    def MakeBinary(frequency, phase_count, orientation, width=1024, height=1024):
+    def MakeBinary(frequency, phase_count, orientation, width=1024, height=1024, dtype=None, persist=False):
         # Maybe not a good idea to rely upon sinusoidal function but works for now :)
-        imgs = FringeFactory.MakeSinusoidal(frequency, phase_count, orientation, width, height)
+        return _patterns('binary', frequency, phase_count, orientation, width, height, np.dtype(get_precision() if dtype is None else dtype).str, persist)
 
-        width, height, _ = imgs[0].shape
+    @staticmethod
+    def MakeBinaryRGB(frequency, phase_count, orientation, width=1024, height=1024, dtype=None, persist=False):
+        imgs = FringeFactory.MakeBinary(frequency, phase_count, orientation, width, height, dtype, persist)
         
-        for i in range(phase_count):
-            for col in range(width):
-                for row in range(height):
-                    imgs[i][col][row] = 0.0 if imgs[i][col][row] < 0.5 else 1.0
+        return FringeFactory.GrayToRGB(imgs)
 
-        return imgs
+    @staticmethod
+    def MakeSinusoidal(frequency, phase_count, orientation, width=1024, height=1024, dtype=None, persist=False):
+        return _patterns('sinusoidal', frequency, phase_count, orientation, width, height, np.dtype(get_precision() if dtype is None else dtype).str, persist)
 
     @staticmethod
-    def MakeBinaryRGB(frequency, phase_count, orientation, width=1024, height=1024):
-        imgs = FringeFactory.MakeBinary(frequency, phase_count, orientation, width, height)
+    def MakeSinusoidalRGB(frequency, phase_count, orientation, width=1024, height=1024, dtype=None, persist=False):
+        imgs = FringeFactory.MakeSinusoidal(frequency, phase_count, orientation, width, height, dtype, persist)
         
         return FringeFactory.GrayToRGB(imgs)
 
     @staticmethod
-    def MakeSinusoidal(frequency, phase_count, orientation, width=1024, height=1024):
-        imgs = np.empty((phase_count, height, width), dtype=np.float32)
-        
-        for i in range(phase_count):
-            x, y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    def GrayToRGB(imgs, view=True):
+        # A read-only broadcast view shares memory with the grey images; pass view=False for a writable copy
+        rgb_imgs = np.broadcast_to(imgs[..., None], (*imgs.shape, 3))
 
-            gradient = np.sin(orientation) * x - np.cos(orientation) * y
-
-            imgs[i] = np.sin(((2.0 * np.pi * gradient) / frequency) + i)
-            
-            imgs[i] = cv2.normalize(imgs[i], None, 0.0, 1.0, cv2.NORM_MINMAX, cv2.CV_32F)
-        
-        return imgs
+        return rgb_imgs if view else rgb_imgs.copy()
 
     @staticmethod
-    def MakeSinusoidalRGB(frequency, phase_count, orientation, width=1024, height=1024):
-        imgs = FringeFactory.MakeSinusoidal(frequency, phase_count, orientation, width, height)
-        
-        return FringeFactory.GrayToRGB(imgs)
+    def clear_cache():
+        with _cache_lock:
+            _cache.clear()
 
-    @staticmethod
-    def GrayToRGB(imgs):
-        a, b, c = imgs.shape
-        rgb_imgs = np.empty(shape=(a, b, c, 3), dtype=imgs[0].dtype)
-        
-        for i, img in enumerate(imgs):
-            rgb_imgs[i] = cv2.merge((img, img, img))
+def _sinusoidal(frequency, phase_count, orientation, width, height):
+    x = np.arange(width, dtype=np.float32)[None, :]
+    y = np.arange(height, dtype=np.float32)[:, None]
+
+    gradient = np.float32(np.sin(orientation)) * x - np.float32(np.cos(orientation)) * y
+
+    # Shifted by 2πi/N and zero phase at the origin, so the patterns demodulate to 2π * gradient / frequency.
+    # Scaled analytically to [0, 1] (min-max normalising each image skews partial periods)
+    shifts = ((2.0 * np.pi * np.arange(phase_count)) / phase_count).astype(np.float32)[:, None, None]
+
+    imgs = np.cos(np.float32(2.0 * np.pi / frequency) * gradient + shifts)
+    imgs *= 0.5
+    imgs += 0.5
+
+    return imgs
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _cached_bytes(imgs):
+    # Memory-mapped sets are backed by their file rather than the heap
+    return 0 if isinstance(imgs, np.memmap) else imgs.nbytes
+
+def _patterns(*key):
+    with _cache_lock:
+        imgs = _cache.get(key)
+        if imgs is not None:
+            _cache.move_to_end(key)
+            return imgs
+
+    imgs = _make_patterns(*key)
+
+    limit = FringeFactory.CACHE_BYTES
+    if limit <= 0 or limit < _cached_bytes(imgs): return imgs
+
+    with _cache_lock:
+        _cache[key] = imgs
+        _cache.move_to_end(key)
+
+        total = sum(_cached_bytes(x) for x in _cache.values())
+        while limit < total:
+            _, evicted = _cache.popitem(last=False)
+            total -= _cached_bytes(evicted)
+
+    return imgs
+
+def _make_patterns(kind, frequency, phase_count, orientation, width, height, dtype, persist):
+    dtype = np.dtype(dtype)
+
+    path = None
+    if persist:
+        name = f'{kind}_f{frequency}_n{phase_count}_o{orientation:.6f}_{width}x{height}_{dtype.str[1:]}.npy'
+        path = os.path.join(definitions.FRINGES_DIR, name)
+
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+
+    imgs = _sinusoidal(frequency, phase_count, orientation, width, height)
+
+    if kind == 'binary':
+        imgs = (0.5 <= imgs)
+
+    if np.issubdtype(dtype, np.integer):
+        imgs = np.rint(imgs * np.iinfo(dtype).max).astype(dtype)
+    else:
+        imgs = imgs.astype(dtype, copy=False)
+
+    if path is not None:
+        definitions.ensure_dir(definitions.FRINGES_DIR)
+
+        with replacing(path) as tmp:
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=imgs.shape)
+            out[:] = imgs
+            out.flush()
+            del out
+
+        return np.load(path, mmap_mode='r')
+
+    imgs.flags.writeable = False
 
-        return rgb_imgs
\ No newline at end of file
+    return imgs
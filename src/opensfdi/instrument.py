@@ -0,0 +1,263 @@
+import os
+import json
+import threading
+import functools
+import tracemalloc
+
+from collections import deque
+from time import perf_counter, thread_time
+
+from opensfdi.io.std import replacing
+
+# Instrumentation is off by default: span() then returns a shared no-op span and traced functions
+# call straight through, so the cost is one global lookup per call
+ENABLED = False
+
+_memory = False
+_started_tracemalloc = False
+
+_lock = threading.Lock()
+_local = threading.local()
+
+_epoch = perf_counter()
+_records = deque(maxlen=100000)
+_totals = {}
+
+class Span:
+    ''' One timed region. Frames and pixels processed can be added while it is open. '''
+    __slots__ = ('name', 'attrs', 'frames', 'pixels', 'parent', 'depth', 'thread', 'start', 'wall', 'cpu',
+                 'alloc_bytes', 'peak_bytes', '_cpu0', '_mem0', '_peak')
+
+    def __init__(self, name, frames=0, pixels=0, attrs=None):
+        self.name = name
+        self.attrs = attrs or {}
+        self.frames = frames
+        self.pixels = pixels
+
+        self.wall = self.cpu = 0.0
+        self.alloc_bytes = self.peak_bytes = 0
+
+    def add(self, frames=0, pixels=0):
+        self.frames += frames
+        self.pixels += pixels
+
+    def __enter__(self):
+        stack = _stack()
+
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        self.thread = threading.get_ident()
+
+        if _memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+
+            # Fold the peak seen so far into the enclosing span before restarting peak tracking
+            if stack: stack[-1]._peak = max(stack[-1]._peak, peak)
+            tracemalloc.reset_peak()
+
+            self._mem0 = self._peak = current
+        else:
+            self._mem0 = None
+
+        stack.append(self)
+
+        self._cpu0 = thread_time()
+        self.start = perf_counter()
+
+        return self
+
+    def __exit__(self, *args):
+        self.wall = perf_counter() - self.start
+        self.cpu = thread_time() - self._cpu0
+
+        stack = _stack()
+        stack.pop()
+
+        if self._mem0 is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(self._peak, peak)
+
+            self.alloc_bytes = current - self._mem0
+            self.peak_bytes = peak - self._mem0
+
+            if stack: stack[-1]._peak = max(stack[-1]._peak, peak)
+
+        _record(self)
+
+        return False
+
+    def as_dict(self):
+        return {
+            "name"          : self.name,
+            "parent"        : self.parent,
+            "depth"         : self.depth,
+            "thread"        : self.thread,
+            "start"         : self.start - _epoch,
+            "wall"          : self.wall,
+            "cpu"           : self.cpu,
+            "alloc_bytes"   : self.alloc_bytes,
+            "peak_bytes"    : self.peak_bytes,
+            "frames"        : self.frames,
+            "pixels"        : self.pixels,
+            **self.attrs
+        }
+
+class _NullSpan:
+    ''' Stand-in returned while instrumentation is disabled. '''
+    def add(self, frames=0, pixels=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def enable(memory=False, max_records=100000):
+    ''' Start recording spans. memory=True also records bytes allocated (via tracemalloc, which
+        slows allocation-heavy code noticeably). At most max_records spans are kept; totals cover all.
+    '''
+    global ENABLED, _memory, _started_tracemalloc, _records
+
+    with _lock:
+        if _records.maxlen != max_records: _records = deque(_records, maxlen=max_records)
+
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+
+    _memory = memory
+    ENABLED = True
+
+def disable():
+    global ENABLED, _memory, _started_tracemalloc
+
+    ENABLED = False
+    _memory = False
+
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+def reset():
+    ''' Forget all recorded spans and totals. '''
+    global _epoch
+
+    with _lock:
+        _records.clear()
+        _totals.clear()
+
+    _epoch = perf_counter()
+
+def span(name, frames=0, pixels=0, **attrs):
+    ''' Context manager timing a region: with span('unwrap', pixels=phase.size) as s: ... '''
+    if not ENABLED: return _NULL_SPAN
+
+    return Span(name, frames, pixels, attrs)
+
+def traced(name, frames=None, pixels=None):
+    ''' Decorator wrapping each call in a span. frames and pixels are optional callables taking
+        the call's arguments and returning the counts to record.
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED: return func(*args, **kwargs)
+
+            with Span(name) as s:
+                if frames is not None: s.frames = frames(*args, **kwargs)
+                if pixels is not None: s.pixels = pixels(*args, **kwargs)
+
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+def records():
+    ''' Recorded spans as dicts, oldest first. '''
+    with _lock:
+        return [s.as_dict() for s in _records]
+
+def totals():
+    ''' Per span name: count, wall, cpu, alloc_bytes, frames and pixels summed over every span recorded. '''
+    with _lock:
+        return {name: dict(t) for name, t in _totals.items()}
+
+def write_log(path):
+    ''' Structured log: one JSON object per span per line. '''
+    with open(path, 'w') as outfile:
+        for record in records():
+            outfile.write(json.dumps(record) + '\n')
+
+def write_prometheus(path, prefix='opensfdi'):
+    ''' Totals in the Prometheus text format (e.g. for the node exporter textfile collector).
+        Written to a temporary file and renamed (see io.std.replacing) so scrapers never read a partial file.
+    '''
+    metrics = [
+        ('spans_total',             'count',        'counter', 'Number of completed spans'),
+        ('span_seconds_total',      'wall',         'counter', 'Wall time spent in spans'),
+        ('span_cpu_seconds_total',  'cpu',          'counter', 'CPU time spent in spans (by the calling thread)'),
+        ('span_alloc_bytes_total',  'alloc_bytes',  'counter', 'Net bytes allocated in spans (with memory tracking)'),
+        ('span_frames_total',       'frames',       'counter', 'Frames processed in spans'),
+        ('span_pixels_total',       'pixels',       'counter', 'Pixels processed in spans'),
+    ]
+
+    data = totals()
+
+    lines = []
+    for metric, key, kind, help in metrics:
+        lines.append(f'# HELP {prefix}_{metric} {help}')
+        lines.append(f'# TYPE {prefix}_{metric} {kind}')
+
+        for name, t in sorted(data.items()):
+            lines.append(f'{prefix}_{metric}{{span="{name}"}} {t[key]}')
+
+    with replacing(path) as tmp, open(tmp, 'w') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+
+def write_chrome_trace(path):
+    ''' Spans as complete ("X") events for chrome://tracing or Perfetto. '''
+    pid = os.getpid()
+
+    events = []
+    for r in records():
+        args = {k: v for k, v in r.items() if k not in ('name', 'start', 'wall', 'thread')}
+
+        events.append({
+            "name"  : r["name"],
+            "ph"    : "X",
+            "ts"    : r["start"] * 1e6,
+            "dur"   : r["wall"] * 1e6,
+            "pid"   : pid,
+            "tid"   : r["thread"],
+            "args"  : args
+        })
+
+    with open(path, 'w') as outfile:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, outfile)
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+
+    if stack is None:
+        stack = _local.stack = []
+
+    return stack
+
+def _record(s):
+    with _lock:
+        _records.append(s)
+
+        t = _totals.get(s.name)
+        if t is None:
+            t = _totals[s.name] = {"count": 0, "wall": 0.0, "cpu": 0.0, "alloc_bytes": 0, "frames": 0, "pixels": 0}
+
+        t["count"] += 1
+        t["wall"] += s.wall
+        t["cpu"] += s.cpu
+        t["alloc_bytes"] += s.alloc_bytes
+        t["frames"] += s.frames
+        t["pixels"] += s.pixels
@@ -1,8 +1,18 @@
 import cv2
 import os
+import json
+import zlib
 import pickle
+import struct
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # Windows: commits are not serialised between processes
+    fcntl = None
 
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 class Repo(ABC):
     @abstractmethod
@@ -18,6 +28,10 @@ class ImageRepo(Repo):
     def load_image(self, name):
         raise NotImplementedError
 
+    def load_images(self, names):
+        ''' Load several images, returned in the same order as names. '''
+        return [self.load_image(name) for name in names]
+
 class ResultRepo(Repo):
     @abstractmethod
     def add_fringe(self, imgs, name):
@@ -76,44 +90,252 @@ class CalibrationRepo(Repo):
     def load_proj(self, proj_name):
         raise NotImplementedError
 
+    def add_reference(self, key, data):
+        raise NotImplementedError
+
+    def load_reference(self, key):
+        ''' Serialized reference phase stored under key, or None. '''
+        raise NotImplementedError
+
 ### CONCRETE IMPLEMENTATIONS ###
 
 class BinRepo(Repo):
-    def __init__(self, file):
+    ''' Append-only record store of pickled values, keyed by the top-level keys of the dicts added.
+
+        Each commit appends one record per key followed by a commit marker, so a crash mid-write
+        leaves the previous commit intact (the torn tail is ignored and overwritten by the next
+        commit). An offset index built from the record headers lets load_key unpickle just one value.
+        Once superseded records make the file compact_ratio times larger than its live data, it is
+        rewritten with only the latest records. Files written by the old whole-pickle format are
+        still read, and converted on their next commit.
+
+        Commits hold an exclusive lock on a .lock file beside the store and first pick up records
+        committed by other instances (or processes), so they append after them rather than over them.
+    '''
+    MAGIC = b'OPENSFDI-REC1\n'
+
+    # Record kind, pickled key length, pickled value length
+    _HEADER = struct.Struct('<BIQ')
+    _DATA, _COMMIT = 0, 1
+
+    def __init__(self, file, compact_ratio=2.0, compact_min_bytes=1 << 20):
         self._file = file
-        
-        self._outdated = True
-        self._load_cache = None
+
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+
+        self._index = None      # key -> (value offset, value length, record length)
+        self._legacy = None     # dict read from an old whole-pickle file
+        self._end = 0           # end of the last committed record
+        self._inode = None      # file the index was built from (compaction replaces it)
+        self._cache = dict()
 
         self._changes = []
 
     def add_bin(self, data):
         self._changes.append(data)
 
+    def keys(self):
+        if self._index is None and not os.path.exists(self._file): return []
+
+        self.__load_index()
+
+        return list(self._legacy.keys()) if self._legacy is not None else list(self._index.keys())
+
+    def load_key(self, key):
+        # Offsets index the file they were read from: re-index if it was since replaced
+        if self._index is not None and self._inode != self.__stat()[0]: self.__reset()
+
+        self.__load_index()
+
+        if self._legacy is not None: return self._legacy[key]
+
+        if key not in self._cache:
+            offset, length, _ = self._index[key]
+
+            with open(self._file, 'rb') as infile:
+                infile.seek(offset)
+                self._cache[key] = pickle.loads(infile.read(length))
+
+        return self._cache[key]
+
     def load_bin(self):
-        if self._outdated:
-            with open(os.path.join(self._file), 'rb') as infile:
-                self._load_cache = pickle.load(infile)
-                
-            self._outdated = False
-            
-        return self._load_cache
+        return {key: self.load_key(key) for key in self.keys()}
 
     def commit(self):
+        if not self._changes: return
+
         out = {}
         for d in self._changes:
             out = out | d
-        
-        with open(os.path.join(self._file), 'wb') as outfile:
-            pickle.dump(out, outfile, protocol=pickle.HIGHEST_PROTOCOL)
 
-        self._outdated = True
+        self._changes = []
+
+        records = [(pickle.dumps(k, protocol=pickle.HIGHEST_PROTOCOL), pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)) for k, v in out.items()]
+
+        with self.__lock():
+            self.__commit(out, records)
+
+    def __commit(self, out, records):
+        # Another instance may have appended to (or compacted) the file since it was indexed here
+        if self._index is not None and (self._inode, self._end) != self.__stat():
+            self.__reset()
+
+        if not os.path.exists(self._file):
+            self._index, self._legacy, self._end = dict(), None, 0
+        else: self.__load_index()
+
+        if self._legacy is not None:
+            # Migrate the old pickle file to records in one atomic rewrite
+            legacy = [(pickle.dumps(k, protocol=pickle.HIGHEST_PROTOCOL), pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)) for k, v in self._legacy.items() if k not in out]
+            self.__rewrite(legacy + records)
+            return
+
+        mode = 'r+b' if os.path.exists(self._file) else 'wb'
+        with open(self._file, mode) as outfile:
+            if self._end == 0:
+                outfile.write(BinRepo.MAGIC)
+                self._end = len(BinRepo.MAGIC)
+
+            # Drop any uncommitted tail left by an interrupted write
+            outfile.seek(self._end)
+            outfile.truncate()
+
+            entries = self.__write_records(outfile, records)
+
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+            self._end = outfile.tell()
+
+        self._index.update(entries)
+        self._inode = self.__stat()[0]
+        for key in entries: self._cache.pop(key, None)
+
+        live = len(BinRepo.MAGIC) + sum(rec for _, _, rec in self._index.values())
+        if self.compact_min_bytes <= self._end and self.compact_ratio * live < self._end:
+            self.__compact()
+
+    def compact(self):
+        ''' Rewrite the file with only the latest record for each key. '''
+        with self.__lock():
+            if self._index is not None and (self._inode, self._end) != self.__stat():
+                self.__reset()
+
+            self.__compact()
+
+    def __compact(self):
+        self.__load_index()
+
+        if self._legacy is not None: return
+
+        records = []
+        with open(self._file, 'rb') as infile:
+            for key, (offset, length, _) in self._index.items():
+                infile.seek(offset)
+                records.append((pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL), infile.read(length)))
+
+        self.__rewrite(records)
+
+    def __rewrite(self, records):
+        # Write a complete new file next to the old one and swap it in
+        tmp = self._file + '.tmp'
+        with open(tmp, 'wb') as outfile:
+            outfile.write(BinRepo.MAGIC)
+            entries = self.__write_records(outfile, records)
+
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+            end = outfile.tell()
+
+        os.replace(tmp, self._file)
+
+        self._index, self._legacy, self._end = entries, None, end
+        self._inode = self.__stat()[0]
+        self._cache = dict()
+
+    def __lock(self):
+        # Closing the returned file releases the lock
+        handle = open(self._file + '.lock', 'a+b')
+
+        if fcntl is not None: fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+
+        return handle
+
+    def __stat(self):
+        try:
+            st = os.stat(self._file)
+        except FileNotFoundError:
+            return None, 0
+
+        return st.st_ino, st.st_size
+
+    def __reset(self):
+        self._index, self._legacy, self._end, self._inode = None, None, 0, None
+        self._cache = dict()
+
+    def __write_records(self, outfile, records):
+        entries = dict()
+        for key_bytes, value_bytes in records:
+            start = outfile.tell()
+            outfile.write(BinRepo._HEADER.pack(BinRepo._DATA, len(key_bytes), len(value_bytes)))
+            outfile.write(key_bytes)
+            outfile.write(value_bytes)
+
+            entries[pickle.loads(key_bytes)] = (start + BinRepo._HEADER.size + len(key_bytes), len(value_bytes), outfile.tell() - start)
+
+        outfile.write(BinRepo._HEADER.pack(BinRepo._COMMIT, 0, 0))
+
+        return entries
+
+    def __load_index(self):
+        if self._index is not None: return
+
+        index, pending = dict(), dict()
+        self._inode, size = self.__stat()
+
+        with open(self._file, 'rb') as infile:
+            if infile.read(len(BinRepo.MAGIC)) != BinRepo.MAGIC:
+                infile.seek(0)
+                self._legacy = pickle.load(infile)
+                self._index, self._end = dict(), 0
+                return
+
+            end = pos = infile.tell()
+            while pos + BinRepo._HEADER.size <= size:
+                kind, key_len, value_len = BinRepo._HEADER.unpack(infile.read(BinRepo._HEADER.size))
+                record_end = pos + BinRepo._HEADER.size + key_len + value_len
+
+                if kind == BinRepo._COMMIT:
+                    index.update(pending)
+                    pending = dict()
+                    end = pos = record_end
+                    continue
+
+                if kind != BinRepo._DATA or size < record_end: break
+
+                key = pickle.loads(infile.read(key_len))
+                pending[key] = (record_end - value_len, value_len, record_end - pos)
+
+                infile.seek(value_len, 1)
+                pos = record_end
+
+        self._index, self._legacy, self._end = index, None, end
 
 class FileImageRepo(ImageRepo):
-    def __init__(self, path):
+    ''' Images stored as individual files, encoded and decoded by OpenCV.
+
+        OpenCV releases the GIL while encoding/decoding, so commit and load_images spread the work
+        over a pool of threads. workers=None lets the pool pick its default size, and workers=1
+        runs serially.
+    '''
+    def __init__(self, path, workers=None):
         self._path = path
         self._changes = {}
 
+        self.workers = workers
+
     def add_image(self, img, name):
         self._changes[name] = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
 
@@ -121,13 +343,191 @@ class FileImageRepo(ImageRepo):
         # BGR Format
         return cv2.imread(os.path.join(self._path, name), cv2.IMREAD_COLOR)
 
+    def load_images(self, names):
+        return self.__map(self.load_image, list(names))
+
     def commit(self):
         # Write all images
-        for name, img in self._changes.items():
-            cv2.imwrite(os.path.join(self._path, name), img)
+        written = self.__map(self.__write, list(self._changes.items()))
+
+        failed = [name for (name, _), ok in zip(self._changes.items(), written) if not ok]
+        if failed: raise Exception(f"Could not write images {failed}")
 
         self._changes = dict()
 
+    def __write(self, item):
+        name, img = item
+        return cv2.imwrite(os.path.join(self._path, name), img)
+
+    def __map(self, func, items):
+        # Results keep the order of items
+        if self.workers == 1 or len(items) < 2:
+            return [func(x) for x in items]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(func, items))
+
+class ChunkedArrayRepo(ImageRepo, ResultRepo):
+    ''' Lossless store for image stacks, heightmaps and fringes in their native dtype.
+
+        Each array is one binary file split into per-frame chunks (the trailing H x W [x C] image),
+        described by a small JSON index. Uncompressed arrays load as read-only memory maps, and
+        load_frame reads a single camera/phase without touching the rest of the stack. With
+        compression='zlib' every frame is compressed on its own, so single frames stay cheap to read.
+    '''
+    INDEX = 'index.json'
+
+    def __init__(self, path, compression=None, level=1):
+        if compression not in (None, 'zlib'):
+            raise Exception(f"Unsupported compression '{compression}' (None or 'zlib')")
+
+        self._path = path
+        self._compression = compression
+        self._level = level
+
+        self._changes = {}
+        self._index = None
+
+    # ImageRepo / ResultRepo
+
+    def add_image(self, imgs, name, frame_ndim=None):
+        self._changes[name] = (np.asarray(imgs), frame_ndim)
+
+    def add_fringe(self, imgs, name):
+        self.add_image(imgs, f'fringes/{name}')
+
+    def add_ref_image(self, imgs, name):
+        self.add_image(imgs, f'ref/{name}')
+
+    def add_heightmap(self, heightmap, name):
+        self.add_image(heightmap, f'heightmaps/{name}', frame_ndim=2)
+
+    def load_image(self, name):
+        entry = self.__entry(name)
+        shape, dtype = tuple(entry["shape"]), np.dtype(entry["dtype"])
+
+        if entry["compression"] is None:
+            return np.memmap(os.path.join(self._path, entry["file"]), dtype=dtype, mode='r', shape=shape)
+
+        frames = [self.__read_chunk(entry, i) for i in range(len(entry["offsets"]))]
+
+        return np.stack(frames).reshape(shape)
+
+    def load_fringe(self, name):
+        return self.load_image(f'fringes/{name}')
+
+    def load_ref_image(self, name):
+        return self.load_image(f'ref/{name}')
+
+    def load_heightmap(self, name):
+        return self.load_image(f'heightmaps/{name}')
+
+    def load_frame(self, name, index, kind=None):
+        ''' A single frame, e.g. load_frame('imgs', (camera, phase)). kind is 'fringes', 'ref' or
+            'heightmaps' for arrays added with add_fringe, add_ref_image or add_heightmap.
+        '''
+        if kind is not None:
+            if kind not in ('fringes', 'ref', 'heightmaps'):
+                raise Exception(f"Unknown array kind '{kind}' (fringes, ref or heightmaps)")
+
+            name = f'{kind}/{name}'
+
+        entry = self.__entry(name)
+
+        lead = tuple(entry["shape"][:len(entry["shape"]) - entry["frame_ndim"]])
+        i = int(np.ravel_multi_index(index, lead)) if lead else 0
+
+        if entry["compression"] is None:
+            return self.load_image(name).reshape(-1, *entry["shape"][len(lead):])[i]
+
+        return self.__read_chunk(entry, i)
+
+    def names(self):
+        return list(self.__load_index().keys())
+
+    def commit(self):
+        os.makedirs(self._path, exist_ok=True)
+
+        index = dict(self.__load_index())
+
+        for name, (arr, frame_ndim) in self._changes.items():
+            if frame_ndim is None:
+                # Colour frames keep their channel axis with the image
+                frame_ndim = 3 if (3 <= arr.ndim and arr.shape[-1] in (1, 3, 4)) else min(2, arr.ndim)
+
+            filename = name.replace('/', '__') + '.bin'
+
+            arr = np.ascontiguousarray(arr)
+            frames = arr.reshape(-1, *arr.shape[arr.ndim - frame_ndim:])
+
+            # Written beside the old file and renamed over it: memory maps handed out by load_image
+            # keep the old file's contents instead of being truncated (SIGBUS) or changed under them
+            path = os.path.join(self._path, filename)
+            tmp = path + '.tmp'
+
+            offsets, lengths = [], []
+            with open(tmp, 'wb') as outfile:
+                for frame in frames:
+                    chunk = frame.tobytes() if self._compression is None else zlib.compress(frame.tobytes(), self._level)
+
+                    offsets.append(outfile.tell())
+                    lengths.append(len(chunk))
+                    outfile.write(chunk)
+
+            os.replace(tmp, path)
+
+            index[name] = {
+                "file"          : filename,
+                "dtype"         : arr.dtype.str,
+                "shape"         : list(arr.shape),
+                "frame_ndim"    : frame_ndim,
+                "compression"   : self._compression,
+                "offsets"       : offsets,
+                "lengths"       : lengths
+            }
+
+        # Replace the index in one step so readers never see a partial one
+        tmp = os.path.join(self._path, ChunkedArrayRepo.INDEX + '.tmp')
+        with open(tmp, 'w') as outfile:
+            json.dump(index, outfile)
+
+        os.replace(tmp, os.path.join(self._path, ChunkedArrayRepo.INDEX))
+
+        self._index = index
+        self._changes = dict()
+
+    def __load_index(self):
+        if self._index is None:
+            path = os.path.join(self._path, ChunkedArrayRepo.INDEX)
+
+            self._index = dict()
+            if os.path.exists(path):
+                with open(path, 'r') as infile:
+                    self._index = json.load(infile)
+
+        return self._index
+
+    def __entry(self, name):
+        index = self.__load_index()
+
+        if name not in index:
+            raise Exception(f"No array named '{name}' in {self._path}")
+
+        return index[name]
+
+    def __read_chunk(self, entry, i):
+        dtype = np.dtype(entry["dtype"])
+        frame_shape = entry["shape"][len(entry["shape"]) - entry["frame_ndim"]:]
+
+        with open(os.path.join(self._path, entry["file"]), 'rb') as infile:
+            infile.seek(entry["offsets"][i])
+            chunk = infile.read(entry["lengths"][i])
+
+        if entry["compression"] == 'zlib':
+            chunk = zlib.decompress(chunk)
+
+        return np.frombuffer(chunk, dtype=dtype).reshape(frame_shape)
+
 class BinCalibrationRepo(CalibrationRepo):
     def __init__(self, file):
         self._repo = BinRepo(file)
@@ -154,21 +554,36 @@ class BinCalibrationRepo(CalibrationRepo):
         self._data[proj_name] = data.serialize()
     
     def load_gamma(self, cam_name):
-        data = self._repo.load_bin()[cam_name]
+        data = self._repo.load_key(cam_name)
         return data["gamma"]
     
     def load_lens(self, cam_name):
-        data = self._repo.load_bin()[cam_name]
+        data = self._repo.load_key(cam_name)
         return data["lens"]
     
     def load_proj(self, proj_name):
         #data = self._repo.load_bin()[proj_name]
         return None
+
+    def add_reference(self, key, data):
+        # Stored as its own record so loading calibrations never reads the phase maps
+        self._data[f'reference:{key}'] = data
+
+    def load_reference(self, key):
+        key = f'reference:{key}'
+
+        if key in self._data: return self._data[key]
+
+        return self._repo.load_key(key) if key in self._repo.keys() else None
     
     def commit(self):
         self._repo.add_bin(self._data)
         
         self._repo.commit()
+
+        # Reference phases are large: write each once rather than again with every later commit
+        for key in [key for key in self._data if key.startswith('reference:')]:
+            del self._data[key]
         
     def __if_ne(self, name):
         if not (name in self._data):
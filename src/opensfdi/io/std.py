@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 
 from contextlib import contextmanager
 
@@ -31,4 +32,29 @@ def stdout_redirected(to=os.devnull):
         try:
             yield
         finally:
-            _redirect_stdout(to=old_stdout)
\ No newline at end of file
+            _redirect_stdout(to=old_stdout)
+
+# Process umask, read once (os.umask can only be read by setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Write a file under a temporary name and rename it into place
+@contextmanager
+def replacing(path):
+    ''' Yields a unique temporary path beside path, renamed over path when the block succeeds and
+        removed when it fails, so readers (and concurrent writers) never see a partial file.
+    '''
+    directory, name = os.path.split(os.path.abspath(path))
+
+    fd, tmp = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=directory)
+    os.close(fd)
+
+    # mkstemp creates the file owner-only; give it the permissions open() would have
+    os.chmod(tmp, 0o666 & ~_UMASK)
+
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
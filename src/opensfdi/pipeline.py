@@ -0,0 +1,198 @@
+import logging
+import queue
+import threading
+
+from time import perf_counter
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+
+        self.count = 0
+        self.dropped = 0
+        self.busy = 0.0
+        self.last_latency = 0.0
+
+        self._start = perf_counter()
+
+    def record(self, latency):
+        self.count += 1
+        self.busy += latency
+        self.last_latency = latency
+
+    @property
+    def mean_latency(self):
+        return self.busy / self.count if self.count else 0.0
+
+    @property
+    def throughput(self):
+        elapsed = perf_counter() - self._start
+        return self.count / elapsed if 0.0 < elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            "count"         : self.count,
+            "dropped"       : self.dropped,
+            "mean_latency"  : self.mean_latency,
+            "last_latency"  : self.last_latency,
+            "throughput"    : self.throughput
+        }
+
+class _Done:
+    pass
+
+class _Failure:
+    def __init__(self, stage, exc):
+        self.stage = stage
+        self.exc = exc
+
+class Pipeline:
+    ''' Runs a source (e.g. Experiment.run) and a chain of processing stages on their own threads.
+
+        Stages are (name, callable) pairs joined by bounded queues of maxsize items. When a queue is
+        full, policy 'block' holds the upstream stage back (backpressure) and 'drop_oldest' discards
+        the oldest queued item so results stay as fresh as possible. Iterate over the pipeline for
+        the final stage's outputs; stop() (or leaving a with block) shuts every stage down.
+    '''
+    POLICIES = ('block', 'drop_oldest')
+
+    def __init__(self, source, stages, maxsize=2, policy='block', name='capture'):
+        if policy not in Pipeline.POLICIES:
+            raise Exception(f"Unknown queue policy '{policy}' ({', '.join(Pipeline.POLICIES)})")
+
+        self.logger = logging.getLogger('opensfdi')
+
+        self.policy = policy
+
+        self._stop = threading.Event()
+
+        names = [name] + [n for n, _ in stages]
+        self._stats = {n: StageStats(n) for n in names}
+
+        self._queues = [queue.Queue(maxsize=maxsize) for _ in names]
+
+        self._threads = [threading.Thread(target=self.__source, args=(name, source, self._queues[0]), name=f'pipeline-{name}', daemon=True)]
+
+        for i, (n, func) in enumerate(stages):
+            t = threading.Thread(target=self.__stage, args=(n, func, self._queues[i], self._queues[i + 1]), name=f'pipeline-{n}', daemon=True)
+            self._threads.append(t)
+
+        for t in self._threads: t.start()
+
+    def __iter__(self):
+        out = self._queues[-1]
+
+        while True:
+            item = out.get()
+
+            if isinstance(item, _Done):
+                return
+
+            if isinstance(item, _Failure):
+                self.stop()
+                raise Exception(f"Pipeline stage '{item.stage}' failed") from item.exc
+
+            yield item
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def stats(self):
+        return {n: s.as_dict() for n, s in self._stats.items()}
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+
+        # Make room so blocked stages can notice the stop and finish
+        for q in self._queues:
+            self.__drain(q)
+
+        for t in self._threads:
+            if t is not threading.current_thread(): t.join(timeout)
+
+        self.logger.info('Finished streaming')
+
+    def __drain(self, q):
+        try:
+            while True: q.get_nowait()
+        except queue.Empty:
+            pass
+
+    def __put(self, q, item, stats):
+        if self.policy == 'drop_oldest':
+            while True:
+                try:
+                    q.put_nowait(item)
+                    return True
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                        stats.dropped += 1
+                    except queue.Empty:
+                        pass
+
+        # Backpressure, but keep checking for shutdown
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def __finish(self, q, item=None):
+        # Control items (end of stream, failures) are never dropped
+        if item is None: item = _Done()
+
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self._stop.is_set(): self.__drain(q)
+
+    def __source(self, name, source, out):
+        stats = self._stats[name]
+
+        try:
+            while not self._stop.is_set():
+                start = perf_counter()
+                item = source()
+                stats.record(perf_counter() - start)
+
+                if not self.__put(out, item, stats): break
+        except Exception as e:
+            self.__finish(out, _Failure(name, e))
+            return
+
+        self.__finish(out)
+
+    def __stage(self, name, func, inq, out):
+        stats = self._stats[name]
+
+        while True:
+            try:
+                item = inq.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set(): break
+                continue
+
+            if isinstance(item, (_Done, _Failure)):
+                self.__finish(out, item)
+                return
+
+            try:
+                start = perf_counter()
+                result = func(item)
+                stats.record(perf_counter() - start)
+            except Exception as e:
+                self.__finish(out, _Failure(name, e))
+                return
+
+            if not self.__put(out, result, stats): break
+
+        self.__finish(out)
@@ -1,14 +1,23 @@
+import logging
+import hashlib
+import functools
 import numpy as np
 
-from matplotlib import pyplot as plt
 from numpy.polynomial import polynomial as P
 
 from abc import ABC
-from stl import mesh
+from collections import OrderedDict
 
-from opensfdi import wrapped_phase, unwrapped_phase, centre_crop_img, rgb2grey
+from opensfdi import unwrapped_phase, rgb2grey
+from opensfdi.instrument import traced
+from opensfdi.utils.maths import demodulate
+from opensfdi.utils.precision import get_precision
+from opensfdi.unwrap.itoh import ItohUnwrapper
+from opensfdi.unwrap.temporal import TemporalUnwrapper
 
 def show_heightmap(heightmap, title='Heightmap'):
+    from matplotlib import pyplot as plt
+
     x, y = np.meshgrid(range(heightmap.shape[0]), range(heightmap.shape[1]))
 
     fig = plt.figure()
@@ -17,42 +26,348 @@ def show_heightmap(heightmap, title='Heightmap'):
     plt.title(title)
     plt.show()
 
+def _callable_key(obj):
+    # Stable description of an unwrapper and its settings, or None when it cannot be told apart
+    # from others with the same name (lambdas, closures, local classes, opaque objects)
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return repr(obj)
+
+    if isinstance(obj, (list, tuple)):
+        items = [_callable_key(x) for x in obj]
+        return None if None in items else f'[{", ".join(items)}]'
+
+    if isinstance(obj, dict):
+        items = [(repr(k), _callable_key(v)) for k, v in sorted(obj.items())]
+        return None if any(v is None for _, v in items) else '{' + ', '.join(f'{k}: {v}' for k, v in items) + '}'
+
+    if isinstance(obj, np.ndarray):
+        return f'array({obj.dtype.str}, {obj.tolist()})'
+
+    if isinstance(obj, np.ufunc):
+        return f'numpy.{obj.__name__}'
+
+    if isinstance(obj, functools.partial):
+        parts = [_callable_key(obj.func), _callable_key(obj.args), _callable_key(obj.keywords)]
+        return None if None in parts else f'partial({", ".join(parts)})'
+
+    qualname = getattr(obj, '__qualname__', None)
+
+    if qualname is not None: # Functions and classes
+        if '<' in qualname: return None
+        return f'{obj.__module__}.{qualname}'
+
+    cls = type(obj)
+    if '<' in cls.__qualname__ or not hasattr(obj, '__dict__'): return None
+
+    state = _callable_key(vars(obj))
+    return None if state is None else f'{cls.__module__}.{cls.__qualname__}{state}'
+
+class ReferencePhase:
+    ''' Unwrapped phase of the reference plane, computed once and reused by later heightmaps.
+
+        key is the content hash of the reference stack and the settings it was processed with
+        (see PhaseHeight.reference_key). setup optionally names the capture setup it belongs to.
+    '''
+    def __init__(self, key, phase, convert_grey=False, crop=None, setup=None):
+        self.key = key
+        self.phase = phase
+        self.convert_grey = convert_grey
+        self.crop = None if crop is None else tuple(crop)
+        self.setup = setup
+
+    def serialize(self):
+        return {
+            "key"           : self.key,
+            "phase"         : self.phase,
+            "convert_grey"  : self.convert_grey,
+            "crop"          : self.crop,
+            "setup"         : self.setup
+        }
+
+    @staticmethod
+    def load(data):
+        return ReferencePhase(data["key"], np.asarray(data["phase"]), data["convert_grey"], data["crop"], data.get("setup"))
+
 class PhaseHeight(ABC):
-    def phasemap(self, imgs):
-        w_phase = wrapped_phase(imgs)
-        
-        return unwrapped_phase(w_phase)
-    
-    def to_stl(self, heightmap):
-        # Create vertices from the heightmap
-        vertices = []
-        for y in range(heightmap.shape[0]):
-            for x in range(heightmap.shape[1]):
-                vertices.append([x, y, heightmap[y, x]])
-
-        vertices = np.array(vertices)
-
-        # Create faces for the mesh
-        faces = []
-        for y in range(heightmap.shape[0] - 1):
-            for x in range(heightmap.shape[1] - 1):
-                v1 = x + y * heightmap.shape[1]
-                v2 = (x + 1) + y * heightmap.shape[1]
-                v3 = x + (y + 1) * heightmap.shape[1]
-                v4 = (x + 1) + (y + 1) * heightmap.shape[1]
-
-                # First triangle
-                faces.append([v1, v2, v3])
-                # Second triangle
-                faces.append([v2, v4, v3])
-
-        # Create the mesh object
-        mesh_data = mesh.Mesh(np.zeros(len(faces), dtype=mesh.Mesh.dtype))
-        for i, f in enumerate(faces):
-            for j in range(3):
-                mesh_data.vectors[i][j] = vertices[f[j]]
-
-        mesh_data.save('heightmap_mesh.stl')
+    # Reference phases computed this session, keyed by reference_key (least recently used dropped first)
+    REFERENCE_CACHE_SIZE = 4
+    _references = OrderedDict()
+
+    def __init__(self, unwrapper=None, workspace=None):
+        self.logger = logging.getLogger('opensfdi')
+
+        # Any callable taking wrapped phase(s), e.g. opensfdi.unwrap.temporal.TemporalUnwrapper
+        # for multi-frequency (F, N, H, W) stacks. Defaults to spatial unwrapping
+        self.unwrapper = unwrapped_phase if unwrapper is None else unwrapper
+
+        # Optional opensfdi.workspace.Workspace: intermediates (and results) are then kept in
+        # buffers reused by every later reconstruction of the same shape
+        self.workspace = workspace
+
+    @traced('phasemap', pixels=lambda self, imgs, *args, **kwargs: np.size(imgs))
+    def phasemap(self, imgs, name='phase'):
+        phase = self.wrapped_phasemap(imgs, name)
+
+        if self.workspace is not None and isinstance(self.unwrapper, ItohUnwrapper):
+            return self.unwrapper(phase, out=phase, workspace=self.workspace)
+
+        return self.unwrapper(phase)
+
+    def wrapped_phasemap(self, imgs, name='phase'):
+        imgs = np.asarray(imgs)
+        ws = self.workspace
+
+        if isinstance(self.unwrapper, TemporalUnwrapper): # (F, N, H, W), one wrapped phase per frequency
+            shape = (imgs.shape[0], *imgs.shape[2:])
+
+            if ws is None:
+                w_phase = np.empty(shape, dtype=get_precision())
+                ac, dc = np.empty_like(w_phase[0]), np.empty_like(w_phase[0])
+            else:
+                w_phase, ac, dc = ws.get(name, shape), ws.get('ac', shape[1:]), ws.get('dc', shape[1:])
+
+            for i, stack in enumerate(imgs):
+                demodulate(stack, out=(w_phase[i], ac, dc), workspace=ws)
+        elif ws is None:
+            w_phase, _, _ = demodulate(imgs)
+        else:
+            shape = imgs.shape[1:]
+            w_phase, _, _ = demodulate(imgs, out=(ws.get(name, shape), ws.get('ac', shape), ws.get('dc', shape)), workspace=ws)
+
+        return w_phase
+
+    def reference_key(self, ref_imgs, convert_grey=False, crop=None, unwrapper_key=None):
+        ''' Hash of the reference stack's contents together with the settings that shape its phase.
+
+            The unwrapper is identified by its name and settings (functools.partial arguments or
+            attributes). Lambdas, closures and other unwrappers that cannot be told apart need an
+            explicit unwrapper_key naming them, or an exception is raised.
+        '''
+        ref_imgs = np.asarray(ref_imgs)
+
+        if unwrapper_key is None:
+            unwrapper_key = _callable_key(self.unwrapper)
+
+            if unwrapper_key is None:
+                raise Exception(f"Cannot identify the unwrapper {self.unwrapper!r} to cache its reference phase: pass an unwrapper_key")
+
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(repr((ref_imgs.shape, ref_imgs.dtype.str, convert_grey, None if crop is None else tuple(crop),
+                            unwrapper_key, get_precision().str)).encode())
+        digest.update(np.ascontiguousarray(ref_imgs).data)
+
+        return digest.hexdigest()
+
+    def reference_phase(self, ref_imgs, convert_grey=False, crop=None, repo=None, unwrapper_key=None):
+        ''' The ReferencePhase of a reference stack, to pass to heightmap in place of the stack.
+
+            Computed once per reference_key and kept in memory (the REFERENCE_CACHE_SIZE most recently
+            used). With a CalibrationRepo as repo it is also loaded from there, or stored there when computed.
+        '''
+        key = self.reference_key(ref_imgs, convert_grey, crop, unwrapper_key)
+        ref = PhaseHeight._references.get(key)
+
+        if ref is None and repo is not None:
+            data = repo.load_reference(key)
+            if data is not None: ref = ReferencePhase.load(data)
+
+        if ref is None:
+            self.logger.debug(f'Computing reference phase {key}')
+
+            ref = ReferencePhase(key, np.array(self._reference_phasemap(np.asarray(ref_imgs), convert_grey, crop)), convert_grey, crop)
+
+            if repo is not None:
+                repo.add_reference(key, ref.serialize())
+                repo.commit()
+
+        PhaseHeight._references[key] = ref
+        PhaseHeight._references.move_to_end(key)
+
+        while PhaseHeight.REFERENCE_CACHE_SIZE < len(PhaseHeight._references):
+            PhaseHeight._references.popitem(last=False)
+
+        return ref
+
+    @staticmethod
+    def clear_references():
+        PhaseHeight._references.clear()
+
+    def _reference_phasemap(self, ref_imgs, convert_grey, crop):
+        if crop is not None:
+            raise Exception(f"{type(self).__name__} does not support cropping")
+
+        return self.phasemap(rgb2grey(ref_imgs) if convert_grey else ref_imgs, 'ref_phase')
+
+
+    def to_stl(self, heightmap, path='heightmap_mesh.stl', scale=(1.0, 1.0), chunk_rows=128):
+        ''' Write the heightmap as a binary STL, two triangles per pixel quad.
+
+            Triangles touching NaN (or masked) pixels are skipped. The file is written through a
+            memory map in bands of chunk_rows, so memory use does not grow with the resolution.
+            scale is the (x, y) size of a pixel.
+        '''
+        from stl import mesh
+
+        heightmap = self.__mesh_heights(heightmap)
+
+        total = sum(int(np.count_nonzero(valid)) for valid, _ in self.__quad_chunks(heightmap, scale, chunk_rows, vertices=False))
+
+        with open(path, 'wb') as outfile:
+            outfile.write(b'opensfdi heightmap'.ljust(80, b' '))
+            outfile.write(np.uint32(total).tobytes())
+
+        if total == 0: return path
+
+        tris = np.memmap(path, dtype=mesh.Mesh.dtype, mode='r+', offset=84, shape=(total,))
+
+        i = 0
+        for valid, vectors in self.__quad_chunks(heightmap, scale, chunk_rows):
+            vectors = vectors[valid]
+            n = len(vectors)
+
+            normals = np.cross(vectors[:, 1] - vectors[:, 0], vectors[:, 2] - vectors[:, 0])
+            lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+            np.divide(normals, lengths, out=normals, where=0 < lengths)
+
+            tris['vectors'][i : i + n] = vectors
+            tris['normals'][i : i + n] = normals
+            tris['attr'][i : i + n] = 0
+
+            i += n
+
+        tris.flush()
+        del tris
+
+        return path
+
+    def to_ply(self, heightmap, path='heightmap_mesh.ply', scale=(1.0, 1.0), chunk_rows=128):
+        ''' Write the heightmap as a binary PLY with shared vertices (one per valid pixel).
+
+            Uses the same triangulation, NaN handling and chunked memory-mapped writing as to_stl.
+        '''
+        heightmap = self.__mesh_heights(heightmap)
+        h, w = heightmap.shape
+
+        # Index of each row's first vertex once invalid pixels are dropped
+        row_counts = np.concatenate([np.count_nonzero(np.isfinite(heightmap[y0 : y0 + chunk_rows]), axis=1) for y0 in range(0, h, chunk_rows)])
+        row_offsets = np.concatenate(([0], np.cumsum(row_counts)))
+        vertex_count = int(row_offsets[-1])
+
+        face_count = sum(int(np.count_nonzero(valid)) for valid, _ in self.__quad_chunks(heightmap, scale, chunk_rows, vertices=False))
+
+        header = (
+            'ply\n'
+            'format binary_little_endian 1.0\n'
+            'comment opensfdi heightmap\n'
+            f'element vertex {vertex_count}\n'
+            'property float x\n'
+            'property float y\n'
+            'property float z\n'
+            f'element face {face_count}\n'
+            'property list uchar int vertex_indices\n'
+            'end_header\n'
+        ).encode('ascii')
+
+        vertex_dtype = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+        face_dtype = np.dtype([('n', 'u1'), ('v', '<i4', (3,))])
+
+        size = len(header) + vertex_count * vertex_dtype.itemsize + face_count * face_dtype.itemsize
+
+        with open(path, 'wb') as outfile:
+            outfile.write(header)
+            outfile.truncate(size)
+
+        if vertex_count:
+            verts = np.memmap(path, dtype=vertex_dtype, mode='r+', offset=len(header), shape=(vertex_count,))
+
+            for y0 in range(0, h, chunk_rows):
+                y1 = min(y0 + chunk_rows, h)
+
+                block = heightmap[y0:y1]
+                valid = np.isfinite(block)
+                ys, xs = np.nonzero(valid)
+
+                a, b = row_offsets[y0], row_offsets[y1]
+                verts['x'][a:b] = xs * scale[0]
+                verts['y'][a:b] = (ys + y0) * scale[1]
+                verts['z'][a:b] = block[valid]
+
+            verts.flush()
+            del verts
+
+        if face_count:
+            faces = np.memmap(path, dtype=face_dtype, mode='r+', offset=len(header) + vertex_count * vertex_dtype.itemsize, shape=(face_count,))
+
+            i = 0
+            for y0 in range(0, h - 1, chunk_rows):
+                y1 = min(y0 + chunk_rows, h - 1)
+
+                # Compacted vertex index of every pixel in the band (and the row below it)
+                block = np.isfinite(heightmap[y0 : y1 + 1])
+                index = np.cumsum(block, axis=1) - 1 + row_offsets[y0 : y1 + 1, None]
+
+                v1, v2, v3, v4 = index[:-1, :-1], index[:-1, 1:], index[1:, :-1], index[1:, 1:]
+
+                corners = np.empty((y1 - y0, w - 1, 2, 3), dtype=np.int32)
+                corners[:, :, 0] = np.stack((v1, v2, v3), axis=-1)
+                corners[:, :, 1] = np.stack((v2, v4, v3), axis=-1)
+
+                valid = self.__quad_validity(block)
+                n = int(np.count_nonzero(valid))
+
+                faces['n'][i : i + n] = 3
+                faces['v'][i : i + n] = corners[valid]
+
+                i += n
+
+            faces.flush()
+            del faces
+
+        return path
+
+    def __mesh_heights(self, heightmap):
+        if np.ma.isMaskedArray(heightmap):
+            return np.ma.filled(heightmap.astype(np.float32), np.nan)
+
+        return np.asarray(heightmap, dtype=np.float32)
+
+    def __quad_validity(self, finite):
+        # (rows, cols, 2) flags for the two triangles of each quad: (v1, v2, v3) and (v2, v4, v3)
+        f1, f2, f3, f4 = finite[:-1, :-1], finite[:-1, 1:], finite[1:, :-1], finite[1:, 1:]
+
+        shared = f2 & f3
+
+        return np.stack((shared & f1, shared & f4), axis=-1)
+
+    def __quad_chunks(self, heightmap, scale, chunk_rows, vertices=True):
+        h, w = heightmap.shape
+
+        for y0 in range(0, h - 1, chunk_rows):
+            y1 = min(y0 + chunk_rows, h - 1)
+
+            block = heightmap[y0 : y1 + 1]
+            valid = self.__quad_validity(np.isfinite(block))
+
+            if not vertices:
+                yield valid, None
+                continue
+
+            xs = np.arange(w, dtype=np.float32) * scale[0]
+            ys = np.arange(y0, y1 + 1, dtype=np.float32) * scale[1]
+
+            # Corner coordinates of every quad: v1 (x, y), v2 (x + 1, y), v3 (x, y + 1), v4 (x + 1, y + 1)
+            pts = np.empty((y1 - y0 + 1, w, 3), dtype=np.float32)
+            pts[..., 0] = xs[None, :]
+            pts[..., 1] = ys[:, None]
+            pts[..., 2] = block
+
+            v1, v2, v3, v4 = pts[:-1, :-1], pts[:-1, 1:], pts[1:, :-1], pts[1:, 1:]
+
+            vectors = np.empty((y1 - y0, w - 1, 2, 3, 3), dtype=np.float32)
+            vectors[:, :, 0, 0], vectors[:, :, 0, 1], vectors[:, :, 0, 2] = v1, v2, v3
+            vectors[:, :, 1, 0], vectors[:, :, 1, 1], vectors[:, :, 1, 2] = v2, v4, v3
+
+            yield valid, vectors
 
 class ClassicPhaseHeight(PhaseHeight):
     # ℎ = 𝜙𝐷𝐸 ⋅ 𝑝 ⋅ 𝑑 / 𝜙𝐷𝐸 ⋅ 𝑝 + 2𝜋𝑙
@@ -60,44 +375,180 @@ class ClassicPhaseHeight(PhaseHeight):
     # d = distance between camera and reference plane
     # l = distance between camera and projector
         
-    def __init__(self, p, d, l):
-        super().__init__()
+    def __init__(self, p, d, l, unwrapper=None, workspace=None):
+        super().__init__(unwrapper, workspace)
         
         self.p = p
         self.d = d 
         self.l = l
     
-    def heightmap(self, ref_imgs, imgs, convert_grey=False, crop=None):
+    @traced('heightmap', pixels=lambda self, ref_imgs, imgs, *args, **kwargs: np.size(imgs))
+    def heightmap(self, ref_imgs, imgs, convert_grey=False, crop=None, memory_budget=None, halo=32, out=None):
+        ''' Height from reference and measurement stacks ((N, H, W), or (F, N, H, W) when multi-frequency).
+
+            With a memory_budget (bytes) the stacks are streamed in row bands sized to fit it, so they
+            can be memory-mapped arrays (e.g. np.load(..., mmap_mode='r')). Spatially unwrapped bands
+            are read with halo rows above them and aligned to the previous band by a multiple of 2π, so
+            they need at least two rows plus a halo row; a budget too small for that raises ValueError.
+            The result is written into out when given (e.g. a np.memmap of the cropped shape); with a
+            workspace and no out, it is a workspace buffer overwritten by the next call.
+            ref_imgs can be a ReferencePhase (see reference_phase) so only the measurement is processed.
+        '''
+        reference = ref_imgs if isinstance(ref_imgs, ReferencePhase) else None
+
+        imgs = np.asarray(imgs)
+        if reference is None: ref_imgs = np.asarray(ref_imgs)
+
+        row_axis = imgs.ndim - (3 if convert_grey else 2)
+        h, w = imgs.shape[row_axis : row_axis + 2]
+
+        y1, y2, x1, x2 = self.__crop_bounds(crop, h, w)
+        rows = y2 - y1
+
+        if reference is not None:
+            if reference.convert_grey != convert_grey or reference.crop != (None if crop is None else tuple(crop)):
+                raise Exception("The reference phase was computed with different convert_grey or crop settings")
+
+            if reference.phase.shape != (rows, x2 - x1):
+                raise Exception(f"Reference phase of shape {reference.phase.shape} does not match the measurement {(rows, x2 - x1)}")
+
+        if out is None:
+            out = np.empty((rows, x2 - x1), dtype=get_precision()) if self.workspace is None else self.workspace.get('height', (rows, x2 - x1))
+
+        band_rows = rows
+        if memory_budget is not None:
+            row_bytes = (x2 - x1) * self.__pixel_bytes(imgs, row_axis, convert_grey)
+            fit = int(memory_budget // row_bytes)
+
+            temporal = isinstance(self.unwrapper, TemporalUnwrapper)
+            least = 1 if temporal else 2 + min(halo, 1)
+
+            if rows <= fit:
+                band_rows = rows
+            elif fit < least:
+                raise ValueError(f"A memory budget of {memory_budget} bytes fits {fit} rows of {row_bytes} bytes (a band needs at least {least})")
+            else:
+                halo = 0 if temporal else min(halo, fit // 2)
+                band_rows = fit - halo
+
+        if band_rows == rows or isinstance(self.unwrapper, TemporalUnwrapper):
+            halo = 0 # Per-pixel unwrapping (or a single band) needs no overlap
+
+        # Estimated peak working memory of a band (the output itself is excluded)
+        self.peak_bytes = (band_rows + halo) * (x2 - x1) * self.__pixel_bytes(imgs, row_axis, convert_grey)
+
+        self.logger.debug(f'Heightmap in bands of {band_rows} rows (~{self.peak_bytes / 2 ** 20:.1f} MiB peak)')
+
+        prev = None
+
+        for r0 in range(0, rows, band_rows):
+            r1 = min(r0 + band_rows, rows)
+            h0 = r0 if prev is None else max(r0 - halo, 0)
+
+            if reference is None:
+                ref_band = self.__band(ref_imgs, row_axis, y1 + h0, y1 + r1, x1, x2, convert_grey)
+                ref_phase = self.phasemap(ref_band, 'ref_phase')
+                del ref_band
+            else:
+                ref_phase = reference.phase[h0:r1] # Unwrapped whole, so already consistent between bands
+
+            band = self.__band(imgs, row_axis, y1 + h0, y1 + r1, x1, x2, convert_grey)
+            measured_phase = self.phasemap(band)
+            del band
+
+            banded = (measured_phase,) if reference is not None else (ref_phase, measured_phase)
+
+            if prev is not None and 0 < halo:
+                # Match the 2π offsets of the previous band on the overlapping rows
+                overlap = r0 - h0
+                for phase, prev_phase in zip(banded, prev):
+                    k = np.rint(np.nanmedian(prev_phase[-overlap:] - phase[:overlap]) / (2.0 * np.pi))
+                    if k != 0: phase += (2.0 * np.pi) * k
+
+            if 0 < halo:
+                prev = tuple(phase[-halo:].copy() for phase in banded)
+            else:
+                prev = ()
+
+            self.from_phase(ref_phase[r0 - h0:], measured_phase[r0 - h0:], out=out[r0:r1])
+
+        return out
+
+    def from_phase(self, ref_phase, measured_phase, out=None):
+        if self.workspace is None:
+            phase_diff = measured_phase - ref_phase
+
+            return np.divide(self.l * phase_diff, phase_diff - (2.0 * np.pi * self.p * self.d), out=out, dtype=get_precision())
+
+        phase_diff = self.workspace.get('diff', measured_phase.shape)
+        denom = self.workspace.get('denom', measured_phase.shape)
+
+        np.subtract(measured_phase, ref_phase, out=phase_diff)
+        np.subtract(phase_diff, 2.0 * np.pi * self.p * self.d, out=denom)
+        phase_diff *= self.l
+
+        if out is None: out = self.workspace.get('height', measured_phase.shape)
+
+        return np.divide(phase_diff, denom, out=out)
+
+    def _reference_phasemap(self, ref_imgs, convert_grey, crop):
+        row_axis = ref_imgs.ndim - (3 if convert_grey else 2)
+        y1, y2, x1, x2 = self.__crop_bounds(crop, *ref_imgs.shape[row_axis : row_axis + 2])
+
+        return self.phasemap(self.__band(ref_imgs, row_axis, y1, y2, x1, x2, convert_grey), 'ref_phase')
+
+    def __crop_bounds(self, crop, h, w):
+        if crop is None:
+            return 0, h, 0, w
+
+        if len(crop) == 2:
+            crop_x1 = int(crop[0] * w)
+            crop_x2 = w - crop_x1 - 1
+            crop_y1 = int(crop[1] * h)
+            crop_y2 = h - crop_y1 - 1
+        elif len(crop) == 4:
+            crop_x1 = int(crop[0] * w)
+            crop_y1 = int(crop[1] * h)
+            crop_x2 = w - int(crop[2] * w) - 1
+            crop_y2 = h - int(crop[3] * h) - 1
+        else: raise Exception("Invalid crop tuple passed")
+
+        return crop_y1, crop_y2, crop_x1, crop_x2
+
+    def __band(self, stack, row_axis, y1, y2, x1, x2, convert_grey):
+        # Only the rows (and columns) of the band are read from memory-mapped stacks
+        idx = [slice(None)] * stack.ndim
+        idx[row_axis] = slice(y1, y2)
+        idx[row_axis + 1] = slice(x1, x2)
+
+        band = np.asarray(stack[tuple(idx)])
+        ws = self.workspace
+
+        if ws is None:
+            return rgb2grey(band) if convert_grey else band
+
         if convert_grey:
-            imgs = np.array([rgb2grey(img) for img in imgs])
-            ref_imgs = np.array([rgb2grey(img) for img in ref_imgs])
-  
-        if crop is not None:
-            h, w = imgs[0].shape[:2]
-            if len(crop) == 2:
-                crop_x1 = int(crop[0] * w)
-                crop_x2 = w - crop_x1 - 1
-                crop_y1 = int(crop[1] * h)
-                crop_y2 = h - crop_y1 - 1
-            elif len(crop) == 4:
-                crop_x1 = int(crop[0] * w)
-                crop_y1 = int(crop[1] * h)
-                crop_x2 = w - int(crop[2] * w) - 1
-                crop_y2 = h - int(crop[3] * h) - 1
-            else: raise Exception("Invalid crop tuple passed")
-            
-            imgs = np.array([centre_crop_img(img, crop_x1, crop_y1, crop_x2, crop_y2) for img in imgs])
-            ref_imgs = np.array([centre_crop_img(img, crop_x1, crop_y1, crop_x2, crop_y2) for img in ref_imgs])
-        
-        ref_phase, measured_phase = self.phasemap(ref_imgs), self.phasemap(imgs)
+            return rgb2grey(band, out=ws.get('grey', band.shape[:-1]), scratch=ws.get('grey_scratch', band.shape[:-1]))
 
-        phase_diff = measured_phase - ref_phase
-        
-        return np.divide(self.l * phase_diff, phase_diff - (2.0 * np.pi * self.p * self.d), dtype=np.float32)
+        if band.flags.c_contiguous: return band
+
+        # Demodulation reads the stack as (N, pixels), which would copy a cropped view
+        contiguous = ws.get('band', band.shape, band.dtype)
+        np.copyto(contiguous, band)
+
+        return contiguous
+
+    def __pixel_bytes(self, stack, row_axis, convert_grey):
+        # Rough upper bound on the working memory per pixel of a band: the raw and grey slices
+        # of both stacks, demodulation outputs, unwrapping temporaries and the difference
+        frames = int(np.prod(stack.shape[:row_axis]))
+        channels = stack.shape[-1] if convert_grey else 1
+
+        return 2 * frames * (channels * stack.itemsize + 2 * get_precision().itemsize) + 24 * get_precision().itemsize
 
 class TriangularStereoHeight(PhaseHeight):
-    def __init__(self, ref_dist, sensor_dist, freq):
-        super().__init__()
+    def __init__(self, ref_dist, sensor_dist, freq, unwrapper=None, workspace=None):
+        super().__init__(unwrapper, workspace)
         
         self.ref_dist = ref_dist
         self.sensor_dist = sensor_dist
@@ -113,21 +564,16 @@ class TriangularStereoHeight(PhaseHeight):
         return None
 
 class PolyPhaseHeight(PhaseHeight):
-    def __init__(self, coeffs=None):
-        super().__init__()
+    def __init__(self, coeffs=None, unwrapper=None, workspace=None):
+        super().__init__(unwrapper, workspace)
         
         self.coeffs = coeffs
     
     def calibrate(self, heightmap, ref_imgs, imgs, deg=1):
-        ref_phase, measured_phase = self.phasemap(ref_imgs), self.phasemap(imgs)
+        ref_phase, measured_phase = self.__ref_phase(ref_imgs), self.phasemap(imgs)
         
         diff = ref_phase - measured_phase
 
-        total = np.zeros(ref_phase.shape, dtype=np.float64)
-        
-        for i in range(deg):
-            total += np.power(diff, i)
-
         # Coefficients are in ascending order
 
         self.coeffs, stats = P.polyfit(diff.ravel(), heightmap.ravel(), deg=deg, full=True)
@@ -135,14 +581,34 @@ class PolyPhaseHeight(PhaseHeight):
         return self.coeffs, stats[0][0]
 
     def heightmap(self, ref_imgs, imgs):
-        ref_phase, measured_phase = self.phasemaps(ref_imgs, imgs)
-        
-        diff = ref_phase - measured_phase
-        
-        result = np.zeros(ref_phase.shape, dtype=np.float64)
-        
-        for i, a_i in enumerate(self.coeffs):
-            print(f'{round(a_i, ndigits=3)} X_{i}')
-            result += (np.power(diff, i) * a_i)
+        ''' Height from reference and measurement stacks. ref_imgs can be a ReferencePhase (see reference_phase). '''
+        ref_phase, measured_phase = self.__ref_phase(ref_imgs), self.phasemap(imgs)
+
+        if self.workspace is None:
+            diff = np.subtract(ref_phase, measured_phase, dtype=get_precision())
+            result = np.empty_like(diff)
+        else:
+            diff = np.subtract(ref_phase, measured_phase, out=self.workspace.get('diff', ref_phase.shape))
+            result = self.workspace.get('height', ref_phase.shape)
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for i, a_i in enumerate(self.coeffs):
+                self.logger.debug(f'{round(a_i, ndigits=3)} X_{i}')
+
+        # Horner's rule on the ascending coefficients, in place in the compute precision
+        result.fill(self.coeffs[-1])
+
+        for a_i in self.coeffs[-2::-1]:
+            result *= diff
+            result += a_i
         
-        return result
\ No newline at end of file
+        return result
+
+    def __ref_phase(self, ref_imgs):
+        if not isinstance(ref_imgs, ReferencePhase):
+            return self.phasemap(ref_imgs, 'ref_phase')
+
+        if ref_imgs.convert_grey or ref_imgs.crop is not None:
+            raise Exception("The reference phase was computed with different convert_grey or crop settings")
+
+        return ref_imgs.phase
@@ -4,8 +4,9 @@ import numpy as np
 
 from datetime import datetime
 
-from opensfdi.io.repositories import ImageRepo, FileImageRepo, CalibrationRepo, BinRepo, BinCalibrationRepo
-from opensfdi.definitions import RESULTS_DIR, CALIBRATION_DIR
+from opensfdi.io.repositories import ImageRepo, FileImageRepo, ChunkedArrayRepo, CalibrationRepo, BinRepo, BinCalibrationRepo
+from opensfdi import definitions
+from opensfdi.instrument import traced
 
 class CalibrationService():
     def __init__(self, data_repo:CalibrationRepo = None):       
@@ -14,11 +15,12 @@ class CalibrationService():
         self._data_repo = data_repo
 
         if self._data_repo is None: # Default to bin repo
-            output = os.path.join(CALIBRATION_DIR, 'calibration.json')
+            output = os.path.join(definitions.ensure_dir(definitions.CALIBRATION_DIR), 'calibration.json')
             self._data_repo = BinCalibrationRepo(output)
             
             self._logger.debug(f'Using calibration data file {output}')
 
+    @traced('calibration.save')
     def save_calibrations(self, gamma_calib=None, lens_calib=None, proj_calib=None):
         updated = False
         if gamma_calib:
@@ -36,9 +38,24 @@ class CalibrationService():
         if updated: 
             self._data_repo.commit()
 
+    @traced('calibration.load')
     def load_calibrations(self, cam_name, proj_name):
         return self._data_repo.load_gamma(cam_name), self._data_repo.load_lens(cam_name), self._data_repo.load_proj(proj_name)
 
+    @traced('calibration.save')
+    def save_reference(self, reference, key=None):
+        ''' Persist a profilometry.ReferencePhase under key (default: its content key). '''
+        self._data_repo.add_reference(reference.key if key is None else key, reference.serialize())
+        self._data_repo.commit()
+
+    @traced('calibration.load')
+    def load_reference(self, key):
+        from opensfdi.profilometry import ReferencePhase
+
+        data = self._data_repo.load_reference(key)
+
+        return None if data is None else ReferencePhase.load(data)
+
 class ResultService():
     def __init__(self, data_repo:BinRepo, image_repo:ImageRepo):
         self._logger = logging.getLogger('opensfdi')
@@ -47,22 +64,35 @@ class ResultService():
         self._image_repo = image_repo
 
     @staticmethod
-    def default(directory=None):
+    def default(directory=None, store='jpeg', compression=None, workers=None):
+        ''' store is 'jpeg' (8-bit images per frame) or 'array' (lossless chunked stacks in native dtype).
+            workers sets the number of encode/decode threads used by the jpeg store.
+        '''
         if directory is None: directory = str(datetime.now().strftime("%Y%m%d_%H%M%S"))
     
-        loc = os.path.join(RESULTS_DIR, directory)
+        loc = os.path.join(definitions.ensure_dir(definitions.RESULTS_DIR), directory)
         
         if not os.path.exists(loc): os.mkdir(loc, 0o770)
         
         data_out = os.path.join(loc, 'results.bin')
+
+        if store == 'array':
+            return ResultService(BinRepo(data_out), ChunkedArrayRepo(loc, compression=compression))
+
+        if store != 'jpeg':
+            raise Exception(f"Unknown result store '{store}' (jpeg or array)")
         
-        return ResultService(BinRepo(data_out), FileImageRepo(loc))
+        return ResultService(BinRepo(data_out), FileImageRepo(loc, workers=workers))
 
-    def save_data(self, data=None, fringes=None, imgs=None, ref_imgs=None):
+    @traced('results.save')
+    def save_data(self, data=None, fringes=None, imgs=None, ref_imgs=None, heightmaps=None):
         if data is not None:
             self._data_repo.add_bin(data)
             self._data_repo.commit()
 
+        if isinstance(self._image_repo, ChunkedArrayRepo):
+            return self.__save_arrays(fringes, imgs, ref_imgs, heightmaps)
+
         updated = False
             
         if fringes is not None:
@@ -82,18 +112,47 @@ class ResultService():
                 for i, img in enumerate(xs):
                     self._image_repo.add_image(img, f'cam{cam_i}_refimg{i}.jpg')
 
+        if heightmaps is not None:
+            self._logger.warning('Heightmaps are only saved by the array result store')
+
         if updated: self._image_repo.commit()
 
+    @traced('results.load')
     def load_data(self):
         data = self._data_repo.load_bin()
+
+        if isinstance(self._image_repo, ChunkedArrayRepo):
+            # Memory-mapped (cameras, phases, h, w, c) stacks, read lazily
+            return self._image_repo.load_ref_image('imgs'), self._image_repo.load_image('imgs'), data
+
         cam_count = len(data["cameras"].keys())
         phases = data["phases"]
         
+        names = [f'cam{cam_i}_{kind}{i}.jpg' for kind in ('img', 'refimg') for cam_i in range(cam_count) for i in range(phases)]
+        loaded = self._image_repo.load_images(names)
+
         imgs = np.empty((cam_count, phases), dtype=np.ndarray)
         ref_imgs = np.empty((cam_count, phases), dtype=np.ndarray)
-        for cam_i in range(cam_count):
-            for i in range(phases):
-                imgs[cam_i][i] = self._image_repo.load_image(f'cam{cam_i}_img{i}.jpg')
-                ref_imgs[cam_i][i] = self._image_repo.load_image(f'cam{cam_i}_refimg{i}.jpg')
 
-        return ref_imgs, imgs, data
\ No newline at end of file
+        count = cam_count * phases
+        for j in range(count):
+            imgs[j // phases][j % phases] = loaded[j]
+            ref_imgs[j // phases][j % phases] = loaded[count + j]
+
+        return ref_imgs, imgs, data
+
+    def load_heightmaps(self):
+        if not isinstance(self._image_repo, ChunkedArrayRepo):
+            raise Exception("Heightmaps are only stored by the array result store")
+
+        return self._image_repo.load_heightmap('heightmaps')
+
+    def __save_arrays(self, fringes, imgs, ref_imgs, heightmaps):
+        repo = self._image_repo
+
+        if fringes is not None: repo.add_fringe(fringes, 'fringes')
+        if imgs is not None: repo.add_image(imgs, 'imgs')
+        if ref_imgs is not None: repo.add_ref_image(ref_imgs, 'imgs')
+        if heightmaps is not None: repo.add_heightmap(np.asarray(heightmaps), 'heightmaps')
+
+        if any(x is not None for x in (fringes, imgs, ref_imgs, heightmaps)): repo.commit()
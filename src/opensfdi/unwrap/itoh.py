@@ -1,43 +1,122 @@
 import numpy as np
 
-def unwrap_phase(wrapped):
-    if wrapped.ndim == 1:
-        return __unwrap_phase_1d(wrapped)
-    
-    if wrapped.ndim == 2:
-        return __unwrap_phase_2d(wrapped)
-    
-    raise Exception("Only one and two-dimensional unwraps are supported!")
+from opensfdi.instrument import traced
+from opensfdi.utils.precision import get_precision
 
-def __unwrap_phase_1d(wrapped):
-    # Accumulate wraps of pi and store in k
-    k = 0
+@traced('unwrap.itoh', pixels=lambda wrapped, *args, **kwargs: np.size(wrapped))
+def unwrap_phase(wrapped, axis=-1, out=None, workspace=None):
+    ''' Itoh unwrapping of a (W,), (H, W) or batched (K, H, W) wrapped phase.
 
-    addon = np.zeros_like(wrapped)
+        With an integer axis, every line along that axis is unwrapped independently
+        (the default unwraps each row, matching the original 2D behaviour). With
+        axis=None, 2D/3D input is unwrapped along rows and the rows are then made
+        consistent with each other by unwrapping along the first column.
 
-    for i in range(1, len(wrapped)):
-        difference = wrapped[i] - wrapped[i - 1]
-        if np.pi < difference:
-            k -= (2.0 * np.pi)
+        With a Workspace (opensfdi.workspace) the temporaries are reused from it and the
+        result is written to out (which may be wrapped itself), so repeated calls allocate nothing.
+    '''
+    if 3 < wrapped.ndim:
+        raise Exception("Only one and two-dimensional (optionally batched) unwraps are supported!")
 
-        elif difference < -np.pi:
-            k += (2.0 * np.pi)
+    if workspace is not None:
+        if out is None: out = workspace.get('itoh_out', wrapped.shape, wrapped.dtype)
 
-        addon[i] = k
+        if axis is None:
+            __unwrap_axis_into(wrapped, wrapped.ndim - 1, out, workspace)
+            if 1 < wrapped.ndim: __shift_rows_into(out, workspace)
+        else:
+            __unwrap_axis_into(wrapped, axis % wrapped.ndim, out, workspace)
 
-    return wrapped + addon
+        return out
+
+    if axis is None:
+        if wrapped.ndim == 1: result = __unwrap_axis(wrapped, 0)
+        else: result = __unwrap_phase_2d(wrapped)
+    else:
+        result = __unwrap_axis(wrapped, axis)
+
+    if out is None: return result
+
+    np.copyto(out, result)
+    return out
+
+def __wrap_counts(wrapped, axis):
+    # Accumulate wraps of pi as integer multiples of 2pi (no per-pixel Python)
+    diff = np.diff(wrapped, axis=axis)
+
+    steps = (diff < -np.pi).astype(np.int32)
+    steps -= (np.pi < diff)
+
+    k = np.zeros(wrapped.shape, dtype=np.int32)
+
+    tail = [slice(None)] * wrapped.ndim
+    tail[axis] = slice(1, None)
+
+    np.cumsum(steps, axis=axis, out=k[tuple(tail)])
+
+    return k
+
+def __unwrap_axis(wrapped, axis):
+    dtype = wrapped.dtype if np.issubdtype(wrapped.dtype, np.floating) else get_precision()
+
+    unwrapped = __wrap_counts(wrapped, axis).astype(dtype)
+    unwrapped *= (2.0 * np.pi)
+    unwrapped += wrapped
+
+    return unwrapped
 
 def __unwrap_phase_2d(wrapped):
-    # TODO: Maybe possible to do this in place?
+    # Unwrap every row, then shift each row by the wraps found down the first column
+    unwrapped = __unwrap_axis(wrapped, -1)
+
+    offsets = __wrap_counts(unwrapped[..., :1], -2).astype(unwrapped.dtype)
+    offsets *= (2.0 * np.pi)
+
+    unwrapped += offsets
+
+    return unwrapped
+
+def __wrap_counts_into(wrapped, axis, workspace, name):
+    # As __wrap_counts, but counting in floats in workspace buffers
+    dtype = wrapped.dtype if np.issubdtype(wrapped.dtype, np.floating) else get_precision()
+
+    head, tail, lead = ([slice(None)] * wrapped.ndim for _ in range(3))
+    head[axis], tail[axis], lead[axis] = slice(None, -1), slice(1, None), slice(None, 1)
+
+    diff_shape = list(wrapped.shape)
+    diff_shape[axis] -= 1
+
+    diff = workspace.get(f'{name}_diff', diff_shape, dtype)
+    low = workspace.get(f'{name}_low', diff_shape, np.bool_)
+    high = workspace.get(f'{name}_high', diff_shape, np.bool_)
+
+    np.subtract(wrapped[tuple(tail)], wrapped[tuple(head)], out=diff)
+    np.less(diff, -np.pi, out=low)
+    np.greater(diff, np.pi, out=high)
+    np.subtract(low, high, out=diff, dtype=dtype)
+
+    k = workspace.get(f'{name}_k', wrapped.shape, dtype)
+    k[tuple(lead)] = 0
+    np.cumsum(diff, axis=axis, out=k[tuple(tail)])
+
+    return k
+
+def __unwrap_axis_into(wrapped, axis, out, workspace):
+    k = __wrap_counts_into(wrapped, axis, workspace, 'itoh')
+    k *= (2.0 * np.pi)
 
-    a, b = wrapped.shape
+    np.add(wrapped, k, out=out)
 
-    unwrapped = np.zeros((a, b))
-    for j in range(b):
-        unwrapped[:, j] = __unwrap_phase_1d(wrapped[:, j])
+def __shift_rows_into(unwrapped, workspace):
+    offsets = __wrap_counts_into(unwrapped[..., :1], unwrapped.ndim - 2, workspace, 'itoh_col')
+    offsets *= (2.0 * np.pi)
 
-    for i in range(a):
-        unwrapped[i, :] = __unwrap_phase_1d(wrapped[i, :])
+    unwrapped += offsets
 
+class ItohUnwrapper:
+    ''' Callable Itoh unwrapper for PhaseHeight, which unwraps in place in its workspace when it has one. '''
+    def __init__(self, axis=None):
+        self.axis = axis
 
-    return unwrapped
\ No newline at end of file
+    def __call__(self, wrapped, out=None, workspace=None):
+        return unwrap_phase(wrapped, self.axis, out=out, workspace=workspace)
@@ -1,6 +1,9 @@
 import numpy as np
 
-from itertools import zip_longest
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree, connected_components, breadth_first_order
+
+from opensfdi.instrument import traced
 
 # Fast unwrapping 2D phase image using the algorithm given in:
 #     M. A. Herráez, D. R. Burton, M. J. Lalor, and M. A. Gdeisat,
@@ -27,7 +30,16 @@ from itertools import zip_longest
 #     Muhammad F. Kasim, University of Oxford (2017)
 #     Email: firman.kasim@gmail.com
 
+@traced('unwrap.reliability', pixels=lambda wrapped, *args, **kwargs: np.size(wrapped))
 def unwrap_phase(wrapped, relationship=None):
+    ''' Reliability-sorted unwrapping of a 2D wrapped phase (any aspect ratio).
+
+        NaN pixels mark invalid regions: they are never used to unwrap their
+        neighbours and remain NaN in the result. Disconnected valid regions are
+        unwrapped independently, each with its own arbitrary offset.
+
+        Throughput target: >= 0.5 MP/s on a single core (see benchmarks/bench_unwrap.py).
+    '''
     if not relationship:
         relationship = __default_rel
 
@@ -40,108 +52,60 @@ def __default_rel(x):
     with np.errstate(divide='ignore'):
         return 1.0 / x
 
+def __wrap(x):
+    # Wrap values into [-pi, pi)
+    return x - (2.0 * np.pi) * np.floor((x + np.pi) / (2.0 * np.pi))
+
 def __unwrap_phase_2d(wrapped, relationship):
-    w_x, w_y = wrapped.shape
+    h, w = wrapped.shape
+    size = h * w
+
+    flat = wrapped.ravel()
 
     # Get the reliability
     reliability = __get_reliability_2d(wrapped, relationship)
 
-    # Get the edges
-    hori, vert = __get_edges_2d(reliability)
-
-    # Combine all edges and sort
-    edges = np.append(hori, vert)
-
-    np.set_printoptions(precision=1)
-
-    print(edges, end='\n\n')
-
-    num_edges = w_x * w_y
-
-    # Sort by highest reliability - collect indices instead of values
-    sorted = np.flip(np.argsort(edges))
-
-    print(sorted, end='\n\n')
+    # Get the edges between valid neighbouring pixels
+    idx1, idx2, edges = __get_edges_2d(reliability, ~np.isnan(wrapped))
 
-    # Get the indices of pixels adjacent to the edges
-    neighbour1 = np.mod(sorted - 1, num_edges) + 1
-    neighbour2 = neighbour1 + 1 + (w_y - 1) * (sorted > num_edges)
+    # Merge pixels into groups from the most reliable edge down (Kruskal ordering).
+    # The merge itself runs in scipy's compiled union-find; the weights only need
+    # to be positive and decreasing in reliability.
+    weights = 1.0 / (1.0 + np.minimum(edges.astype(np.float64), 1e300))
 
+    graph = coo_matrix((weights, (idx1, idx2)), shape=(size, size)).tocsr()
+    tree = minimum_spanning_tree(graph)
 
-    # TODO: Fix function
+    # Hang every group off a virtual root so one traversal orients the whole forest
+    _, labels = connected_components(tree, directed=False)
+    _, heads = np.unique(labels, return_index=True)
 
+    tree = tree.tocoo()
+    rows = np.concatenate((tree.row, np.full(heads.size, size)))
+    cols = np.concatenate((tree.col, heads))
 
+    forest = coo_matrix((np.ones(rows.size), (rows, cols)), shape=(size + 1, size + 1)).tocsr()
 
-    groups = np.reshape(np.arange(0, wrapped.size, 1, dtype=int), num_edges)
+    _, parent = breadth_first_order(forest, size, directed=False, return_predecessors=True)
+    parent[size] = size
 
-    # label the group
-    is_grouped = np.zeros_like(groups)
-    group_members = np.empty_like(groups)
+    # Number of 2pi wraps of each pixel relative to its parent
+    padded = np.append(flat, 0.0)
 
-    for i in range(is_grouped.size):
-        group_members[i] = i
-    
-    num_members_group = np.ones(edges_size)
+    offset = np.rint((padded[parent] - padded) / (2.0 * np.pi))
+    offset[heads] = 0
+    offset = np.nan_to_num(offset).astype(np.int32)
 
-    # propagate the unwrapping
-    res_img = wrapped
-    num_nan = sum(np.isnan(edges))
+    # Path compression by pointer jumping: accumulate offsets up to the root
+    while np.any(parent != parent[parent]):
+        offset += offset[parent]
+        parent = parent[parent]
 
-    # for i in range(num_nan+1, len(edge_sort_idx)):
-    #     # get the indices of the adjacent pixels
-    #     idx1 = idxs1(i)
-    #     idx2 = idxs2(i)
-    
-    #     # skip if they belong to the same group
-    #     if (group(idx1) == group(idx2)):
-    #         continue
-    
-    #     # idx1 should be ungrouped (swap if idx2 ungrouped and idx1 grouped)
-    #     # otherwise, activate the flag all_grouped.
-    #     # The group in idx1 must be smaller than in idx2. If initially
-    #     # group(idx1) is larger than group(idx2), then swap it.
-    
-    #     all_grouped = 0
-    #     if is_grouped(idx1):
-    #         if not is_grouped(idx2):
-    #             idxt = idx1
-    #             idx1 = idx2
-    #             idx2 = idxt
-    #         elif num_members_group(group(idx1)) > num_members_group(group(idx2)):
-    #             idxt = idx1
-    #             idx1 = idx2
-    #             idx2 = idxt
-    #             all_grouped = 1
-    #         else:
-    #             all_grouped = 1
-            
-    #     # calculate how much we should add to the idx1 and group
-    #     dval = floor((res_img(idx2) - res_img(idx1) + np.pi) / (2.0 * np.pi)) * 2 * np.pi
-    
-    #     # which pixel should be changed
-    #     g1 = group(idx1)
-    #     g2 = group(idx2)
-    
-    #     if all_grouped: 
-    #         pix_idxs = group_members{g1}
+    res_img = offset[:size].reshape(h, w).astype(wrapped.dtype)
+    res_img *= (2.0 * np.pi)
+    res_img += wrapped
 
-    #     else: 
-    #         pix_idxs = idx1
-    
-    #     # add the pixel value
-    #     if dval != 0: 
-    #         res_img[pix_idxs] = res_img[pix_idxs] + dval
-    
-    #     # change the group
-    #     len_g1 = num_members_group(g1)
-    #     len_g2 = num_members_group(g2)
-    #     group_members[g2][len_g2 + 1 : len_g2 + len_g1] = pix_idxs
-    #     group[pix_idxs] = g2 # assign the pixels to the new group
-    #     num_members_group[g2] = num_members_group(g2) + len_g1
-    
-    #     # mark idx1 and idx2 as already being grouped
-    #     is_grouped[idx1] = 1
-    #     is_grouped[idx2] = 1
+    return res_img
 
 def __get_reliability_2d(img, relationship=None):
 
@@ -160,8 +124,8 @@ def __get_reliability_2d(img, relationship=None):
     # Central
     img_i_j     = img[1:-1, 1:-1]   # i = 0, j = 0
 
-    # Determine positive or negative modulus pi
-    gamma_mod = lambda x: np.sign(x) * np.mod(np.abs(x), np.pi)
+    # Wrapped difference between neighbouring pixels
+    gamma_mod = __wrap
 
     # H = gamma( Phi_I(-1, 0) - Phi_I(0, 0) ) - gamma( Phi_I(0, 0) - Phi_I(1, 0) )
     H  = gamma_mod(img_in1_j - img_i_j) - gamma_mod(img_i_j - img_ip1_j)
@@ -182,39 +146,24 @@ def __get_reliability_2d(img, relationship=None):
     rel = np.zeros_like(img)
     rel[1:-1, 1:-1] = relationship(D)
 
-    # Any NaNs in the non-border pixels reduce to 0
-    # TODO: Maybe consider putting this in the relationship function?
-    rel[np.isnan(rel)] = 0  # Set to NaNs to be unreliable
+    # Pixels next to NaNs (invalid regions) are unreliable
+    rel[np.isnan(rel)] = 0
 
     return rel
 
-def __print_edges(hori, vert):
-    hori2 = hori.tolist()
-    vert2 = vert.tolist()
-
-    rows = zip_longest(vert2, hori2, fillvalue=[])
-
-    for (v, h) in rows:
-        for x in v: print(f'\t{x:.2f}', end='\t')
-        print()
+def __get_edges_2d(rel, valid):
+    # Horizontal edges join (i, j) to (i, j + 1), vertical edges join (i, j) to (i + 1, j).
+    # Edges touching an invalid pixel are dropped entirely
+    h, w = rel.shape
 
-        for x in h: print(f'{x:.2f}\t', end='\t')
-        print()
+    idx = np.arange(h * w).reshape(h, w)
 
-def __get_edges_2d(rel):
-    # Image could be in a format such that width != height
-    # Therefore, need to pad edges with necessary nans so the
-    # the shape of vert matches hori
-    #
-    # This should be accounted for wherever the edges are used
-    x, y = rel.shape
+    hori = valid[:, 1:] & valid[:, :-1]
+    vert = valid[1:, :] & valid[:-1, :]
 
-    # [rel(2:end, 1:end) + rel(1:end-1, 1:end); nan(1, Nx)];
-    hori = np.array(rel[:, 1:] + rel[:, :-1])
-    vert = np.array(rel[1:, :] + rel[:-1, :])
+    idx1 = np.concatenate((idx[:, :-1][hori], idx[:-1, :][vert]))
+    idx2 = np.concatenate((idx[:, 1:][hori], idx[1:, :][vert]))
 
-    # These edges need to be padded before usage
-    hori = np.hstack((hori, np.full((x, 1), -1))).flatten()
-    vert = np.vstack((vert, np.full((1, y), -1))).flatten()
+    edges = np.concatenate(((rel[:, 1:] + rel[:, :-1])[hori], (rel[1:, :] + rel[:-1, :])[vert]))
 
-    return hori, vert
+    return idx1, idx2, edges
@@ -0,0 +1,122 @@
+import numpy as np
+
+from opensfdi.instrument import traced
+
+# Multi-frequency (temporal) phase unwrapping.
+#
+# Every pixel is unwrapped independently from the wrapped phases of several
+# fringe periods, so the cost is linear in the number of pixels and there is
+# no spatial path to break on discontinuous surfaces.
+#
+# Periods and orientation are given as for FringeFactory.MakeSinusoidal
+# (pixels per fringe, radians), whose patterns have phase 2π·g/period with
+# g = sin(orientation)·x - cos(orientation)·y over the phase map's pixels. The
+# phases must share that common zero at the origin; depending on the
+# orientation g is negative over part or all of the field, and the coarsest
+# phase is placed in the range g spans.
+#
+# * hierarchical: the coarsest period must span the whole field (at most one
+#   fringe, less COARSE_MARGIN); each finer phase is unwrapped from the next
+#   coarser one.
+# * heterodyne: beat phases of neighbouring periods are formed repeatedly until
+#   a single beat spans the field, then unwrapped hierarchically back down.
+
+# Noise allowance (radians) either side of the coarsest phase's range over the field
+COARSE_MARGIN = 0.05
+
+@traced('unwrap.temporal', pixels=lambda phases, *args, **kwargs: np.size(phases))
+def unwrap_phase(phases, periods, orientation, method='hierarchical'):
+    ''' Unwrap a (K, H, W) stack of wrapped phases, one per fringe period, of fringes at orientation.
+
+        Returns the unwrapped phase of the finest (smallest) period.
+    '''
+    phases = np.asarray(phases)
+    periods = np.asarray(periods, dtype=np.float64)
+
+    if phases.ndim < 2 or phases.shape[0] != periods.size:
+        raise Exception(f"Expected one wrapped phase per period ({periods.size} periods, {phases.shape[0]} phases)")
+
+    if periods.size < 2:
+        raise Exception("At least two fringe periods are needed for temporal unwrapping")
+
+    if np.unique(periods).size != periods.size:
+        raise Exception("Fringe periods must be distinct")
+
+    order = np.argsort(periods)
+    field = __field(orientation, *phases.shape[-2:])
+
+    if method == 'hierarchical':
+        return __hierarchical(phases[order[::-1]], periods[order[::-1]], field)
+
+    if method == 'heterodyne':
+        return __heterodyne(phases[order], periods[order], field)
+
+    raise Exception(f"Unknown temporal unwrapping method '{method}'")
+
+def __wrap(x):
+    # Wrap values into [-pi, pi)
+    return x - (2.0 * np.pi) * np.floor((x + np.pi) / (2.0 * np.pi))
+
+def __field(orientation, height, width):
+    # Range of the fringe coordinate g over the field (g is 0 at the origin and linear in x and y)
+    gx = np.sin(orientation) * (width - 1)
+    gy = -np.cos(orientation) * (height - 1)
+
+    return min(0.0, gx) + min(0.0, gy), max(0.0, gx) + max(0.0, gy)
+
+def __unwrap_coarse(wrapped, period, field):
+    # The coarsest phase covers a single period, from its lowest value over the field
+    lowest, highest = (2.0 * np.pi * g / period for g in field)
+
+    if 2.0 * np.pi - 2.0 * COARSE_MARGIN < highest - lowest:
+        raise Exception(f"The coarsest period ({period:g} pixels) does not span the field at this orientation ({(field[1] - field[0]):.1f} pixels)")
+
+    start = lowest - COARSE_MARGIN
+
+    return (np.mod(wrapped - start, 2.0 * np.pi) + start).astype(wrapped.dtype, copy=False)
+
+def __unwrap_with(coarse, coarse_period, wrapped, period):
+    # Fringe order of each pixel from the scaled coarse (already unwrapped) phase
+    k = np.rint((coarse * (coarse_period / period) - wrapped) / (2.0 * np.pi))
+
+    return (wrapped + (2.0 * np.pi) * k).astype(wrapped.dtype, copy=False)
+
+def __hierarchical(phases, periods, field):
+    # Coarse to fine, the coarsest phase is unambiguous over the field
+    unwrapped = __unwrap_coarse(phases[0], periods[0], field)
+
+    for i in range(1, periods.size):
+        unwrapped = __unwrap_with(unwrapped, periods[i - 1], phases[i], periods[i])
+
+    return unwrapped
+
+def __heterodyne(phases, periods, field):
+    # Fine to coarse: beat neighbouring periods until only one remains
+    levels = [(phases, periods)]
+
+    while 1 < periods.size:
+        beats = __wrap(phases[:-1] - phases[1:]).astype(phases.dtype, copy=False)
+        periods = (periods[:-1] * periods[1:]) / (periods[1:] - periods[:-1])
+
+        phases = beats
+        levels.append((phases, periods))
+
+    coarse_period = levels[-1][1][0]
+    unwrapped = __unwrap_coarse(levels[-1][0][0], coarse_period, field)
+
+    # Unwrap back down through the finest member of every level
+    for phases, periods in reversed(levels[:-1]):
+        unwrapped = __unwrap_with(unwrapped, coarse_period, phases[0], periods[0])
+        coarse_period = periods[0]
+
+    return unwrapped
+
+class TemporalUnwrapper:
+    ''' Callable unwrapper for PhaseHeight when measuring with multiple fringe periods. '''
+    def __init__(self, periods, orientation, method='hierarchical'):
+        self.periods = list(periods)
+        self.orientation = float(orientation)
+        self.method = method
+
+    def __call__(self, phases):
+        return unwrap_phase(phases, self.periods, self.orientation, self.method)
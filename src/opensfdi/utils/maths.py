@@ -1,5 +1,189 @@
 import numpy as np
 
+from functools import lru_cache
+
+from opensfdi.utils.precision import get_precision
+
+# Number of pixels demodulated per block (keeps the scratch buffers cache-sized)
+DEMOD_BLOCK = 1 << 16
+
+def phase_weights(n, dtype=None):
+    ''' Demodulation weights for an n-step phase shift as a read-only (3, n) array of dtype
+        (the compute precision by default).
+
+        Rows are sin(2πi/n), cos(2πi/n) and 1/n, so a single matrix product with an
+        (n, pixels) stack yields the p and q sums and the mean intensity.
+    '''
+    return __phase_weights(n, np.dtype(get_precision() if dtype is None else dtype).str)
+
+@lru_cache(maxsize=None)
+def __phase_weights(n, dtype):
+    if n < 3: raise Exception(f"At least 3 phase steps are needed to demodulate ({n} provided)")
+
+    shifts = (2.0 * np.pi * np.arange(n)) / n
+
+    weights = np.empty((3, n), dtype=dtype)
+    weights[0] = np.sin(shifts)
+    weights[1] = np.cos(shifts)
+    weights[2] = 1.0 / n
+
+    weights.flags.writeable = False
+
+    return weights
+
+def demodulate(imgs, out=None, workspace=None):
+    ''' Demodulate an (N, H, W[, C]) phase-shifted stack in a single pass.
+
+        Integer stacks (uint8/uint16) are accepted as-is and converted block by block.
+        Returns (wrapped phase, AC modulation, DC background) as arrays of shape
+        imgs.shape[1:] in the compute precision (float32 by default). A tuple of three
+        C-contiguous arrays of that dtype can be passed as out to avoid allocating the results,
+        and a Workspace (opensfdi.workspace) to reuse the block scratch buffers.
+    '''
+    imgs = np.asarray(imgs)
+
+    n = imgs.shape[0]
+    shape = imgs.shape[1:]
+
+    dtype = get_precision()
+    weights = phase_weights(n, dtype)
+
+    if out is None:
+        out = tuple(np.empty(shape, dtype=dtype) for _ in range(3))
+
+    phase, ac, dc = out
+
+    for x in out:
+        if x.shape != shape or x.dtype != dtype or not x.flags.c_contiguous:
+            raise Exception(f"Output buffers must be C-contiguous {dtype.name} arrays of shape {shape}")
+
+    stack = imgs.reshape(n, -1)
+    phase_flat, ac_flat, dc_flat = phase.reshape(-1), ac.reshape(-1), dc.reshape(-1)
+
+    pixels = stack.shape[1]
+    block = min(DEMOD_BLOCK, pixels)
+
+    if workspace is None:
+        sums = np.empty((3, block), dtype=dtype)
+        scratch = None if stack.dtype == dtype else np.empty((n, block), dtype=dtype)
+    else:
+        sums = workspace.get('demod_sums', (3, block), dtype)
+        scratch = None if stack.dtype == dtype else workspace.get('demod_scratch', (n, block), dtype)
+
+    for start in range(0, pixels, block):
+        stop = min(start + block, pixels)
+        size = stop - start
+
+        chunk = stack[:, start:stop]
+
+        if scratch is not None:
+            np.copyto(scratch[:, :size], chunk, casting='unsafe')
+            chunk = scratch[:, :size]
+
+        p, q, mean = np.matmul(weights, chunk, out=sums[:, :size])
+
+        np.arctan2(p, q, out=phase_flat[start:stop])
+        np.negative(phase_flat[start:stop], out=phase_flat[start:stop])
+
+        np.hypot(p, q, out=ac_flat[start:stop])
+        ac_flat[start:stop] *= 2.0 / n
+
+        dc_flat[start:stop] = mean
+
+    return phase, ac, dc
+
+class RollingDemodulator:
+    ''' Sliding-window demodulation of a continuous n-step fringe stream.
+
+        Frames are pushed with their phase step index (FringeProjector.current when they were
+        captured). The last frame of every index is kept, and the p/q/mean sums are updated by the
+        difference between the incoming and outgoing frame of that index, so once all n indices
+        have been seen a phase map is available after every frame at the cost of one frame.
+        The sums are rebuilt from the window every refresh frames to bound rounding drift.
+    '''
+    def __init__(self, n, refresh=None):
+        self.n = n
+        self.weights = phase_weights(n)
+        self.refresh = 64 * n if refresh is None else refresh
+
+        self.shape = None
+        self.reset()
+
+    def reset(self):
+        ''' Start a new window (frames pushed before are forgotten). '''
+        self.filled = np.zeros(self.n, dtype=bool)
+        self.frames = 0
+
+        if self.shape is not None:
+            self.window.fill(0)
+            self.sums.fill(0)
+
+    @property
+    def ready(self):
+        return bool(self.filled.all())
+
+    def push(self, frame, index):
+        ''' Replace the window's frame for phase step index with frame (any shape, fixed per stream). '''
+        frame = np.asarray(frame)
+
+        if frame.shape != self.shape:
+            self.__allocate(frame.shape)
+
+        index %= self.n
+        slot, new = self.window[index].reshape(-1), frame.reshape(-1)
+
+        if self.filled[index]:
+            np.subtract(new, slot, out=self.delta, casting='unsafe')
+        else:
+            np.copyto(self.delta, new, casting='unsafe')
+
+        np.copyto(slot, new, casting='unsafe')
+        self.filled[index] = True
+        self.frames += 1
+
+        if self.frames % self.refresh == 0 and self.ready:
+            np.matmul(self.weights, self.window.reshape(self.n, -1), out=self.sums)
+            return
+
+        for row, weight in zip(self.sums, self.weights[:, index]):
+            np.multiply(self.delta, weight, out=self.scratch)
+            row += self.scratch
+
+    def result(self, out=None):
+        ''' (wrapped phase, AC, DC) of the current window, like demodulate. Without out the arrays
+            are the demodulator's own buffers, overwritten by the next call.
+        '''
+        if not self.ready:
+            raise Exception(f"Only {int(self.filled.sum())} of {self.n} phase steps have been pushed")
+
+        phase, ac, dc = self.out if out is None else out
+
+        # Shape the (contiguous) sums like the frames rather than flattening out, which may be a strided view
+        p, q, mean = self.sums.reshape(3, *self.shape)
+
+        np.arctan2(p, q, out=phase)
+        np.negative(phase, out=phase)
+
+        np.hypot(p, q, out=ac)
+        ac *= 2.0 / self.n
+
+        dc[...] = mean
+
+        return phase, ac, dc
+
+    def __allocate(self, shape):
+        dtype = self.weights.dtype
+        pixels = int(np.prod(shape))
+
+        self.shape = shape
+        self.window = np.zeros((self.n, *shape), dtype=dtype)
+        self.sums = np.zeros((3, pixels), dtype=dtype)
+        self.delta = np.empty(pixels, dtype=dtype)
+        self.scratch = np.empty(pixels, dtype=dtype)
+        self.out = tuple(np.empty(shape, dtype=dtype) for _ in range(3))
+
+        self.reset()
+
 # Demodulation (array input)
 def AC(imgs: list):
     return (2 ** 0.5 / 3) * (((imgs[0] - imgs[1]) ** 2 + (imgs[1] - imgs[2]) ** 2 + (imgs[2] - imgs[0]) ** 2) ** 0.5)
@@ -15,4 +199,4 @@ def diffusion_approximation(A, ap, mu_tr, f_ac):
     r_ac = (3 * A * ap) / (((2 * np.pi * f_ac) / mu_tr) ** 2 + ((2 * np.pi * f_ac) / mu_tr) * (1 + 3 * A) + 3 * A)
     r_dc = (3 * A * ap) / (3 * (1 - ap) + (1 + 3 * A) * np.sqrt(3 * (1 - ap)) + 3 * A)
 
-    return r_ac, r_dc
\ No newline at end of file
+    return r_ac, r_dc
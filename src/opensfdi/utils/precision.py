@@ -0,0 +1,27 @@
+import os
+
+import numpy as np
+
+# Floating point type that opensfdi computes in. float32 halves memory traffic and is accurate enough
+# for fringe analysis; float64 can be opted into (e.g. for reference runs) with set_precision or
+# OPENSFDI_PRECISION=float64
+PRECISIONS = ('float32', 'float64')
+
+def set_precision(dtype):
+    global _dtype
+
+    dtype = np.dtype(dtype)
+
+    if dtype.name not in PRECISIONS:
+        raise Exception(f"Unsupported compute precision '{dtype.name}' ({', '.join(PRECISIONS)})")
+
+    _dtype = dtype
+
+def get_precision():
+    return _dtype
+
+def as_float(x):
+    ''' x as an array of the compute precision, without copying when it already is one. '''
+    return np.asarray(x, dtype=_dtype)
+
+set_precision(os.environ.get('OPENSFDI_PRECISION', 'float32'))
@@ -1,8 +1,13 @@
 
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, wait
+from time import time, perf_counter, sleep
 
+import os
 import logging
-import cv2
+import queue
+import threading
+import numpy as np
 
 class Projector(ABC):
     @abstractmethod
@@ -56,6 +61,11 @@ class FringeProjector(Projector):
 
         if reset: self.current = 0
 
+    def set_frequency(self, frequency, reset=True):
+        self.frequency = frequency
+
+        if reset: self.current = 0
+
     def next(self):
         self.current = (self.current + 1) % len(self.phases)
 
@@ -77,32 +87,118 @@ class Camera(ABC):
     
     def set_resolution(self, res):
         self.resolution = res
+        self._undistort_maps = None
+
+    @property
+    def cam_mat(self):
+        return self._cam_mat
+
+    @cam_mat.setter
+    def cam_mat(self, value):
+        self._cam_mat = value
+        self._undistort_maps = None
+
+    @property
+    def dist_mat(self):
+        return self._dist_mat
+
+    @dist_mat.setter
+    def dist_mat(self, value):
+        self._dist_mat = value
+        self._undistort_maps = None
+
+    @property
+    def optimal_mat(self):
+        return self._optimal_mat
+
+    @optimal_mat.setter
+    def optimal_mat(self, value):
+        self._optimal_mat = value
+        self._undistort_maps = None
+
+    def has_calibration(self):
+        return self.cam_mat is not None and self.dist_mat is not None and self.optimal_mat is not None
+
+    def undistort_maps(self, size=None):
+        ''' Fixed-point (CV_16SC2 + interpolation table) remap maps for an image of size (w, h),
+            defaulting to the camera resolution. Built once and reused until the size or matrices change.
+        '''
+        if not self.has_calibration():
+            raise Exception(f"{self.name} has no lens calibration to undistort with")
+
+        size = tuple(self.resolution if size is None else size)
+
+        maps = getattr(self, '_undistort_maps', None)
+        if maps is None or maps[0] != size:
+            import cv2
+
+            self.logger.debug(f'Building undistortion maps for {self.name} at {size[0]}x{size[1]}')
+
+            map1, map2 = cv2.initUndistortRectifyMap(self.cam_mat, self.dist_mat, None, self.optimal_mat, size, cv2.CV_16SC2)
+            self._undistort_maps = maps = (size, map1, map2)
+
+        return maps[1], maps[2]
+
+    def save_undistort_maps(self, path, size=None):
+        size = tuple(self.resolution if size is None else size)
+        map1, map2 = self.undistort_maps(size)
+
+        with open(path, 'wb') as outfile:
+            np.savez(outfile, size=size, map1=map1, map2=map2, cam_mat=self.cam_mat, dist_mat=self.dist_mat, optimal_mat=self.optimal_mat)
+
+    def load_undistort_maps(self, path):
+        ''' Use maps saved by save_undistort_maps. Returns False (and keeps the current maps) when
+            the file is missing or was built from different calibration matrices.
+        '''
+        if not (self.has_calibration() and os.path.exists(path)): return False
+
+        with np.load(path) as data:
+            for key in ('cam_mat', 'dist_mat', 'optimal_mat'):
+                if not np.array_equal(data[key], np.asarray(getattr(self, key))):
+                    self.logger.warning(f'Ignoring undistortion maps {path} built for a different calibration')
+                    return False
+
+            self._undistort_maps = (tuple(int(x) for x in data['size']), data['map1'], data['map2'])
+
+        return True
+
+    def try_undistort_img(self, img, out=None):
+        if self.has_calibration():
+            h, w = img.shape[:2]
+            map1, map2 = self.undistort_maps((w, h))
+
+            import cv2
 
-    def try_undistort_img(self, img):
-        if self.cam_mat is not None and self.dist_mat is not None and self.optimal_mat is not None:
-            self.logger.debug('Undistorting camera image...')
-            return cv2.undistort(img, self.cam_mat, self.dist_mat, None, self.optimal_mat)
+            return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=out)
+
+        if out is not None:
+            np.copyto(out, img)
+            return out
         
         return img
 
 class FakeCamera(Camera):
-    def __init__(self, imgs=[], name='Camera1', cam_mat=None, dist_mat = None, optimal_mat=None):
-        super().__init__(name='Camera1', cam_mat=cam_mat, dist_mat=dist_mat, optimal_mat=optimal_mat)
+    def __init__(self, imgs=None, name='Camera1', cam_mat=None, dist_mat = None, optimal_mat=None, loop=True):
+        super().__init__(name=name, cam_mat=cam_mat, dist_mat=dist_mat, optimal_mat=optimal_mat)
         
         self.img_num = 0
+        self.loop = loop
 
-        self.imgs = imgs
+        self.imgs = [] if imgs is None else list(imgs)
 
     def capture(self):
-        img = next(self.imgs)
-        
-        if not self.loop and len(self.imgs) <= self.img_num:
+        if len(self.imgs) <= self.img_num:
+            if not self.loop or len(self.imgs) == 0:
+                self.img_num = 0
+                return None
+
             self.img_num = 0
-            return None
+
+        img = self.imgs[self.img_num]
         
         self.img_num += 1
         
-        self.logger.info(f'Returning an image')
+        self.logger.debug(f'Returning image {self.img_num} of {len(self.imgs)}')
 
         return img
     
@@ -110,13 +206,235 @@ class FakeCamera(Camera):
         return iter(self.imgs)
 
     def add_image(self, img):
-        self._images.append(img)
+        self.imgs.append(img)
         return self
 
 class FileCamera(FakeCamera):
     def __init__(self, img_paths, name='Camera1', cam_mat=None, dist_mat = None, optimal_mat=None):
-        super().__init__(name='Camera1', cam_mat=cam_mat, dist_mat=dist_mat, optimal_mat=optimal_mat)
+        super().__init__(name=name, cam_mat=cam_mat, dist_mat=dist_mat, optimal_mat=optimal_mat)
         
+        import cv2
+
         # Load all images into memory
         for path in img_paths:
-            self.imgs.append(cv2.imread(path, 1))
\ No newline at end of file
+            self.imgs.append(cv2.imread(path, 1))
+
+class SyntheticCamera(Camera):
+    ''' Renders the projector's current fringe pattern as seen on a surface of known height.
+
+        Uses the inverse of the ClassicPhaseHeight model: a height h shifts the fringe phase by
+        2π·p·d·h / (h - l), where p = 1 / projector.frequency, d is the camera to reference plane
+        distance and l the camera to projector distance. heightmap=None is the flat reference plane.
+        Frames are intensity ac·cos(phase + shift) + dc raised to gamma, plus Gaussian noise of
+        standard deviation noise, in dtype (floats in [0, 1], integers scaled to their full range).
+        The phase map is cached per (frequency, orientation, surface), so each frame is one cosine.
+        frame_rate limits the frames per second; None renders as fast as frames are requested.
+    '''
+    def __init__(self, projector, heightmap=None, plane_dist=100.0, proj_dist=200.0, resolution=(1280, 720), name='Camera1',
+                 noise=0.0, gamma=1.0, dc=0.5, ac=0.5, dtype=np.float32, channels=3, frame_rate=None, seed=None):
+        super().__init__(resolution=resolution, name=name)
+
+        self.projector = projector
+
+        self.plane_dist = plane_dist
+        self.proj_dist = proj_dist
+
+        self.noise = noise
+        self.gamma = gamma
+        self.dc = dc
+        self.ac = ac
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        self.frame_rate = frame_rate
+
+        self._rng = np.random.default_rng(seed)
+        self._phase_key = self._phase = None
+        self._next_frame = 0.0
+
+        self.set_heightmap(heightmap)
+
+    def set_heightmap(self, heightmap):
+        w, h = self.resolution
+
+        if heightmap is not None:
+            heightmap = np.asarray(heightmap, dtype=np.float32)
+
+            if heightmap.shape != (h, w):
+                raise Exception(f"Heightmap shape {heightmap.shape} does not match the camera resolution {w}x{h}")
+
+        self.heightmap = heightmap
+        self._phase_key = None
+
+    def set_resolution(self, res):
+        super().set_resolution(res)
+
+        if self.heightmap is not None and self.heightmap.shape != (res[1], res[0]):
+            self.heightmap = None
+            self.logger.warning(f'{self.name} heightmap cleared by the change of resolution')
+
+        self._phase_key = None
+
+    def phase_map(self):
+        ''' Fringe phase (without the step shift) at every pixel, for the current projector frequency. '''
+        frequency, orientation = self.projector.frequency, self.projector.orientation
+        key = (frequency, orientation, tuple(self.resolution))
+
+        if self._phase_key != key:
+            w, h = self.resolution
+            x = np.arange(w, dtype=np.float32)[None, :]
+            y = np.arange(h, dtype=np.float32)[:, None]
+
+            # Same layout as FringeFactory.MakeSinusoidal
+            gradient = np.float32(np.sin(orientation)) * x - np.float32(np.cos(orientation)) * y
+            phase = np.float32(2.0 * np.pi / frequency) * gradient
+
+            if self.heightmap is not None:
+                p = 1.0 / frequency
+                phase = phase + np.float32(2.0 * np.pi * p * self.plane_dist) * self.heightmap / (self.heightmap - np.float32(self.proj_dist))
+
+            self._phase_key, self._phase = key, phase.astype(np.float32, copy=False)
+
+        return self._phase
+
+    def capture(self):
+        if self.frame_rate:
+            delay = self._next_frame - perf_counter()
+            if 0.0 < delay: sleep(delay)
+
+            self._next_frame = max(self._next_frame, perf_counter()) + 1.0 / self.frame_rate
+
+        img = np.add(self.phase_map(), np.float32(self.projector.get_phase()))
+        np.cos(img, out=img)
+        img *= np.float32(self.ac)
+        img += np.float32(self.dc)
+
+        if self.gamma != 1.0:
+            np.clip(img, 0.0, 1.0, out=img)
+            np.power(img, np.float32(self.gamma), out=img)
+
+        if 0.0 < self.noise:
+            img += self._rng.standard_normal(img.shape, dtype=np.float32) * np.float32(self.noise)
+
+        if np.issubdtype(self.dtype, np.integer):
+            top = np.iinfo(self.dtype).max
+            np.clip(img, 0.0, 1.0, out=img)
+            img = np.rint(img * np.float32(top)).astype(self.dtype)
+        elif self.dtype != img.dtype:
+            img = img.astype(self.dtype)
+
+        if self.channels is None: return img
+
+        out = np.empty((*img.shape, self.channels), dtype=img.dtype)
+        out[...] = img[..., None]
+
+        return out
+
+class _CaptureWorker:
+    # A camera's capture thread. Unlike ThreadPoolExecutor's workers, which the interpreter joins at
+    # exit, it is a daemon, so a camera whose read never returns cannot keep the process alive
+    def __init__(self, name):
+        self._jobs = queue.SimpleQueue()
+
+        threading.Thread(target=self.__run, name=name, daemon=True).start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._jobs.put((future, fn, args))
+
+        return future
+
+    def shutdown(self):
+        self._jobs.put(None)
+
+    def __run(self):
+        while (job := self._jobs.get()) is not None:
+            future, fn, args = job
+
+            if not future.set_running_or_notify_cancel(): continue
+
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+class CaptureCoordinator:
+    ''' Captures from several cameras at once.
+
+        Every camera's capture runs on its own thread; the threads wait on a barrier so the captures
+        are released together. Each frame's completion time (time.time()) is kept in timestamps,
+        and a camera that does not return within timeout seconds raises an exception naming it.
+        Each camera has its own worker, so a camera whose capture hangs only holds up itself: later
+        captures report it as busy until its call returns. close() (or leaving a with block) stops
+        the workers.
+    '''
+    def __init__(self, cameras, timeout=10.0):
+        self.logger = logging.getLogger('opensfdi')
+
+        self.cameras = cameras
+        self.timeout = timeout
+
+        self.timestamps = []
+
+        self._workers = [_CaptureWorker(f'capture{i}') for i in range(len(cameras))]
+        self._pending = [None] * len(cameras)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def capture(self):
+        if self._workers is None:
+            raise Exception("The capture coordinator has been closed")
+
+        busy = [camera.name for camera, future in zip(self.cameras, self._pending) if future is not None and not future.done()]
+
+        if busy:
+            raise Exception(f"{', '.join(busy)} still capturing from an earlier call that timed out")
+
+        barrier = threading.Barrier(len(self.cameras))
+
+        self._pending = [worker.submit(self.__capture, camera, barrier) for worker, camera in zip(self._workers, self.cameras)]
+
+        _, not_done = wait(self._pending, timeout=self.timeout)
+
+        if not_done:
+            barrier.abort()
+
+            late = [camera.name for camera, future in zip(self.cameras, self._pending) if future in not_done]
+            raise Exception(f"{', '.join(late)} did not capture within {self.timeout}s")
+
+        imgs = []
+        self.timestamps = []
+
+        for camera, future in zip(self.cameras, self._pending):
+            try:
+                img, timestamp = future.result()
+            except threading.BrokenBarrierError:
+                raise Exception(f"{camera.name} was not released to capture within {self.timeout}s")
+            except Exception as e:
+                raise Exception(f"{camera.name} failed to capture: {e}") from e
+
+            imgs.append(img)
+            self.timestamps.append(timestamp)
+
+        self.logger.debug(f'Captured {len(imgs)} frames with {max(self.timestamps) - min(self.timestamps):.4f}s skew')
+
+        return imgs
+
+    def close(self):
+        if self._workers is None: return
+
+        for worker, future in zip(self._workers, self._pending):
+            if future is not None: future.cancel()
+            worker.shutdown()
+
+        self._workers = None
+
+    def __capture(self, camera, barrier):
+        barrier.wait(self.timeout)
+
+        img = camera.capture()
+
+        return img, time()
@@ -0,0 +1,32 @@
+import numpy as np
+
+from opensfdi.utils.precision import get_precision
+
+class Workspace:
+    ''' Preallocated scratch and result buffers for repeated reconstructions of the same shape.
+
+        Buffers are keyed by (name, shape, dtype) and handed out again on every later request, so
+        once a reconstruction has run (warm-up) repeating it allocates nothing. Buffers returned
+        by a call that uses a workspace are overwritten by the next call: copy anything that must
+        outlive it. A workspace is not thread-safe; give each worker thread its own.
+    '''
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=None):
+        ''' The buffer for name with this shape and dtype (default: the compute precision). '''
+        key = (name, tuple(shape), np.dtype(get_precision() if dtype is None else dtype).str)
+
+        buf = self._buffers.get(key)
+
+        if buf is None:
+            buf = self._buffers[key] = np.empty(key[1], dtype=key[2])
+
+        return buf
+
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self._buffers.values())
+
+    def clear(self):
+        self._buffers.clear()
@@ -0,0 +1,42 @@
+import unittest
+
+import cv2
+import numpy as np
+
+from opensfdi.calibration import CameraCalibration
+from opensfdi.video import FakeCamera
+
+def checkerboard_image(width, height, squares=(8, 6), square=120, angle=0.0):
+    board = np.kron((np.indices(squares[::-1]).sum(axis=0) % 2), np.ones((square, square)))
+    board = np.pad(board * 255, square, constant_values=255).astype(np.uint8)
+
+    bh, bw = board.shape
+    src = np.float32([[0, 0], [bw, 0], [bw, bh], [0, bh]])
+
+    c, s = np.cos(angle), np.sin(angle)
+    pts = np.float32([[-bw / 2, -bh / 2], [bw / 2, -bh / 2], [bw / 2, bh / 2], [-bw / 2, bh / 2]]) * 0.9
+    dst = (pts @ np.float32([[c, s], [-s, c]])) + np.float32([width / 2, height / 2])
+    dst[1] += (40, 20)
+
+    img = cv2.warpPerspective(board, cv2.getPerspectiveTransform(src, dst), (width, height), borderValue=255)
+    img = cv2.GaussianBlur(img, (5, 5), 1.0)
+
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+class TestCheckerboardDetection(unittest.TestCase):
+    def test_parallel_matches_serial(self):
+        imgs = [checkerboard_image(1600, 1200, angle=a) for a in (0.0, 0.1, -0.15)]
+        imgs.append(np.full((1200, 1600, 3), 128, dtype=np.uint8)) # No board
+
+        serial = CameraCalibration(FakeCamera(), workers=1, max_detect_size=4096)
+        parallel = CameraCalibration(FakeCamera(), workers=2, max_detect_size=512)
+
+        expected = serial.detect(imgs)
+        found = parallel.detect(imgs)
+
+        self.assertEqual(serial.failures, [3])
+        self.assertEqual(parallel.failures, [3])
+
+        for a, b in zip(expected[:3], found[:3]):
+            self.assertEqual(a.shape, b.shape)
+            self.assertLess(np.abs(a - b).max(), 0.1)
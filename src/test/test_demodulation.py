@@ -0,0 +1,136 @@
+import unittest
+
+import numpy as np
+
+from opensfdi.utils.maths import demodulate, phase_weights, RollingDemodulator
+
+
+def reference_demodulate(imgs):
+    N = len(imgs)
+
+    p = np.zeros(imgs[0].shape, dtype=np.float64)
+    q = np.zeros(imgs[0].shape, dtype=np.float64)
+
+    for i, img in enumerate(imgs):
+        phase = (2.0 * np.pi * i) / N
+        p += img * np.sin(phase)
+        q += img * np.cos(phase)
+
+    return -np.arctan2(p, q), (2.0 / N) * np.sqrt(p * p + q * q), np.mean(imgs, axis=0)
+
+
+class TestDemodulation(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+
+        self.N = 6
+        h, w = 67, 45
+
+        truth = rng.uniform(-np.pi, np.pi, (h, w))
+        shifts = (2.0 * np.pi * np.arange(self.N)) / self.N
+
+        self.imgs = (0.5 + 0.4 * np.cos(truth[None] + shifts[:, None, None])).astype(np.float32)
+
+    def test_matches_reference(self):
+        phase, ac, dc = demodulate(self.imgs)
+        r_phase, r_ac, r_dc = reference_demodulate(self.imgs)
+
+        for x in (phase, ac, dc): self.assertEqual(x.dtype, np.float32)
+
+        np.testing.assert_allclose(phase, r_phase, atol=1e-4)
+        np.testing.assert_allclose(ac, r_ac, atol=1e-5)
+        np.testing.assert_allclose(dc, r_dc, atol=1e-5)
+
+    def test_integer_stack(self):
+        imgs = np.round(self.imgs * 65535.0).astype(np.uint16)
+
+        phase, ac, dc = demodulate(imgs)
+        r_phase, r_ac, r_dc = reference_demodulate(imgs.astype(np.float64))
+
+        np.testing.assert_allclose(phase, r_phase, atol=1e-4)
+        np.testing.assert_allclose(ac, r_ac, rtol=1e-5)
+        np.testing.assert_allclose(dc, r_dc, rtol=1e-5)
+
+    def test_out_buffers(self):
+        out = tuple(np.empty(self.imgs.shape[1:], dtype=np.float32) for _ in range(3))
+
+        result = demodulate(self.imgs, out=out)
+
+        for a, b in zip(result, out): self.assertIs(a, b)
+
+        with self.assertRaises(Exception):
+            demodulate(self.imgs, out=tuple(np.empty((2, 2), dtype=np.float32) for _ in range(3)))
+
+    def test_weights_cached(self):
+        self.assertIs(phase_weights(self.N), phase_weights(self.N))
+        self.assertFalse(phase_weights(self.N).flags.writeable)
+
+
+class TestRollingDemodulator(unittest.TestCase):
+
+    def test_matches_window(self):
+        rng = np.random.default_rng(1)
+        n, h, w = 4, 23, 31
+
+        demod = RollingDemodulator(n, refresh=7)
+        window = np.zeros((n, h, w), dtype=np.float32)
+
+        for i, index in enumerate(rng.integers(0, n, 40)):
+            frame = rng.integers(0, 255, (h, w), dtype=np.uint8)
+            window[index] = frame
+
+            demod.push(frame, index)
+
+            if not demod.ready:
+                self.assertRaises(Exception, demod.result)
+                continue
+
+            (phase, ac, dc), (r_phase, r_ac, r_dc) = demod.result(), demodulate(window)
+
+            np.testing.assert_allclose(np.angle(np.exp(1j * (phase - r_phase))), 0.0, atol=1e-3)
+            np.testing.assert_allclose(ac, r_ac, atol=1e-3)
+            np.testing.assert_allclose(dc, r_dc, atol=1e-3)
+
+    def test_result_buffers(self):
+        demod = RollingDemodulator(3)
+
+        for i in range(4): demod.push(np.full((2, 5, 3), i, dtype=np.uint16), i)
+
+        self.assertEqual(demod.result()[0].shape, (2, 5, 3))
+        self.assertIs(demod.result()[0], demod.result()[0])
+
+    def test_reset(self):
+        rng = np.random.default_rng(2)
+        n = 4
+
+        demod = RollingDemodulator(n)
+        for i in range(n): demod.push(rng.integers(0, 255, (6, 7), dtype=np.uint8), i)
+
+        demod.reset()
+        self.assertFalse(demod.ready)
+
+        window = rng.integers(0, 255, (n, 6, 7), dtype=np.uint8)
+        for i in range(n): demod.push(window[i], i)
+
+        (phase, ac, dc), (r_phase, r_ac, r_dc) = demod.result(), demodulate(window)
+
+        np.testing.assert_allclose(np.angle(np.exp(1j * (phase - r_phase))), 0.0, atol=1e-3)
+        np.testing.assert_allclose(ac, r_ac, atol=1e-3)
+        np.testing.assert_allclose(dc, r_dc, atol=1e-3)
+
+    def test_strided_out(self):
+        window = np.random.default_rng(3).integers(0, 255, (3, 6, 8), dtype=np.uint8)
+
+        demod = RollingDemodulator(3)
+        for i in range(3): demod.push(window[i], i)
+
+        # The left halves of wider arrays: views that cannot be flattened in place
+        out = [np.zeros((6, 16), dtype=np.float32)[:, :8] for _ in range(3)]
+        demod.result(out=out)
+
+        (phase, ac, dc), (r_phase, r_ac, r_dc) = out, demodulate(window)
+
+        np.testing.assert_allclose(np.angle(np.exp(1j * (phase - r_phase))), 0.0, atol=1e-3)
+        np.testing.assert_allclose(ac, r_ac, atol=1e-3)
+        np.testing.assert_allclose(dc, r_dc, atol=1e-3)
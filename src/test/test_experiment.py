@@ -1,5 +1,170 @@
+import os
+import tempfile
 import unittest
 
+import numpy as np
+
+from unittest import mock
+
+from opensfdi import definitions
+from opensfdi.services import CalibrationService
+from opensfdi.io.repositories import BinCalibrationRepo
+from opensfdi.experiment import LightCalc, FringeProjection, NStepFPExperiment
+from opensfdi.fringes import FringeFactory
+from opensfdi.utils.maths import demodulate
+from opensfdi.video import FringeProjector, FakeCamera, SyntheticCamera
+
+class DummyProjector(FringeProjector):
+    def __init__(self, phases=[0.0, 1.0, 2.0, 3.0]):
+        super().__init__('Projector1', 20, np.pi / 2.0, (200, 120), phases)
+
+    def display(self):
+        pass
+
 class TestExperiment(unittest.TestCase):
     def test_creation(self):
-        self.assertTrue(True)
\ No newline at end of file
+        self.assertTrue(True)
+
+class TestLightCalc(unittest.TestCase):
+    def test_lookup_inverts_forward_model(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(definitions, 'CALIBRATION_DIR', tmp):
+            LightCalc._luts.clear()
+
+            calc = LightCalc(0.01, 1.0, 1.43, lut_size=256)
+
+            rng = np.random.default_rng(0)
+            mu_a = rng.uniform(0.01, 0.4, (32, 48))
+            mu_sp = rng.uniform(0.5, 4.0, (32, 48))
+
+            mua_map, musp_map = calc.lookup(*calc.forward_model(mu_a, mu_sp))
+
+            self.assertEqual(mua_map.shape, mu_a.shape)
+            np.testing.assert_allclose(mua_map, mu_a, atol=5e-3)
+            np.testing.assert_allclose(musp_map, mu_sp, atol=2e-2)
+
+            # Cached on disk, keyed by refractive index and spatial frequencies
+            self.assertEqual(len(os.listdir(tmp)), 1)
+
+            LightCalc._luts.clear()
+            np.testing.assert_array_equal(calc.lookup_table()[2], LightCalc(0.02, 2.0, 1.43, lut_size=256).lookup_table()[2])
+
+    def test_interrupted_lookup_table(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(definitions, 'CALIBRATION_DIR', tmp):
+            LightCalc._luts.clear()
+
+            with mock.patch.object(np, 'savez', side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    LightCalc(0.01, 1.0, 1.43, lut_size=32).lookup_table()
+
+            # No truncated table for later runs to load
+            self.assertEqual(os.listdir(tmp), [])
+
+            LightCalc._luts.clear()
+
+class TestFringeProjection(unittest.TestCase):
+    def test_rolling_phase(self):
+        steps = 4
+        projector = DummyProjector([2.0 * np.pi * i / steps for i in range(steps)])
+        camera = SyntheticCamera(projector, resolution=(40, 30), dtype=np.uint8)
+
+        y, x = np.ogrid[-1.0:1.0:30j, -1.0:1.0:40j]
+        camera.set_heightmap(np.exp(-2.0 * (x * x + y * y)).astype(np.float32))
+
+        test = FringeProjection([camera], projector)
+
+        # Captured in projector order, so the window for frame i holds frames i - 3 to i
+        captured = []
+        frames = test.frames()
+        for _ in range(steps + 3):
+            index, imgs = next(frames)
+            self.assertEqual(index, len(captured) % steps)
+            captured.append(imgs[0])
+
+        projector.current = 0
+        results = test.rolling_phase(convert_grey=True)
+
+        for i in range(steps - 1, len(captured)):
+            window = [None] * steps
+            for j in range(i - steps + 1, i + 1): window[j % steps] = captured[j]
+
+            phase, ac, dc = next(results)[0]
+            expected = demodulate(np.mean(np.asarray(window, dtype=np.float32), axis=-1))[0]
+
+            np.testing.assert_allclose(np.angle(np.exp(1j * (phase - expected))), 0.0, atol=1e-3)
+
+class TestNStepFPExperiment(unittest.TestCase):
+    def test_cached_references(self):
+        steps = 4
+        projector = DummyProjector([2.0 * np.pi * i / steps for i in range(steps)])
+        camera = SyntheticCamera(projector, resolution=(40, 30), dtype=np.uint8)
+
+        y, x = np.ogrid[-1.0:1.0:30j, -1.0:1.0:40j]
+        heightmap = np.exp(-2.0 * (x * x + y * y)).astype(np.float32)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration = CalibrationService(BinCalibrationRepo(os.path.join(tmp, 'calibration.bin')))
+            experiment = NStepFPExperiment(FringeProjection([camera], projector), steps=steps, calibration=calibration)
+
+            flat, imgs = experiment.run()
+            self.assertIsNotNone(flat)
+
+            # Cached once a heightmap has been computed from the captured reference
+            experiment.classic_ph(flat, imgs, 20, [100.0], [200.0])
+
+            camera.set_heightmap(heightmap)
+            ref_imgs, imgs = experiment.run()
+            self.assertIsNone(ref_imgs)
+
+            expected = NStepFPExperiment(FringeProjection([camera], projector), steps=steps).classic_ph(flat, imgs, 20, [100.0], [200.0])[0]
+
+            for backend in ('serial', 'process'):
+                np.testing.assert_allclose(experiment.classic_ph(None, imgs, 20, [100.0], [200.0], backend=backend)[0], expected, atol=1e-5)
+
+            # A new session finds the reference through the calibration service
+            reopened = NStepFPExperiment(FringeProjection([camera], projector), steps=steps,
+                                         calibration=CalibrationService(BinCalibrationRepo(os.path.join(tmp, 'calibration.bin'))))
+            self.assertTrue(reopened.has_references())
+
+            # Changing the setup invalidates it
+            projector.set_phases(projector.phases + [0.0])
+            self.assertFalse(reopened.has_references())
+
+    def test_classic_ph_backends(self):
+        experiment = NStepFPExperiment(FringeProjection([FakeCamera()], DummyProjector()), steps=4)
+
+        ref_imgs = FringeFactory.MakeSinusoidalRGB(20, 4, np.pi / 2.0, 200, 120)
+        imgs = FringeFactory.MakeSinusoidalRGB(18, 4, np.pi / 2.0, 200, 120)
+
+        cameras = 3
+        ref_imgs, imgs = np.stack([ref_imgs] * cameras), np.stack([imgs] * cameras)
+
+        args = (ref_imgs, imgs, 20, [1.0] * cameras, [2.0] * cameras)
+
+        expected = experiment.classic_ph(*args)
+
+        for backend in ('thread', 'process'):
+            result = experiment.classic_ph(*args, backend=backend, workers=2)
+
+            self.assertEqual(len(result), cameras)
+            self.assertEqual(len(experiment.timings), cameras)
+
+            for a, b in zip(result, expected):
+                np.testing.assert_array_equal(a, b)
+
+        with self.assertRaises(Exception):
+            experiment.classic_ph(*args, backend='gpu')
+
+    def test_heightmap_stages_match_classic_ph(self):
+        experiment = NStepFPExperiment(FringeProjection([FakeCamera()], DummyProjector()), steps=4)
+
+        ref_imgs = np.stack([FringeFactory.MakeSinusoidalRGB(20, 4, np.pi / 2.0, 200, 120)] * 2)
+        imgs = np.stack([FringeFactory.MakeSinusoidalRGB(18, 4, np.pi / 2.0, 200, 120)] * 2)
+
+        args = (20, [1.0, 1.5], [2.0, 2.5])
+
+        result = (ref_imgs, imgs)
+        for _, stage in experiment.heightmap_stages(*args):
+            result = stage(result)
+
+        for a, b in zip(result, experiment.classic_ph(ref_imgs, imgs, *args)):
+            np.testing.assert_allclose(a, b, atol=1e-6)
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from unittest import mock
+
+from opensfdi import definitions
+from opensfdi.fringes import FringeFactory
+from opensfdi.utils.maths import demodulate
+
+class TestFringeFactory(unittest.TestCase):
+    def setUp(self):
+        FringeFactory.clear_cache()
+
+    def test_sinusoidal_phase(self):
+        imgs = FringeFactory.MakeSinusoidal(16, 4, np.pi / 2.0, 64, 8)
+
+        self.assertEqual(imgs.shape, (4, 8, 64))
+        self.assertEqual(imgs.dtype, np.float32)
+
+        x = np.arange(64, dtype=np.float32)
+        expected = np.angle(np.exp(1j * (2.0 * np.pi * x / 16)))
+
+        phase = demodulate(imgs)[0]
+        np.testing.assert_allclose(np.angle(np.exp(1j * (phase - expected))), 0.0, atol=1e-4)
+
+    def test_binary_and_integer(self):
+        sinusoidal = FringeFactory.MakeSinusoidal(16, 3, 0.3, 40, 30)
+        binary = FringeFactory.MakeBinary(16, 3, 0.3, 40, 30, dtype=np.uint8)
+
+        self.assertEqual(binary.dtype, np.uint8)
+        np.testing.assert_array_equal(binary, np.where(sinusoidal < 0.5, 0, 255))
+
+    def test_cached_read_only(self):
+        a = FringeFactory.MakeSinusoidal(16, 3, 0.3, 40, 30)
+
+        self.assertIs(a, FringeFactory.MakeSinusoidal(16, 3, 0.3, 40, 30))
+        self.assertFalse(a.flags.writeable)
+
+        rgb = FringeFactory.MakeSinusoidalRGB(16, 3, 0.3, 40, 30)
+
+        self.assertEqual(rgb.shape, (3, 30, 40, 3))
+        self.assertTrue(np.shares_memory(rgb, a))
+        self.assertTrue(FringeFactory.GrayToRGB(a, view=False).flags.writeable)
+
+    def test_cache_bytes(self):
+        nbytes = FringeFactory.MakeSinusoidal(16, 3, 0.3, 40, 30).nbytes
+
+        with mock.patch.object(FringeFactory, 'CACHE_BYTES', 2 * nbytes):
+            FringeFactory.clear_cache()
+            a, b = (FringeFactory.MakeSinusoidal(16, 3, o, 40, 30) for o in (0.1, 0.2))
+
+            # Reusing a makes b the least recently used, evicted to make room for c
+            self.assertIs(a, FringeFactory.MakeSinusoidal(16, 3, 0.1, 40, 30))
+            c = FringeFactory.MakeSinusoidal(16, 3, 0.3, 40, 30)
+
+            self.assertIs(a, FringeFactory.MakeSinusoidal(16, 3, 0.1, 40, 30))
+            self.assertIs(c, FringeFactory.MakeSinusoidal(16, 3, 0.3, 40, 30))
+            self.assertIsNot(b, FringeFactory.MakeSinusoidal(16, 3, 0.2, 40, 30))
+
+            # A set over the whole limit is not cached at all
+            big = FringeFactory.MakeSinusoidal(16, 3, 0.3, 80, 60)
+            self.assertIsNot(big, FringeFactory.MakeSinusoidal(16, 3, 0.3, 80, 60))
+
+    def test_persisted(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(definitions, 'FRINGES_DIR', tmp):
+            a = FringeFactory.MakeSinusoidal(16, 3, 0.3, 40, 30, dtype=np.uint16, persist=True)
+
+            self.assertEqual(len(os.listdir(tmp)), 1)
+
+            FringeFactory.clear_cache()
+            b = FringeFactory.MakeSinusoidal(16, 3, 0.3, 40, 30, dtype=np.uint16, persist=True)
+
+            self.assertIsInstance(b, np.memmap)
+            np.testing.assert_array_equal(a, b)
+
+            del a, b
+
+    def test_interrupted_persist(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(definitions, 'FRINGES_DIR', tmp):
+            FringeFactory.clear_cache()
+
+            with mock.patch.object(np.lib.format, 'open_memmap', side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    FringeFactory.MakeSinusoidal(16, 3, 0.3, 40, 30, dtype=np.uint16, persist=True)
+
+            # Nothing partial is left behind for later runs to load
+            self.assertEqual(os.listdir(tmp), [])
+
+            FringeFactory.clear_cache()
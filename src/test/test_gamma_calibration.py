@@ -4,7 +4,7 @@ import numpy as np
 
 from numpy.polynomial.polynomial import polyval
 
-from opensfdi.calibration import GammaCalibration
+from opensfdi.calibration import GammaCalibration, apply_correction, apply_lut, correction_lut
 
 
 class TestGammaCalibration(unittest.TestCase):
@@ -71,4 +71,52 @@ class TestGammaCalibration(unittest.TestCase):
 
         self.assertListEqual(test_coeffs.tolist(), coeffs.tolist())
 
-        self.assertListEqual(test_values.tolist(), values.tolist())
\ No newline at end of file
+        self.assertListEqual(test_values.tolist(), values.tolist())
+
+
+class TestGammaLUT(unittest.TestCase):
+
+    def setUp(self):
+        self.coeffs = [0.6, 0.3, 0.1, 0.0] # Increasing curve on [0, 1]
+
+    def test_integer_in_place(self):
+        for dtype, size, bits in ((np.uint8, 256, None), (np.uint16, 4096, 12)):
+            lut = correction_lut(self.coeffs, size)
+
+            img = np.arange(size, dtype=dtype).reshape(16, -1)
+            expected = np.rint(np.clip(np.polyval(self.coeffs, img / (size - 1.0)), 0.0, 1.0) * (size - 1)).astype(dtype)
+
+            out = apply_lut(img, lut, bits=bits)
+
+            self.assertIs(out, img)
+            np.testing.assert_array_equal(img, expected)
+
+    def test_full_range_uint16(self):
+        pattern = np.linspace(0, 65535, 1 << 16).astype(np.uint16).reshape(256, -1)
+
+        # An identity table leaves a full-range pattern unchanged rather than saturating it
+        identity = apply_lut(pattern.copy(), correction_lut([1.0, 0.0], 4096))
+        np.testing.assert_array_equal(identity, pattern)
+
+        corrected = apply_lut(pattern.copy(), correction_lut(self.coeffs, 4096))
+        expected = np.clip(np.polyval(self.coeffs, pattern / 65535.0), 0.0, 1.0) * 65535
+
+        np.testing.assert_allclose(corrected, expected, atol=65535 * 1e-3)
+
+    def test_float_quantised(self):
+        lut = correction_lut(self.coeffs, 4096)
+
+        img = np.random.default_rng(0).random((32, 32), dtype=np.float32)
+
+        corrected = apply_lut(img, lut)
+
+        self.assertEqual(corrected.dtype, np.float32)
+        np.testing.assert_allclose(corrected, apply_correction(img, self.coeffs), atol=1e-3)
+
+    def test_load_lut(self):
+        data = {"coeffs": self.coeffs, "visible_intensities": [0.1, 0.9], "bit_depth": 10}
+
+        lut = GammaCalibration.load_lut(data)
+
+        self.assertEqual(len(lut), 1024)
+        np.testing.assert_array_equal(GammaCalibration.load_lut(data | {"lut": lut.tolist()}), lut)
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Generous ceiling for a bare import; the heavy optional dependencies alone take several times this
+IMPORT_BUDGET = 0.5
+
+PROBE = '''
+import os, sys, json, pathlib
+from time import perf_counter
+
+# Record any directory creation done while importing
+made = []
+os.mkdir = lambda path, *args, **kwargs: made.append(str(path))
+os.makedirs = lambda path, *args, **kwargs: made.append(str(path))
+pathlib.Path.mkdir = lambda self, *args, **kwargs: made.append(str(self))
+
+import importlib
+
+start = perf_counter()
+for module in sys.argv[1].split(','): importlib.import_module(module)
+elapsed = perf_counter() - start
+
+heavy = [m for m in ('matplotlib', 'skimage', 'cv2', 'stl', 'argparse') if m in sys.modules]
+print(json.dumps({"elapsed": elapsed, "heavy": heavy, "made": made}))
+'''
+
+class TestImport(unittest.TestCase):
+    def probe(self, modules='opensfdi,opensfdi.definitions', *argv):
+        result = subprocess.run([sys.executable, '-c', PROBE, modules, *argv], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+        return json.loads(result.stdout)
+
+    def test_no_heavy_imports(self):
+        # Unknown command line arguments are no longer parsed by the library
+        result = self.probe('opensfdi,opensfdi.definitions', '--debug', '--other')
+
+        self.assertEqual(result["heavy"], [])
+
+    def test_worker_modules(self):
+        # Imported by every spawned process worker, so they must stay as light as the package
+        for module in ('opensfdi.profilometry', 'opensfdi.experiment'):
+            with self.subTest(module=module):
+                result = self.probe(module)
+
+                self.assertEqual(result["heavy"], [])
+                self.assertEqual(result["made"], [])
+
+    def test_no_directories_created(self):
+        self.assertEqual(self.probe()["made"], [])
+
+    def test_import_time(self):
+        elapsed = min(self.probe()["elapsed"] for _ in range(3))
+
+        self.assertLess(elapsed, IMPORT_BUDGET)
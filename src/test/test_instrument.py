@@ -0,0 +1,91 @@
+import os
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+from opensfdi import instrument
+from opensfdi.experiment import Photogrammetry
+from opensfdi.unwrap import itoh
+from opensfdi.video import FakeCamera
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        instrument.reset()
+
+    def tearDown(self):
+        instrument.disable()
+        instrument.reset()
+
+    def test_disabled_records_nothing(self):
+        with instrument.span('outer') as s:
+            s.add(frames=1)
+            itoh.unwrap_phase(np.zeros((4, 4), dtype=np.float32))
+
+        self.assertEqual(instrument.records(), [])
+        self.assertIs(instrument.span('a'), instrument.span('b'))
+
+    def test_run_with_exhausted_cameras(self):
+        cameras = [FakeCamera(name=f'Camera{i}', loop=False) for i in range(2)]
+        with Photogrammetry(cameras, 0.0) as photogrammetry:
+            # Disabled: nothing is counted, so missing frames pass straight through
+            self.assertEqual(photogrammetry.run(), [None, None])
+
+            instrument.enable()
+            self.assertEqual(photogrammetry.run(), [None, None])
+
+        self.assertEqual(instrument.totals()["photogrammetry.run"]["pixels"], 0)
+
+    def test_nested_spans(self):
+        instrument.enable(memory=True)
+
+        wrapped = np.zeros((32, 48), dtype=np.float32)
+
+        with instrument.span('measurement', frames=2) as s:
+            buffer = np.ones(1 << 20, dtype=np.uint8)
+            itoh.unwrap_phase(wrapped, axis=None)
+            s.add(pixels=wrapped.size)
+
+        records = {r["name"]: r for r in instrument.records()}
+
+        self.assertEqual(records["unwrap.itoh"]["parent"], "measurement")
+        self.assertEqual(records["unwrap.itoh"]["pixels"], wrapped.size)
+        self.assertEqual(records["measurement"]["frames"], 2)
+        self.assertGreaterEqual(records["measurement"]["alloc_bytes"], buffer.nbytes)
+        self.assertGreaterEqual(records["measurement"]["wall"], records["unwrap.itoh"]["wall"])
+
+        totals = instrument.totals()
+        self.assertEqual(totals["unwrap.itoh"]["count"], 1)
+
+    def test_exports(self):
+        instrument.enable()
+
+        for _ in range(3):
+            with instrument.span('step', pixels=10): pass
+
+        with tempfile.TemporaryDirectory() as tmp:
+            log, prom, trace = (os.path.join(tmp, name) for name in ('spans.jsonl', 'spans.prom', 'trace.json'))
+
+            instrument.write_log(log)
+            instrument.write_prometheus(prom)
+            instrument.write_chrome_trace(trace)
+
+            with open(log) as infile:
+                self.assertEqual([json.loads(line)["name"] for line in infile], ['step'] * 3)
+
+            with open(prom) as infile:
+                text = infile.read()
+
+            self.assertIn('opensfdi_spans_total{span="step"} 3', text)
+            self.assertIn('opensfdi_span_pixels_total{span="step"} 30', text)
+
+            with open(trace) as infile:
+                events = json.load(infile)["traceEvents"]
+
+            self.assertEqual(len(events), 3)
+            self.assertEqual(events[0]["ph"], 'X')
+
+            # Nothing left behind by the atomic write, and readable beyond the owner like a plain open()
+            self.assertEqual(sorted(os.listdir(tmp)), ['spans.jsonl', 'spans.prom', 'trace.json'])
+            self.assertEqual(os.stat(prom).st_mode & 0o777, os.stat(log).st_mode & 0o777)
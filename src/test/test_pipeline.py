@@ -0,0 +1,49 @@
+import itertools
+import unittest
+
+from time import sleep
+
+from opensfdi.pipeline import Pipeline
+
+class TestPipeline(unittest.TestCase):
+    def test_ordered_results_and_stats(self):
+        counter = itertools.count()
+
+        stages = [('double', lambda x: 2 * x), ('inc', lambda x: x + 1)]
+
+        with Pipeline(lambda: next(counter), stages, maxsize=2) as pipeline:
+            results = list(itertools.islice(pipeline, 20))
+
+        self.assertEqual(results, [2 * i + 1 for i in range(20)])
+
+        stats = pipeline.stats()
+        self.assertEqual(list(stats.keys()), ['capture', 'double', 'inc'])
+        self.assertGreaterEqual(stats['inc']['count'], 20)
+        self.assertEqual(stats['double']['dropped'], 0)
+
+    def test_drop_oldest(self):
+        counter = itertools.count()
+
+        def slow(x):
+            sleep(0.02)
+            return x
+
+        with Pipeline(lambda: next(counter), [('slow', slow)], maxsize=1, policy='drop_oldest') as pipeline:
+            results = list(itertools.islice(pipeline, 5))
+
+        # Consumer only ever sees fresh, increasing items while the source keeps running
+        self.assertEqual(results, sorted(results))
+        self.assertGreater(pipeline.stats()['capture']['dropped'], 0)
+
+    def test_failure_propagates(self):
+        def fail(x):
+            raise ValueError('bad frame')
+
+        pipeline = Pipeline(lambda: 1, [('fail', fail)])
+
+        with self.assertRaises(Exception):
+            list(pipeline)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(Exception):
+            Pipeline(lambda: 1, [], policy='newest')
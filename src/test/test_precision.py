@@ -0,0 +1,96 @@
+import tempfile
+import unittest
+import tracemalloc
+
+import numpy as np
+
+from unittest import mock
+
+from opensfdi import definitions, rgb2grey, wrapped_phase, ac_imgs, dc_imgs, unwrapped_phase, set_precision, get_precision
+from opensfdi.calibration import apply_correction, apply_lut, correction_lut
+from opensfdi.experiment import LightCalc, FringeProjection, NStepFPExperiment
+from opensfdi.fringes import FringeFactory
+from opensfdi.video import FakeCamera, FringeProjector
+from opensfdi.profilometry import ClassicPhaseHeight, PolyPhaseHeight
+from opensfdi.unwrap import itoh, reliability, temporal
+from opensfdi.utils.maths import demodulate
+
+class DummyProjector(FringeProjector):
+    def __init__(self):
+        super().__init__('Projector1', 16, np.pi / 2.0, (64, 48), [0.0, 1.0, 2.0, 3.0])
+
+    def display(self):
+        pass
+
+def itoh_2d(phase):
+    return itoh.unwrap_phase(phase, axis=None)
+
+class TestPrecision(unittest.TestCase):
+    def setUp(self):
+        self.ref_imgs = np.asarray(FringeFactory.MakeSinusoidalRGB(16, 4, np.pi / 2.0, 64, 48, dtype=np.uint8))
+        self.imgs = np.asarray(FringeFactory.MakeSinusoidalRGB(14, 4, np.pi / 2.0, 64, 48, dtype=np.uint8))
+
+    def tearDown(self):
+        set_precision(np.float32)
+
+    def stage_outputs(self):
+        ''' (stage name, output) for every stage, each fed from integer frames or earlier stages. '''
+        grey = rgb2grey(self.imgs)
+        wrapped = wrapped_phase(grey)
+
+        outputs = [
+            ('rgb2grey uint8', grey),
+            ('rgb2grey uint16', rgb2grey(self.imgs.astype(np.uint16))),
+            ('demodulate', demodulate(self.imgs[..., 0])[1]),
+            ('wrapped_phase', wrapped),
+            ('ac_imgs', ac_imgs(grey)),
+            ('dc_imgs', dc_imgs(grey)),
+            ('itoh', itoh_2d(wrapped)),
+            ('itoh integer', itoh.unwrap_phase(np.zeros((4, 4), dtype=np.int16))),
+            ('reliability', reliability.unwrap_phase(wrapped)),
+            ('skimage', unwrapped_phase(wrapped)),
+            ('temporal', temporal.unwrap_phase(np.stack([wrapped, wrapped]), [14, 70], np.pi / 2.0)),
+            ('classic heightmap', ClassicPhaseHeight(1 / 16, 100.0, 200.0, itoh_2d).heightmap(self.ref_imgs, self.imgs, convert_grey=True)),
+            ('poly heightmap', PolyPhaseHeight([0.0, 0.5, 0.01], itoh_2d).heightmap(rgb2grey(self.ref_imgs), grey)),
+            ('apply_correction', apply_correction(self.imgs[0, ..., 0], [0.6, 0.3, 0.1, 0.0])),
+            ('apply_lut', apply_lut(grey[0], correction_lut([0.6, 0.3, 0.1, 0.0], 256))),
+            ('fringes', FringeFactory.MakeSinusoidal(16, 4, 0.0, 64, 48)),
+        ]
+
+        with NStepFPExperiment(FringeProjection([FakeCamera()], DummyProjector()), steps=4) as experiment:
+            for backend in ('serial', 'process'):
+                outputs.append((f'classic_ph {backend}', experiment.classic_ph(self.ref_imgs[None], self.imgs[None], 16, [100.0], [200.0], backend=backend)[0]))
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(definitions, 'CALIBRATION_DIR', tmp):
+            LightCalc._luts.clear()
+            outputs.append(('light calc', LightCalc(0.05, 1.0, 1.43, lut_size=64).optical_maps(0.8 * grey, grey)[0]))
+            LightCalc._luts.clear()
+
+        return outputs
+
+    def test_no_promotion(self):
+        for precision in (np.float32, np.float64):
+            set_precision(precision)
+
+            for name, output in self.stage_outputs():
+                with self.subTest(precision=np.dtype(precision).name, stage=name):
+                    self.assertEqual(output.dtype, precision)
+
+    def test_rgb2grey_integer_frames(self):
+        frame = np.zeros((480, 640, 3), dtype=np.uint8)
+
+        tracemalloc.start()
+        grey = rgb2grey(frame)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.assertEqual(grey.dtype, np.float32)
+
+        # The result and one channel of scratch (plus ufunc cast buffers), never a float copy of the whole frame
+        self.assertLessEqual(peak, 2 * grey.nbytes + 65536)
+
+    def test_unsupported_precision(self):
+        with self.assertRaises(Exception):
+            set_precision(np.float16)
+
+        self.assertEqual(get_precision(), np.float32)
@@ -0,0 +1,231 @@
+import os
+import functools
+import tempfile
+import tracemalloc
+import unittest
+import unittest.mock
+
+import numpy as np
+
+from stl import mesh
+
+from opensfdi.fringes import FringeFactory
+from opensfdi.io.repositories import BinCalibrationRepo
+from opensfdi.profilometry import ClassicPhaseHeight, PolyPhaseHeight, ReferencePhase
+from opensfdi.unwrap import itoh
+from opensfdi.workspace import Workspace
+
+
+class TestClassicPhaseHeight(unittest.TestCase):
+
+    def setUp(self):
+        w, h, steps, period = 400, 300, 4, 20
+
+        y, x = np.mgrid[0:h, 0:w]
+        bump = 3.0 * np.exp(-((x - 200) ** 2 + (y - 150) ** 2) / 3000.0)
+        shifts = (2.0 * np.pi * np.arange(steps)) / steps
+
+        self.ref_imgs = FringeFactory.MakeSinusoidal(period, steps, np.pi / 2.0, w, h)
+        self.imgs = (0.5 + 0.5 * np.cos((2.0 * np.pi * x) / period + bump + shifts[:, None, None])).astype(np.float32)
+
+        self.ph = ClassicPhaseHeight(period, 1.0, 2.0, unwrapper=lambda phase: itoh.unwrap_phase(phase, axis=None))
+
+    def test_tiled_matches_full(self):
+        expected = self.ph.heightmap(self.ref_imgs, self.imgs)
+
+        budget = 2 * 2 ** 20
+
+        tracemalloc.start()
+        result = self.ph.heightmap(self.ref_imgs, self.imgs, memory_budget=budget)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        np.testing.assert_allclose(result, expected, atol=1e-6)
+
+        self.assertLessEqual(self.ph.peak_bytes, budget)
+        self.assertLessEqual(peak, budget + result.nbytes)
+
+    def test_small_budget(self):
+        expected = self.ph.heightmap(self.ref_imgs, self.imgs)
+        row_bytes = self.ph.peak_bytes // expected.shape[0] # One band of every row
+
+        with self.assertRaises(ValueError):
+            self.ph.heightmap(self.ref_imgs, self.imgs, memory_budget=2 * row_bytes)
+
+        budget = 3 * row_bytes
+        result = self.ph.heightmap(self.ref_imgs, self.imgs, memory_budget=budget)
+
+        np.testing.assert_allclose(result, expected, atol=1e-6)
+        self.assertLessEqual(self.ph.peak_bytes, budget)
+
+    def test_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ref_imgs = np.lib.format.open_memmap(os.path.join(tmp, 'ref.npy'), mode='w+', dtype=np.float32, shape=self.ref_imgs.shape)
+            ref_imgs[:] = self.ref_imgs
+
+            out = np.lib.format.open_memmap(os.path.join(tmp, 'height.npy'), mode='w+', dtype=np.float32, shape=(239, 319))
+
+            result = self.ph.heightmap(ref_imgs, self.imgs, crop=(0.1, 0.1), memory_budget=2 ** 20, out=out)
+
+            self.assertIs(result, out)
+
+            np.testing.assert_allclose(out, self.ph.heightmap(self.ref_imgs, self.imgs, crop=(0.1, 0.1)), atol=1e-6)
+
+            del ref_imgs, out, result
+
+    def test_reference_phase(self):
+        ClassicPhaseHeight.clear_references()
+
+        # A lambda cannot be told apart from other lambdas, so it needs naming
+        self.assertRaises(Exception, self.ph.reference_phase, self.ref_imgs)
+
+        kwargs = dict(crop=(0.1, 0.1), memory_budget=2 ** 20)
+        ref = self.ph.reference_phase(self.ref_imgs, crop=kwargs['crop'], unwrapper_key='itoh-2d')
+
+        self.assertIs(self.ph.reference_phase(self.ref_imgs, crop=kwargs['crop'], unwrapper_key='itoh-2d'), ref)
+        self.assertNotEqual(self.ph.reference_key(self.ref_imgs, unwrapper_key='itoh-2d'), ref.key)
+
+        np.testing.assert_allclose(self.ph.heightmap(ref, self.imgs, **kwargs), self.ph.heightmap(self.ref_imgs, self.imgs, **kwargs), atol=1e-5)
+
+        self.assertRaises(Exception, self.ph.heightmap, ref, self.imgs)
+
+        poly = PolyPhaseHeight([0.0, 1.0], unwrapper=itoh.ItohUnwrapper())
+        np.testing.assert_allclose(poly.heightmap(poly.reference_phase(self.ref_imgs), self.imgs), poly.heightmap(self.ref_imgs, self.imgs))
+
+    def test_reference_unwrapper_keys(self):
+        ClassicPhaseHeight.clear_references()
+
+        rows = ClassicPhaseHeight(20, 1.0, 2.0, unwrapper=functools.partial(itoh.unwrap_phase, axis=-1))
+        cols = ClassicPhaseHeight(20, 1.0, 2.0, unwrapper=functools.partial(itoh.unwrap_phase, axis=0))
+
+        self.assertIsNot(rows.reference_phase(self.ref_imgs), cols.reference_phase(self.ref_imgs))
+        self.assertNotEqual(ClassicPhaseHeight(20, 1.0, 2.0, unwrapper=itoh.ItohUnwrapper(axis=0)).reference_key(self.ref_imgs),
+                            ClassicPhaseHeight(20, 1.0, 2.0, unwrapper=itoh.ItohUnwrapper(axis=None)).reference_key(self.ref_imgs))
+
+        def factory(axis):
+            return lambda phase: itoh.unwrap_phase(phase, axis=axis)
+
+        self.assertRaises(Exception, ClassicPhaseHeight(20, 1.0, 2.0, unwrapper=factory(0)).reference_key, self.ref_imgs)
+
+        # Only the most recently used references are kept
+        for i in range(ClassicPhaseHeight.REFERENCE_CACHE_SIZE + 2):
+            rows.reference_phase(self.ref_imgs[..., i:])
+
+        self.assertEqual(len(ClassicPhaseHeight._references), ClassicPhaseHeight.REFERENCE_CACHE_SIZE)
+
+    def test_reference_phase_repo(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'calibration.bin')
+
+            ClassicPhaseHeight.clear_references()
+            ref = self.ph.reference_phase(self.ref_imgs, repo=BinCalibrationRepo(path), unwrapper_key='itoh-2d')
+
+            ClassicPhaseHeight.clear_references()
+            repo = BinCalibrationRepo(path)
+            loaded = ReferencePhase.load(repo.load_reference(ref.key))
+
+            np.testing.assert_array_equal(loaded.phase, ref.phase)
+            self.assertIsNone(repo.load_reference('missing'))
+
+            # Served from the repository rather than recomputed
+            with unittest.mock.patch.object(ClassicPhaseHeight, '_reference_phasemap') as compute:
+                np.testing.assert_array_equal(self.ph.reference_phase(self.ref_imgs, repo=repo, unwrapper_key='itoh-2d').phase, ref.phase)
+                compute.assert_not_called()
+
+
+class TestWorkspace(unittest.TestCase):
+
+    def setUp(self):
+        w, h, steps, period = 320, 240, 4, 16
+
+        y, x = np.mgrid[0:h, 0:w]
+        bump = 2.0 * np.exp(-((x - 160) ** 2 + (y - 120) ** 2) / 3000.0)
+        shifts = (2.0 * np.pi * np.arange(steps)) / steps
+
+        def rgb(phase):
+            grey = 127.5 + 100.0 * np.cos((2.0 * np.pi * x) / period + phase + shifts[:, None, None])
+            return np.repeat(grey[..., None], 3, axis=-1).astype(np.uint8)
+
+        self.ref_imgs, self.imgs = rgb(0.0), rgb(bump)
+
+    def assert_steady_state(self, heightmap):
+        heightmap() # Warm-up allocates the workspace buffers
+
+        tracemalloc.start()
+        heightmap()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Only Python objects and numpy's fixed-size casting buffers, far below one (300KB) phase map
+        self.assertLess(peak, 128 * 1024)
+
+    def test_classic_no_allocations(self):
+        kwargs = dict(convert_grey=True, crop=(0.1, 0.1))
+
+        expected = ClassicPhaseHeight(16, 1.0, 2.0, unwrapper=itoh.ItohUnwrapper()).heightmap(self.ref_imgs, self.imgs, **kwargs)
+
+        ph = ClassicPhaseHeight(16, 1.0, 2.0, unwrapper=itoh.ItohUnwrapper(), workspace=Workspace())
+        result = ph.heightmap(self.ref_imgs, self.imgs, **kwargs)
+
+        np.testing.assert_allclose(result, expected, atol=1e-5)
+        self.assertIs(ph.heightmap(self.ref_imgs, self.imgs, **kwargs), result)
+
+        self.assert_steady_state(lambda: ph.heightmap(self.ref_imgs, self.imgs, **kwargs))
+
+    def test_poly_no_allocations(self):
+        ref_imgs, imgs = np.ascontiguousarray(self.ref_imgs[..., 0]), np.ascontiguousarray(self.imgs[..., 0])
+
+        expected = PolyPhaseHeight([0.1, 0.5, 0.02], unwrapper=itoh.ItohUnwrapper()).heightmap(ref_imgs, imgs)
+
+        ph = PolyPhaseHeight([0.1, 0.5, 0.02], unwrapper=itoh.ItohUnwrapper(), workspace=Workspace())
+
+        np.testing.assert_allclose(ph.heightmap(ref_imgs, imgs), expected, atol=1e-5)
+
+        self.assert_steady_state(lambda: ph.heightmap(ref_imgs, imgs))
+
+
+class TestMeshExport(unittest.TestCase):
+
+    def setUp(self):
+        self.ph = ClassicPhaseHeight(1.0, 1.0, 1.0)
+        self.heightmap = np.random.default_rng(0).random((13, 17)).astype(np.float32)
+
+    def test_stl_matches_pixel_grid(self):
+        h, w = self.heightmap.shape
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self.ph.to_stl(self.heightmap, os.path.join(tmp, 'mesh.stl'), scale=(0.5, 2.0), chunk_rows=4)
+            vectors = mesh.Mesh.from_file(path).vectors
+
+        self.assertEqual(len(vectors), 2 * (h - 1) * (w - 1))
+
+        # Second quad of the second row: triangles (v1, v2, v3) and (v2, v4, v3)
+        y, x = 1, 1
+        i = 2 * (y * (w - 1) + x)
+        z = self.heightmap
+
+        np.testing.assert_allclose(vectors[i], [[0.5 * x, 2.0 * y, z[y, x]], [0.5 * (x + 1), 2.0 * y, z[y, x + 1]], [0.5 * x, 2.0 * (y + 1), z[y + 1, x]]])
+        np.testing.assert_allclose(vectors[i + 1], [[0.5 * (x + 1), 2.0 * y, z[y, x + 1]], [0.5 * (x + 1), 2.0 * (y + 1), z[y + 1, x + 1]], [0.5 * x, 2.0 * (y + 1), z[y + 1, x]]])
+
+    def test_nan_pixels_skipped(self):
+        h, w = self.heightmap.shape
+        self.heightmap[5, 5] = np.nan
+
+        with tempfile.TemporaryDirectory() as tmp:
+            vectors = mesh.Mesh.from_file(self.ph.to_stl(self.heightmap, os.path.join(tmp, 'mesh.stl'), chunk_rows=4)).vectors
+
+            with open(self.ph.to_ply(self.heightmap, os.path.join(tmp, 'mesh.ply'), chunk_rows=4), 'rb') as infile:
+                raw = infile.read()
+
+        # An interior pixel belongs to six triangles
+        self.assertEqual(len(vectors), 2 * (h - 1) * (w - 1) - 6)
+        self.assertTrue(np.isfinite(vectors).all())
+
+        end = raw.index(b'end_header\n') + len(b'end_header\n')
+        self.assertIn(f'element vertex {h * w - 1}'.encode(), raw[:end])
+        self.assertIn(f'element face {len(vectors)}'.encode(), raw[:end])
+
+        verts = np.frombuffer(raw[end : end + 12 * (h * w - 1)], dtype='<f4').reshape(-1, 3)
+        faces = np.frombuffer(raw[end + 12 * (h * w - 1):], dtype=np.dtype([('n', 'u1'), ('v', '<i4', (3,))]))
+
+        np.testing.assert_allclose(verts[faces['v']], vectors)
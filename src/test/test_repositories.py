@@ -0,0 +1,184 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from opensfdi.io.repositories import BinRepo, ChunkedArrayRepo, FileImageRepo
+from opensfdi.services import ResultService
+
+class TestBinRepo(unittest.TestCase):
+    def test_append_and_reopen(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data.bin')
+
+            repo = BinRepo(path)
+            repo.add_bin({"a": 1, "b": [1, 2]})
+            repo.commit()
+            repo.add_bin({"b": [3]})
+            repo.commit()
+
+            repo = BinRepo(path)
+            self.assertEqual(repo.load_key("b"), [3])
+            self.assertEqual(repo.load_bin(), {"a": 1, "b": [3]})
+
+    def test_torn_write_ignored(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data.bin')
+
+            repo = BinRepo(path)
+            repo.add_bin({"a": 1})
+            repo.commit()
+
+            # Records without a commit marker, as left by an interrupted write
+            with open(path, 'ab') as outfile:
+                value = pickle.dumps(2)
+                outfile.write(BinRepo._HEADER.pack(BinRepo._DATA, len(pickle.dumps("a")), len(value)) + pickle.dumps("a") + value[:-1])
+
+            repo = BinRepo(path)
+            self.assertEqual(repo.load_bin(), {"a": 1})
+
+            repo.add_bin({"c": 3})
+            repo.commit()
+            self.assertEqual(BinRepo(path).load_bin(), {"a": 1, "c": 3})
+
+    def test_compaction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data.bin')
+
+            repo = BinRepo(path, compact_min_bytes=0)
+            for i in range(20):
+                repo.add_bin({"big": np.full(1000, i), "i": i})
+                repo.commit()
+
+            self.assertLess(os.path.getsize(path), 3 * 8000)
+            self.assertEqual(BinRepo(path).load_key("i"), 19)
+
+    def test_shared_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data.bin')
+
+            first, second = BinRepo(path), BinRepo(path)
+            first.add_bin({"a": 1})
+            first.commit()
+            self.assertEqual(second.load_key("a"), 1)
+
+            # Each commits on top of what the other committed since it last looked
+            second.add_bin({"b": 2})
+            second.commit()
+            first.add_bin({"c": 3})
+            first.commit()
+            second.add_bin({"a": 4})
+            second.commit()
+
+            self.assertEqual(BinRepo(path).load_bin(), {"a": 4, "b": 2, "c": 3})
+            self.assertEqual(first.load_key("c"), 3)
+
+            # Compacting replaces the file under the other instance
+            first.compact()
+            self.assertEqual(second.load_key("b"), 2)
+            self.assertEqual(second.load_key("a"), 4)
+
+    def test_reads_legacy_pickle(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data.bin')
+
+            with open(path, 'wb') as outfile:
+                pickle.dump({"a": 1, "b": 2}, outfile)
+
+            repo = BinRepo(path)
+            self.assertEqual(repo.load_key("b"), 2)
+
+            repo.add_bin({"b": 3})
+            repo.commit()
+
+            with open(path, 'rb') as infile:
+                self.assertEqual(infile.read(len(BinRepo.MAGIC)), BinRepo.MAGIC)
+
+            self.assertEqual(BinRepo(path).load_bin(), {"a": 1, "b": 3})
+
+class TestChunkedArrayRepo(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+
+        self.imgs = rng.integers(0, 65535, (2, 3, 24, 32, 3), dtype=np.uint16)
+        self.heightmaps = rng.random((2, 24, 32), dtype=np.float32)
+
+    def test_roundtrip(self):
+        for compression in (None, 'zlib'):
+            with tempfile.TemporaryDirectory() as tmp:
+                repo = ChunkedArrayRepo(tmp, compression=compression)
+                repo.add_image(self.imgs, 'imgs')
+                repo.add_heightmap(self.heightmaps, 'heightmaps')
+                repo.commit()
+
+                repo = ChunkedArrayRepo(tmp)
+
+                imgs = repo.load_image('imgs')
+                self.assertEqual(imgs.dtype, np.uint16)
+                np.testing.assert_array_equal(imgs, self.imgs)
+                np.testing.assert_array_equal(repo.load_heightmap('heightmaps'), self.heightmaps)
+
+                # Single camera/phase without reading the rest of the stack
+                np.testing.assert_array_equal(repo.load_frame('imgs', (1, 2)), self.imgs[1, 2])
+                np.testing.assert_array_equal(repo.load_frame('heightmaps', (1,), kind='heightmaps'), self.heightmaps[1])
+
+                if compression is None: self.assertIsInstance(imgs, np.memmap)
+
+                del imgs
+
+    def test_recommit_keeps_loaded_maps(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            repo = ChunkedArrayRepo(tmp)
+            repo.add_image(self.imgs, 'imgs')
+            repo.commit()
+
+            imgs = repo.load_image('imgs')
+
+            # Smaller and same-size rewrites of the file behind a live memory map
+            for replacement in (self.imgs[:1], self.imgs[::-1]):
+                repo.add_image(replacement, 'imgs')
+                repo.commit()
+
+                np.testing.assert_array_equal(imgs, self.imgs)
+                np.testing.assert_array_equal(repo.load_image('imgs'), replacement)
+
+            del imgs
+
+    def test_result_service(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            service = ResultService(BinRepo(os.path.join(tmp, 'results.bin')), ChunkedArrayRepo(tmp))
+
+            service.save_data(data={"phases": 3}, imgs=self.imgs, ref_imgs=self.imgs[::-1], heightmaps=self.heightmaps)
+
+            ref_imgs, imgs, data = service.load_data()
+
+            self.assertEqual(data["phases"], 3)
+            np.testing.assert_array_equal(imgs, self.imgs)
+            np.testing.assert_array_equal(ref_imgs, self.imgs[::-1])
+            np.testing.assert_array_equal(service.load_heightmaps(), self.heightmaps)
+
+            del ref_imgs, imgs
+
+class TestFileImageRepo(unittest.TestCase):
+    def test_parallel_roundtrip(self):
+        rng = np.random.default_rng(1)
+        imgs = [rng.integers(0, 255, (16, 20, 3), dtype=np.uint8) for _ in range(8)]
+        names = [f'img{i}.png' for i in range(len(imgs))]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            repo = FileImageRepo(tmp, workers=4)
+
+            for img, name in zip(imgs, names):
+                # Lossless format with a full 0-255 range so normalisation is a no-op
+                img[0, 0] = (0, 0, 0)
+                img[0, 1] = (255, 255, 255)
+                repo.add_image(img, name)
+
+            repo.commit()
+
+            loaded = repo.load_images(reversed(names))
+
+        for img, expected in zip(loaded, reversed(imgs)):
+            np.testing.assert_array_equal(img, expected)
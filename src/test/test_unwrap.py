@@ -0,0 +1,172 @@
+import unittest
+
+import numpy as np
+
+from opensfdi.fringes import FringeFactory
+from opensfdi.profilometry import ClassicPhaseHeight
+from opensfdi.unwrap import itoh, reliability, temporal
+from opensfdi.utils.maths import demodulate
+
+
+def loop_unwrap_1d(wrapped):
+    k = 0
+
+    addon = np.zeros_like(wrapped)
+
+    for i in range(1, len(wrapped)):
+        difference = wrapped[i] - wrapped[i - 1]
+        if np.pi < difference:
+            k -= (2.0 * np.pi)
+
+        elif difference < -np.pi:
+            k += (2.0 * np.pi)
+
+        addon[i] = k
+
+    return wrapped + addon
+
+
+def wrap(x):
+    return np.angle(np.exp(1j * x))
+
+
+class TestItohUnwrap(unittest.TestCase):
+
+    def setUp(self):
+        y, x = np.mgrid[0:48, 0:64]
+
+        self.truth = 0.3 * x + 0.15 * y + 0.002 * x * y
+        self.wrapped = wrap(self.truth)
+
+    def test_1d_matches_loop(self):
+        line = self.wrapped[7]
+
+        np.testing.assert_allclose(itoh.unwrap_phase(line), loop_unwrap_1d(line))
+
+    def test_rows_match_loop(self):
+        expected = np.array([loop_unwrap_1d(row) for row in self.wrapped])
+
+        np.testing.assert_allclose(itoh.unwrap_phase(self.wrapped), expected)
+
+        expected = np.array([loop_unwrap_1d(col) for col in self.wrapped.T]).T
+
+        np.testing.assert_allclose(itoh.unwrap_phase(self.wrapped, axis=0), expected)
+
+    def test_2d_recovers_surface(self):
+        unwrapped = itoh.unwrap_phase(self.wrapped, axis=None)
+
+        np.testing.assert_allclose(unwrapped - unwrapped[0, 0], self.truth - self.truth[0, 0], atol=1e-9)
+
+    def test_batched(self):
+        batch = np.stack([self.wrapped, wrap(self.truth * 0.5), wrap(-self.truth)]).astype(np.float32)
+
+        unwrapped = itoh.unwrap_phase(batch, axis=None)
+
+        self.assertEqual(unwrapped.dtype, np.float32)
+
+        for result, wrapped in zip(unwrapped, batch):
+            np.testing.assert_array_equal(result, itoh.unwrap_phase(wrapped, axis=None))
+
+
+class TestReliabilityUnwrap(unittest.TestCase):
+
+    def setUp(self):
+        y, x = np.mgrid[0:60, 0:95]
+
+        bump = 4.0 * np.exp(-((x - 40) ** 2 + (y - 30) ** 2) / 200.0)
+
+        self.truth = (0.4 * x + 0.25 * y + bump).astype(np.float32)
+        self.wrapped = wrap(self.truth).astype(np.float32)
+
+    def test_recovers_surface(self):
+        unwrapped = reliability.unwrap_phase(self.wrapped)
+
+        self.assertEqual(unwrapped.shape, self.wrapped.shape)
+        self.assertEqual(unwrapped.dtype, np.float32)
+
+        np.testing.assert_allclose(unwrapped - unwrapped[0, 0], self.truth - self.truth[0, 0], atol=1e-4)
+
+    def test_nan_mask(self):
+        masked = self.wrapped.copy()
+        masked[20:30, :] = np.nan
+
+        unwrapped = reliability.unwrap_phase(masked)
+        valid = ~np.isnan(masked)
+
+        self.assertTrue(np.isnan(unwrapped[~valid]).all())
+        self.assertFalse(np.isnan(unwrapped[valid]).any())
+
+        # Each disconnected region is correct up to its own multiple of 2pi
+        for region in (slice(0, 20), slice(30, None)):
+            diff = (unwrapped - self.truth)[region]
+
+            np.testing.assert_allclose(diff, diff[0, 0], atol=1e-4)
+            self.assertAlmostEqual(diff[0, 0] / (2.0 * np.pi), round(diff[0, 0] / (2.0 * np.pi)), places=4)
+
+
+class TestTemporalUnwrap(unittest.TestCase):
+
+    def setUp(self):
+        self.width, self.height = 240, 16
+
+    def wrapped(self, periods, orientation=np.pi / 2.0, steps=4, width=None, height=None):
+        width, height = width or self.width, height or self.height
+
+        return np.array([
+            demodulate(FringeFactory.MakeSinusoidal(period, steps, orientation, width, height))[0]
+            for period in periods
+        ])
+
+    def truth(self, period, orientation=np.pi / 2.0, width=None, height=None):
+        width, height = width or self.width, height or self.height
+
+        x = np.arange(width, dtype=np.float64)[None, :]
+        y = np.arange(height, dtype=np.float64)[:, None]
+
+        return (2.0 * np.pi / period) * (np.sin(orientation) * x - np.cos(orientation) * y)
+
+    def test_hierarchical(self):
+        periods = [256, 48, 10]
+
+        unwrapped = temporal.unwrap_phase(self.wrapped(periods), periods, np.pi / 2.0, method='hierarchical')
+
+        np.testing.assert_allclose(unwrapped, self.truth(10), atol=1e-3)
+
+    def test_heterodyne(self):
+        periods = [13, 12, 14]
+
+        unwrapped = temporal.unwrap_phase(self.wrapped(periods), periods, np.pi / 2.0, method='heterodyne')
+
+        np.testing.assert_allclose(unwrapped, self.truth(12), atol=1e-3)
+
+    def test_orientations(self):
+        # The coarse phase is negative over part or all of the field for these
+        width = height = 120
+
+        for orientation in (0.0, -np.pi / 2.0, np.pi / 4.0):
+            with self.subTest(orientation=orientation):
+                periods = [256, 48, 10]
+                wrapped = self.wrapped(periods, orientation, width=width, height=height)
+
+                unwrapped = temporal.unwrap_phase(wrapped, periods, orientation, method='hierarchical')
+                np.testing.assert_allclose(unwrapped, self.truth(10, orientation, width, height), atol=1e-3)
+
+                periods = [13, 12, 14]
+                wrapped = self.wrapped(periods, orientation, width=width, height=height)
+
+                unwrapped = temporal.unwrap_phase(wrapped, periods, orientation, method='heterodyne')
+                np.testing.assert_allclose(unwrapped, self.truth(12, orientation, width, height), atol=1e-3)
+
+    def test_span(self):
+        # 240 pixels across the field needs a coarsest period longer than that
+        with self.assertRaisesRegex(Exception, 'does not span'):
+            temporal.unwrap_phase(self.wrapped([200, 10]), [200, 10], np.pi / 2.0)
+
+    def test_phase_height_hook(self):
+        periods = [256, 32]
+
+        stacks = np.array([FringeFactory.MakeSinusoidal(p, 4, np.pi / 2.0, self.width, self.height) for p in periods])
+
+        ph = ClassicPhaseHeight(32, 1.0, 1.0, unwrapper=temporal.TemporalUnwrapper(periods, np.pi / 2.0))
+
+        np.testing.assert_allclose(ph.phasemap(stacks), self.truth(32), atol=1e-3)
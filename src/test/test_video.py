@@ -0,0 +1,180 @@
+import os
+import sys
+import cv2
+import tempfile
+import subprocess
+import unittest
+
+import numpy as np
+
+from time import sleep, perf_counter
+
+from opensfdi.experiment import FringeProjection, NStepFPExperiment
+from opensfdi.profilometry import ClassicPhaseHeight
+from opensfdi.unwrap import itoh
+from opensfdi.video import FakeCamera, CaptureCoordinator, FringeProjector, SyntheticCamera
+
+class LatencyCamera(FakeCamera):
+    def __init__(self, latency, name='Camera1'):
+        super().__init__(name=name)
+
+        self.latency = latency
+
+    def capture(self):
+        sleep(self.latency)
+        return np.zeros((4, 4, 3), dtype=np.uint8)
+
+class TestCaptureCoordinator(unittest.TestCase):
+    def test_concurrent_capture(self):
+        cameras = [LatencyCamera(0.1, f'Camera{i}') for i in range(4)]
+        coordinator = CaptureCoordinator(cameras, timeout=2.0)
+
+        start = perf_counter()
+        for _ in range(3):
+            imgs = coordinator.capture()
+        elapsed = perf_counter() - start
+
+        coordinator.close()
+
+        self.assertEqual(len(imgs), len(cameras))
+        self.assertEqual(len(coordinator.timestamps), len(cameras))
+
+        # Roughly one exposure per capture rather than one per camera
+        self.assertLess(elapsed, 3 * 0.1 * len(cameras) * 0.75)
+        self.assertLess(max(coordinator.timestamps) - min(coordinator.timestamps), 0.05)
+
+    def test_timeout(self):
+        slow = LatencyCamera(1.0, 'Slow')
+        coordinator = CaptureCoordinator([LatencyCamera(0.01, 'A'), slow], timeout=0.2)
+
+        with self.assertRaisesRegex(Exception, 'Slow did not capture'):
+            coordinator.capture()
+
+        # The hung capture is reported against its own camera, not a healthy one
+        with self.assertRaisesRegex(Exception, '^Slow still capturing'):
+            coordinator.capture()
+
+        slow.latency = 0.01
+        sleep(1.0)
+
+        self.assertEqual(len(coordinator.capture()), 2)
+
+        coordinator.close()
+
+        with self.assertRaisesRegex(Exception, 'closed'):
+            coordinator.capture()
+
+    def test_hung_camera_exit(self):
+        # A camera whose read never returns must not keep the interpreter from exiting
+        code = (
+            "import threading\n"
+            "from opensfdi.experiment import Photogrammetry\n"
+            "class Hung:\n"
+            "    name = 'Hung'\n"
+            "    def capture(self): threading.Event().wait()\n"
+            "with Photogrammetry([Hung(), Hung()], 0.0, timeout=0.1) as p:\n"
+            "    try: p.run()\n"
+            "    except Exception as e: print(e)\n"
+        )
+
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=60,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('did not capture', result.stdout)
+
+class TestUndistortMaps(unittest.TestCase):
+    def setUp(self):
+        w, h = 64, 48
+
+        self.camera = LatencyCamera(0.0)
+        self.camera.set_resolution((w, h))
+        self.camera.cam_mat = np.array([[60.0, 0.0, w / 2], [0.0, 60.0, h / 2], [0.0, 0.0, 1.0]])
+        self.camera.dist_mat = np.array([[-0.2, 0.05, 0.001, 0.001, 0.0]])
+        self.camera.optimal_mat = self.camera.cam_mat.copy()
+
+        self.img = np.random.default_rng(0).integers(0, 255, (h, w, 3), dtype=np.uint8)
+
+    def test_matches_undistort(self):
+        c = self.camera
+        expected = cv2.undistort(self.img, c.cam_mat, c.dist_mat, None, c.optimal_mat)
+
+        out = np.empty_like(self.img)
+        result = c.try_undistort_img(self.img, out=out)
+
+        self.assertIs(result, out)
+        self.assertLessEqual(np.abs(result.astype(int) - expected).max(), 1)
+
+        # Cached until the calibration changes
+        maps = c.undistort_maps()
+        self.assertIs(c.undistort_maps()[0], maps[0])
+
+        c.dist_mat = np.zeros((1, 5))
+        self.assertIsNot(c.undistort_maps()[0], maps[0])
+        np.testing.assert_array_equal(c.try_undistort_img(self.img), self.img)
+
+    def test_persisted_maps(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'maps.npz')
+            self.camera.save_undistort_maps(path)
+
+            camera = LatencyCamera(0.0)
+            camera.cam_mat, camera.dist_mat, camera.optimal_mat = self.camera.cam_mat, self.camera.dist_mat, self.camera.optimal_mat
+            self.assertTrue(camera.load_undistort_maps(path))
+            np.testing.assert_array_equal(camera.undistort_maps((64, 48))[0], self.camera.undistort_maps()[0])
+
+            camera.dist_mat = np.zeros((1, 5))
+            self.assertFalse(camera.load_undistort_maps(path))
+
+class StepProjector(FringeProjector):
+    def __init__(self, steps=4, frequency=16):
+        super().__init__('Projector1', frequency, np.pi / 2.0, (96, 64), [2.0 * np.pi * i / steps for i in range(steps)])
+
+    def display(self):
+        pass
+
+class TestFakeCamera(unittest.TestCase):
+    def test_replay(self):
+        imgs = [np.full((2, 2), i) for i in range(3)]
+
+        camera = FakeCamera(imgs, name='Replay')
+        self.assertEqual(camera.name, 'Replay')
+        self.assertEqual([camera.capture()[0, 0] for _ in range(5)], [0, 1, 2, 0, 1])
+
+        camera = FakeCamera(imgs, loop=False)
+        self.assertEqual([None if x is None else x[0, 0] for x in (camera.capture() for _ in range(4))], [0, 1, 2, None])
+
+class TestSyntheticCamera(unittest.TestCase):
+    def test_reconstructs_heightmap(self):
+        w, h = 96, 64
+        y, x = np.ogrid[-1.0:1.0:h * 1j, -1.0:1.0:w * 1j]
+        truth = (5.0 * np.exp(-3.0 * (x * x + y * y))).astype(np.float32)
+
+        projector = StepProjector()
+        camera = SyntheticCamera(projector, resolution=(w, h), plane_dist=100.0, proj_dist=200.0, dtype=np.uint16)
+
+        experiment = NStepFPExperiment(FringeProjection([camera], projector), steps=4)
+        experiment.add_pre_ref_callback(lambda: camera.set_heightmap(None))
+        experiment.add_post_ref_callback(lambda: camera.set_heightmap(truth))
+
+        with experiment:
+            ref_imgs, imgs = experiment.run()
+
+        self.assertEqual(imgs.shape, (1, 4, h, w, 3))
+        self.assertEqual(imgs.dtype, np.uint16)
+
+        ph = ClassicPhaseHeight(1.0 / projector.frequency, 100.0, 200.0, unwrapper=lambda phase: itoh.unwrap_phase(phase, axis=None))
+        heightmap = ph.heightmap(ref_imgs[0, ..., 0].astype(np.float32), imgs[0, ..., 0].astype(np.float32))
+
+        np.testing.assert_allclose(heightmap, truth, atol=0.02)
+
+    def test_noise_and_gamma(self):
+        projector = StepProjector()
+        camera = SyntheticCamera(projector, resolution=(96, 64), noise=0.05, gamma=2.2, channels=None, seed=0)
+
+        clean = SyntheticCamera(projector, resolution=(96, 64), gamma=2.2, channels=None).capture()
+        noisy = camera.capture()
+
+        self.assertEqual(noisy.shape, (64, 96))
+        self.assertAlmostEqual(float(np.std(noisy - clean)), 0.05, delta=0.01)
+        self.assertLessEqual(clean.max(), 1.0)